@@ -18,13 +18,17 @@ class HospitalAdminAdmin(admin.ModelAdmin):
 
 admin.site.register(models.Patient)
 admin.site.register(models.Appointment, AppointmentAdmin)
+admin.site.register(models.RecurringAppointment)
+admin.site.register(models.SkippedOccurrence)
 admin.site.register(models.Doctor)
 admin.site.register(models.Nurse)
 admin.site.register(models.Hospital)
 admin.site.register(models.HospitalAdmin, HospitalAdminAdmin)
 admin.site.register(models.Prescription)
+admin.site.register(models.Conversation)
 admin.site.register(models.Message)
 admin.site.register(models.TransferRequest)
 admin.site.register(models.TransferRequestReply)
 admin.site.register(models.Test)
 admin.site.register(models.LogEntry)
+admin.site.register(models.UserRoleIndex)
@@ -0,0 +1,249 @@
+"""
+    File containing the bulk appointment import, used to move a clinic's
+    schedule into HealthNet in one go. The appointments already booked for
+    everyone in a batch are read up front into sorted lists, one per doctor
+    and patient, and every row is checked against them in memory with the
+    same half hour rule as single bookings. The rows that pass are written
+    with bulk_create, and the rest are reported back by row.
+"""
+
+import csv
+import datetime
+import io
+import json
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Appointment, Doctor, Patient, RecurringAppointment
+from .cache_versions import bump, appointment_scopes
+from .recurrence import series_in
+from .scheduling import CONFLICT_WINDOW, IntervalIndex
+from .windows import DateWindow
+
+# the formats batches can be given in
+CSV = 'csv'
+JSON = 'json'
+FORMATS = (CSV, JSON)
+
+# the columns of a batch; doctors and patients are given by username or id
+COLUMNS = ('doctor', 'patient', 'appointment_time', 'reason')
+
+# the states an imported appointment may be given, pending by default
+IMPORT_STATES = (Appointment.PENDING, Appointment.ACCEPTED)
+
+# the formats appointment times are read in
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M')
+
+# how many ids go into a single IN (...) clause, well under SQLite's limit
+# of 999 variables a query
+ID_CHUNK_SIZE = 400
+
+# the outcome of an import: the appointments created, and the number and
+# reason of each row that was turned down
+ImportReport = namedtuple('ImportReport', ['created', 'rejected'])
+
+
+class ImportFileError(Exception):
+    """
+        Raised when a batch can't be read at all
+    """
+
+
+def guess_format(filename):
+    """
+        Works out the format of a batch from its file name
+    :param filename: (str) the file name
+    :return: (str) CSV or JSON, or None if the extension is neither
+    """
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return extension if extension in FORMATS else None
+
+
+def read_rows(text, file_format):
+    """
+        Reads the rows of a batch. CSV batches have a header row naming the
+        columns; JSON batches are a list of objects, or an object with the
+        list under "appointments".
+    :param text: (str) the contents of the batch
+    :param file_format: (str) CSV or JSON
+    :return: (list) a dict for each row
+    :raises ImportFileError: if the batch can't be read
+    """
+    if file_format == CSV:
+        reader = csv.DictReader(io.StringIO(text))
+        if reader.fieldnames is None or not set(COLUMNS) <= {name.strip() for name in reader.fieldnames}:
+            raise ImportFileError('The CSV header must name the columns %s' % ', '.join(COLUMNS))
+        return [{key.strip(): value for key, value in row.items() if key is not None} for row in reader]
+
+    if file_format == JSON:
+        try:
+            rows = json.loads(text)
+        except ValueError as error:
+            raise ImportFileError('The file is not valid JSON: %s' % error)
+        if isinstance(rows, dict):
+            rows = rows.get('appointments')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ImportFileError('The JSON must be a list of appointments')
+        return rows
+
+    raise ImportFileError('Batches must be %s' % ' or '.join(FORMATS))
+
+
+def _chunks(values, size=ID_CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def parse_time(value):
+    """
+        Reads an appointment time
+    :param value: (str) the time
+    :return: (datetime) the time, or None if it isn't in a known format
+    """
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), time_format)
+        except ValueError:
+            pass
+    return None
+
+
+def _people(model, references, hospital_id=None):
+    """
+        Looks up the doctors or patients a batch refers to, by username or id
+    :return: (dict) the id and hospital id of each reference found
+    """
+    rows = []
+    for chunk in _chunks(references):
+        people = model.objects.filter(Q(username__in=chunk) |
+                                      Q(pk__in=[int(reference) for reference in chunk if reference.isdigit()]))
+        if hospital_id is not None:
+            people = people.filter(hospital_id=hospital_id)
+        rows.extend(people.values_list('pk', 'username', 'hospital_id'))
+
+    found = {}
+    for pk, username, person_hospital in rows:
+        found[username] = (pk, person_hospital)
+    for pk, username, person_hospital in rows:
+        # a username wins over an id that happens to look the same
+        found.setdefault(str(pk), (pk, person_hospital))
+    return found
+
+
+def import_appointments(rows, hospital_id=None, dry_run=False, now=None):
+    """
+        Checks every row of a batch and books the ones that pass. A row is
+        turned down if it is incomplete, in the past, names a doctor or
+        patient that doesn't exist (or isn't in the hospital), or comes less
+        than half an hour from another appointment of its doctor or patient,
+        whether booked already or earlier in the batch.
+    :param rows: (list) the rows, from read_rows
+    :param hospital_id: (int) if given, only doctors and patients of this
+                        hospital can be booked
+    :param dry_run: (bool) check the rows without booking any of them
+    :param now: (datetime) the current time, defaults to now
+    :return: (ImportReport) the appointments created and the rows turned
+                down, numbered from 1
+    """
+    now = now or datetime.datetime.now()
+    rejected = []
+    parsed = []
+
+    for number, row in enumerate(rows, 1):
+        values = {column: str(row.get(column) or '').strip() for column in COLUMNS}
+        missing = [column for column in COLUMNS if not values[column]]
+        if missing:
+            rejected.append((number, 'Missing %s' % ', '.join(missing)))
+            continue
+
+        time = parse_time(values['appointment_time'])
+        state = str(row.get('accept_state') or Appointment.PENDING).strip().capitalize()
+        if time is None:
+            rejected.append((number, 'Appointment time is not YYYY-MM-DD HH:MM[:SS]'))
+        elif time <= now:
+            rejected.append((number, 'Appointment time is in the past'))
+        elif len(values['reason']) > Appointment._meta.get_field('reason').max_length:
+            rejected.append((number, 'Reason is too long'))
+        elif state not in IMPORT_STATES:
+            rejected.append((number, 'Accept state must be %s' % ' or '.join(IMPORT_STATES)))
+        else:
+            parsed.append((number, values, time, state))
+
+    doctors = _people(Doctor, {values['doctor'] for _, values, _, _ in parsed}, hospital_id)
+    patients = _people(Patient, {values['patient'] for _, values, _, _ in parsed}, hospital_id)
+
+    booked = []
+    index = IntervalIndex()
+    with transaction.atomic():
+        party_ids = sorted({pk for pk, _ in doctors.values()} | {pk for pk, _ in patients.values()})
+
+        if parsed and party_ids:
+            # hold everyone in the batch, as single bookings do, in the same order
+            for chunk in _chunks(party_ids):
+                list(User.objects.select_for_update().filter(pk__in=chunk).order_by('pk').values_list('pk', flat=True))
+
+            # every appointment that could be in the way of a row
+            first = min(time for _, _, time, _ in parsed) - CONFLICT_WINDOW
+            last = max(time for _, _, time, _ in parsed) + CONFLICT_WINDOW
+            seen = set()
+            for chunk in _chunks(party_ids):
+                for appt_id, doctor_id, patient_id, time in Appointment.objects.filter(
+                        Q(doctor_id__in=chunk) | Q(patient_id__in=chunk),
+                        appointment_time__gt=first, appointment_time__lt=last,
+                ).exclude(accept_state=Appointment.REJECTED).values_list(
+                        'id', 'doctor_id', 'patient_id', 'appointment_time'):
+                    if appt_id not in seen:
+                        seen.add(appt_id)
+                        index.add(doctor_id, time)
+                        index.add(patient_id, time)
+
+            # and the occurrences of their series, only as far as the batch goes
+            window = DateWindow(first, last)
+            seen = set()
+            for chunk in _chunks(party_ids):
+                for series in series_in(window, RecurringAppointment.objects.filter(
+                        Q(doctor_id__in=chunk) | Q(patient_id__in=chunk),
+                ).exclude(accept_state=Appointment.REJECTED)):
+                    if series.pk not in seen:
+                        seen.add(series.pk)
+                        for time in series.occurrences(*window):
+                            index.add(series.doctor_id, time)
+                            index.add(series.patient_id, time)
+
+        for number, values, time, state in parsed:
+            doctor = doctors.get(values['doctor'])
+            patient = patients.get(values['patient'])
+            if doctor is None:
+                rejected.append((number, 'No doctor %s' % values['doctor']))
+            elif patient is None:
+                rejected.append((number, 'No patient %s' % values['patient']))
+            elif index.conflicts(doctor[0], time):
+                rejected.append((number, 'The doctor is not available at this time'))
+            elif index.conflicts(patient[0], time):
+                rejected.append((number, 'The patient has an appointment within half an hour of this time'))
+            else:
+                index.add(doctor[0], time)
+                index.add(patient[0], time)
+                booked.append((Appointment(doctor_id=doctor[0], patient_id=patient[0], appointment_time=time,
+                                           reason=values['reason'], accept_state=state,
+                                           slot=Appointment.slot_for(time)), doctor[1]))
+
+        if not dry_run and booked:
+            # bulk_create doesn't call save(), so the slots were filled in above
+            Appointment.objects.bulk_create([appointment for appointment, _ in booked],
+                                            batch_size=settings.HEALTHNET_IMPORT_BATCH_SIZE)
+
+    if not dry_run and booked:
+        # nor does it send post_save, so the caches are invalidated here, once
+        scopes = set()
+        for appointment, doctor_hospital in booked:
+            scopes.update(appointment_scopes(appointment.patient_id, appointment.doctor_id, doctor_hospital))
+        bump(*scopes)
+
+    rejected.sort()
+    return ImportReport([appointment for appointment, _ in booked], rejected)
@@ -9,3 +9,7 @@ from django.apps import AppConfig
 
 class HealthnetConfig(AppConfig):
     name = 'HealthNet'
+
+    def ready(self):
+        # connect the signal receivers
+        from . import signals
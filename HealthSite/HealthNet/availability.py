@@ -0,0 +1,196 @@
+"""
+    File containing the free slot finder. It lists the open half hour slots
+    of doctors over a range of days, so a time can be picked before booking
+    rather than found by trial and error. The open slots of each doctor-day
+    are cached; a doctor's cached days are keyed on the version of their
+    calendar, so any change to one of their appointments invalidates them.
+"""
+
+import bisect
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Appointment, Doctor, RecurringAppointment
+from .cache_versions import get_versions, calendar_scope
+from .recurrence import series_in
+from .scheduling import CONFLICT_WINDOW
+from .windows import DateWindow
+
+# the length of a slot, and how far apart slots start
+SLOT_LENGTH = datetime.timedelta(minutes=30)
+
+# the format of days in requests and responses
+DAY_FORMAT = '%Y-%m-%d'
+
+
+def parse_days(start=None, end=None):
+    """
+        Works out the days a request asks about. Days are YYYY-MM-DD, and
+        the end is not included. Anything else, or days too close to the
+        first or last date there is, gets the default number of days from
+        today, and ranges are capped in length.
+    :param start: (str) the first day
+    :param end: (str) the day after the last day
+    :return: (tuple) the first day and the day after the last, as dates
+    """
+    today = datetime.date.today()
+    default_end = today + datetime.timedelta(days=settings.HEALTHNET_AVAILABILITY_DEFAULT_DAYS)
+    longest = datetime.timedelta(days=settings.HEALTHNET_AVAILABILITY_MAX_DAYS)
+
+    try:
+        start = datetime.datetime.strptime(start, DAY_FORMAT).date() if start else today
+        end = datetime.datetime.strptime(end, DAY_FORMAT).date() if end else None
+        if end is None or end <= start or end - start > longest:
+            end = start + min(longest, default_end - today)
+    except (ValueError, OverflowError):
+        start, end = today, default_end
+
+    # appointments on the days either side of the range are read too
+    if not datetime.date.min < start < end < datetime.date.max:
+        start, end = today, default_end
+
+    return start, end
+
+
+def day_slots(day):
+    """
+        Returns the start of every slot of a working day
+    :param day: (date) the day
+    :return: (list) the datetimes the slots start at
+    """
+    first_hour, last_hour = settings.HEALTHNET_WORKING_HOURS
+    time = datetime.datetime.combine(day, datetime.time(first_hour))
+    end = datetime.datetime.combine(day, datetime.time(last_hour))
+
+    slots = []
+    while time < end:
+        slots.append(time)
+        time += SLOT_LENGTH
+    return slots
+
+
+def sweep(slots, times):
+    """
+        Finds the slots no appointment is in the way of. Both lists are
+        sorted, so a single pass over them does: the appointments that end
+        too early for a slot can't be in the way of any later slot either.
+        A slot is taken when an appointment starts less than half an hour
+        either side of it, the same rule bookings are checked with.
+    :param slots: (list) the sorted datetimes the slots start at
+    :param times: (list) the sorted times of the appointments
+    :return: (list) the free slots
+    """
+    free = []
+    i = 0
+    for slot in slots:
+        while i < len(times) and times[i] <= slot - CONFLICT_WINDOW:
+            i += 1
+        if i == len(times) or times[i] >= slot + CONFLICT_WINDOW:
+            free.append(slot)
+    return free
+
+
+def _day_key(doctor_id, day, version):
+    return 'healthnet:availability:%s:%s:%s' % (doctor_id, day.isoformat(), version)
+
+
+def free_slots(doctor_ids, start, end):
+    """
+        Returns the open slots of each doctor on each day of a range. Cached
+        doctor-days are read in one round trip, and the rest from a single
+        query sorted by appointment time, plus one for the doctors' series.
+    :param doctor_ids: (list) ids of the doctors
+    :param start: (date) the first day
+    :param end: (date) the day after the last day
+    :return: (dict) for each doctor id, a dict of the list of free slot
+                times of each day
+    """
+    days = [start + datetime.timedelta(days=i) for i in range((end - start).days)]
+    versions = dict(zip(doctor_ids, get_versions(*[calendar_scope('doctor', doctor_id)
+                                                   for doctor_id in doctor_ids])))
+
+    keys = {(doctor_id, day): _day_key(doctor_id, day, versions[doctor_id])
+            for doctor_id in doctor_ids for day in days}
+    cached = cache.get_many(list(keys.values()))
+
+    result = {doctor_id: {} for doctor_id in doctor_ids}
+    missing = []
+    for (doctor_id, day), key in keys.items():
+        if key in cached:
+            result[doctor_id][day] = cached[key]
+        else:
+            missing.append((doctor_id, day))
+
+    if missing:
+        first = min(day for _, day in missing)
+        last = max(day for _, day in missing)
+
+        # appointments just before or after a day can take its first or last slot
+        window = DateWindow(datetime.datetime.combine(first, datetime.time.min) - CONFLICT_WINDOW,
+                            datetime.datetime.combine(last, datetime.time.min)
+                            + datetime.timedelta(days=1) + CONFLICT_WINDOW)
+        missing_doctors = {doctor_id for doctor_id, _ in missing}
+        times = {doctor_id: [] for doctor_id in doctor_ids}
+        for doctor_id, time in Appointment.objects.filter(
+                doctor_id__in=missing_doctors, **window.lookup()
+        ).exclude(accept_state=Appointment.REJECTED).order_by('appointment_time').values_list('doctor_id', 'appointment_time'):
+            times[doctor_id].append(time)
+
+        # and the occurrences of their series, worked out for the window only
+        for series in series_in(window, RecurringAppointment.objects.filter(
+                doctor_id__in=missing_doctors).exclude(accept_state=Appointment.REJECTED)):
+            times[series.doctor_id].extend(series.occurrences(*window))
+            times[series.doctor_id].sort()
+
+        computed = {}
+        for doctor_id, day in missing:
+            slots = day_slots(day)
+            doctor_times = times[doctor_id]
+            if slots:
+                # only the appointments around the day need sweeping
+                doctor_times = doctor_times[bisect.bisect_right(doctor_times, slots[0] - CONFLICT_WINDOW):
+                                            bisect.bisect_left(doctor_times, slots[-1] + CONFLICT_WINDOW)]
+            free = [slot.time() for slot in sweep(slots, doctor_times)]
+            result[doctor_id][day] = free
+            computed[keys[doctor_id, day]] = free
+        cache.set_many(computed, settings.HEALTHNET_AVAILABILITY_CACHE_TIMEOUT)
+
+    return result
+
+
+def availability(doctors, start, end, now=None):
+    """
+        Lists the open slots of doctors over a range of days, leaving out
+        the slots that have already started
+    :param doctors: (iterable) the doctors
+    :param start: (date) the first day
+    :param end: (date) the day after the last day
+    :param now: (datetime) the current time, defaults to now
+    :return: (list) a dict for each doctor, ready to be sent as JSON
+    """
+    now = now or datetime.datetime.now()
+    doctors = list(doctors)
+    slots = free_slots([doctor.pk for doctor in doctors], start, end)
+
+    return [{
+        'id': doctor.pk,
+        'name': '%s %s' % (doctor.first_name, doctor.last_name),
+        'days': {day.strftime(DAY_FORMAT): [time.strftime('%H:%M') for time in times
+                                            if datetime.datetime.combine(day, time) > now]
+                 for day, times in sorted(slots[doctor.pk].items())},
+    } for doctor in doctors]
+
+
+def hospital_doctors(hospital_id, doctor_id=None):
+    """
+        Returns the doctors of a hospital, or just one of them
+    :param hospital_id: (int) id of the hospital
+    :param doctor_id: (int) id of a single doctor, or None for all of them
+    :return: (QuerySet) the doctors
+    """
+    doctors = Doctor.objects.filter(hospital_id=hospital_id).only('first_name', 'last_name')
+    if doctor_id is not None:
+        doctors = doctors.filter(pk=doctor_id)
+    return doctors.order_by('last_name', 'first_name', 'pk')
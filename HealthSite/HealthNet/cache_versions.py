@@ -0,0 +1,99 @@
+"""
+    File containing the version tokens used to invalidate HealthNet's caches.
+    Cached fragments put the versions of the scopes they depend on into their
+    keys, so bumping a scope makes every fragment built from it unreachable
+    without having to know or delete their keys.
+"""
+
+import uuid
+
+from django.core.cache import cache
+
+# scope of the system log, which every admin dashboard depends on
+LOG_SCOPE = 'log'
+
+
+def user_scope(user_id):
+    """
+        Returns the scope of everything shown to a single user
+    :param user_id: (int) id of the user
+    :return: (str) the scope
+    """
+    return 'user:%s' % user_id
+
+
+def hospital_scope(hospital_id):
+    """
+        Returns the scope of everything shown to the staff of a hospital
+    :param hospital_id: (int) id of the hospital
+    :return: (str) the scope
+    """
+    return 'hospital:%s' % hospital_id
+
+
+def calendar_scope(owner, owner_id):
+    """
+        Returns the scope of the month calendars of a patient, a doctor or
+        a hospital (which nurses see)
+    :param owner: (str) 'patient', 'doctor' or 'hospital'
+    :param owner_id: (int) id of the patient, doctor or hospital
+    :return: (str) the scope
+    """
+    return 'calendar:%s:%s' % (owner, owner_id)
+
+
+def appointment_scopes(patient_id, doctor_id, hospital_id):
+    """
+        Returns the scopes an appointment is shown in: the dashboards and
+        calendars of its patient and doctor, and of the doctor's hospital
+    :param patient_id: (int) id of the patient
+    :param doctor_id: (int) id of the doctor
+    :param hospital_id: (int) id of the doctor's hospital, or None
+    :return: (list) the scopes, with None in place of the hospital's if
+                there is no hospital
+    """
+    return [user_scope(patient_id), user_scope(doctor_id),
+            calendar_scope('patient', patient_id), calendar_scope('doctor', doctor_id),
+            hospital_scope(hospital_id) if hospital_id is not None else None,
+            calendar_scope('hospital', hospital_id) if hospital_id is not None else None]
+
+
+def _version_key(scope):
+    return 'healthnet:version:%s' % scope
+
+
+def _new_token():
+    return uuid.uuid4().hex
+
+
+def get_versions(*scopes):
+    """
+        Returns the current version of each scope in one cache round trip.
+        Scopes that have no version yet, or whose version was evicted, are
+        given a new one; a new token never matches an old key, so an evicted
+        version can never bring back a stale fragment.
+    :param scopes: (str) the scopes
+    :return: (list) the versions, in the order of the scopes
+    """
+    keys = [_version_key(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+
+    for key in keys:
+        if key not in versions:
+            token = _new_token()
+            # add() leaves a version set by a concurrent request alone
+            if not cache.add(key, token, None):
+                token = cache.get(key, token)
+            versions[key] = token
+
+    return [versions[key] for key in keys]
+
+
+def bump(*scopes):
+    """
+        Gives each scope a new version, invalidating everything cached with
+        the old one. Scopes that are None are skipped.
+    :param scopes: (str) the scopes
+    :return: none
+    """
+    cache.set_many({_version_key(scope): _new_token() for scope in scopes if scope is not None}, None)
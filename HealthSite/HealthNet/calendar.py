@@ -2,136 +2,281 @@
     File containing the classes needed for a calendar implementation
     @author Theodora Bendlin
 """
+import calendar as stdlib_calendar
 import datetime
 from datetime import date
+from functools import lru_cache
+from collections import namedtuple
+from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db.models import Count, Min, Q, Case, When, Func, IntegerField, DateTimeField
+from django.utils import timezone
 from .models import Appointment
+from .cache_versions import get_versions, calendar_scope
+from .recurrence import expand, series_in, series_of
+
+# weeks start on sunday everywhere in HealthNet
+_sunday_calendar = stdlib_calendar.Calendar(firstweekday=stdlib_calendar.SUNDAY)
+
+# how many month grids are kept in memory; 240 covers twenty years
+MONTH_GRID_CACHE_SIZE = 240
+
+
+@lru_cache(maxsize=MONTH_GRID_CACHE_SIZE)
+def month_grid(month, year):
+    """
+        Returns the weeks of a month as rows of seven days, sunday first.
+        Days outside the month are 0. Grids are computed once and then
+        served from a bounded LRU cache, so they are immutable tuples.
+    :param month: (int) the month, 1 - 12
+    :param year: (int) the year
+    :return: (tuple) a tuple of weeks, each a tuple of seven day numbers
+    """
+    return tuple(tuple(week) for week in _sunday_calendar.monthdayscalendar(year, month))
+
+
+@lru_cache(maxsize=MONTH_GRID_CACHE_SIZE)
+def month_days(month, year):
+    """
+        Returns the days of a month aligned by day of the week: one 0 for
+        each day of the first week before the 1st, then the days 1 - n
+    :param month: (int) the month, 1 - 12
+    :param year: (int) the year
+    :return: (tuple) the day numbers
+    """
+    first_weekday, num_of_days = stdlib_calendar.monthrange(year, month)
+    # monthrange counts weekdays from monday
+    return (0,) * ((first_weekday + 1) % 7) + tuple(range(1, num_of_days + 1))
+
+
+def year_grid(year):
+    """
+        Returns the grids of every month of a year (see month_grid)
+    :param year: (int) the year
+    :return: (tuple) the twelve month grids, January first
+    """
+    return tuple(month_grid(month, year) for month in range(1, 13))
+
+
+class DayOf(Func):
+    """
+        The day of the month of a datetime column, worked out by the database
+    """
+
+    def __init__(self, expression):
+        super(DayOf, self).__init__(expression, output_field=IntegerField())
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        tzname = timezone.get_current_timezone_name() if settings.USE_TZ else None
+        sql, extract_params = connection.ops.datetime_extract_sql('day', sql, tzname)
+        return sql, params + extract_params
+
+
+# how many appointments in each state fall on a day, and the time of the
+# first one in each state (None if there are none)
+DaySummary = namedtuple('DaySummary', ['pending', 'accepted', 'rejected',
+                                       'first_pending', 'first_accepted', 'first_rejected'])
+
+
+def first_in_state(state):
+    """
+        The earliest appointment time in a state, as an aggregate
+    :param state: (Q) the states to look at
+    :return: (Min) the aggregate
+    """
+    return Min(Case(When(state, then='appointment_time'), output_field=DateTimeField()))
+
+
+def summarize_days(appointments):
+    """
+        Counts the appointments on each day by state. The counting and
+        grouping is all done by the database, so no appointments are loaded.
+    :param appointments: (QuerySet) the appointments of a single month
+    :return: (dict) a DaySummary for each day that has appointments
+    """
+    # anything that is neither pending nor rejected counts as accepted
+    accepted = ~Q(accept_state__in=[Appointment.PENDING, Appointment.REJECTED])
+    rows = appointments.order_by().annotate(day=DayOf('appointment_time')).values('day').annotate(
+        total=Count('id'),
+        pending=Count(Case(When(accept_state=Appointment.PENDING, then=1))),
+        rejected=Count(Case(When(accept_state=Appointment.REJECTED, then=1))),
+        first_pending=first_in_state(Q(accept_state=Appointment.PENDING)),
+        first_accepted=first_in_state(accepted),
+        first_rejected=first_in_state(Q(accept_state=Appointment.REJECTED)),
+    ).values_list('day', 'total', 'pending', 'rejected', 'first_pending', 'first_accepted', 'first_rejected')
+
+    return {day: DaySummary(pending, total - pending - rejected, rejected, first_pending, first_accepted,
+                            first_rejected)
+            for day, total, pending, rejected, first_pending, first_accepted, first_rejected in rows}
+
+
+def count_occurrences(summary, occurrences):
+    """
+        Adds occurrences of recurring series to a summary of days, each
+        counted by the state of its series
+    :param summary: (dict) a DaySummary for each day, from summarize_days
+    :param occurrences: (iterable) the occurrences of a single month
+    :return: (dict) the same summary
+    """
+    for occurrence in occurrences:
+        time = occurrence.appointment_time
+        pending, accepted, rejected, first_pending, first_accepted, first_rejected = summary.get(
+            time.day, (0, 0, 0, None, None, None))
+        if occurrence.accept_state == Appointment.PENDING:
+            pending += 1
+            first_pending = earliest(first_pending, time)
+        elif occurrence.accept_state == Appointment.REJECTED:
+            rejected += 1
+            first_rejected = earliest(first_rejected, time)
+        else:
+            accepted += 1
+            first_accepted = earliest(first_accepted, time)
+        summary[time.day] = DaySummary(pending, accepted, rejected, first_pending, first_accepted, first_rejected)
+    return summary
+
+
+def earliest(first, time):
+    """
+        Returns the earlier of two times, either of which may be None
+    :param first: (datetime) the earliest time so far, or None
+    :param time: (datetime) another time
+    :return: (datetime) the earlier one
+    """
+    return time if first is None or time < first else first
+
+
+# the status of a day is a set of flags, one for each state of appointment
+# shown on it, listed in the order their CSS classes are written
+PENDING_DAY = 1
+FILLED_DAY = 2
+REJECTED_DAY = 4
+DAY_STATUS_CLASSES = ((PENDING_DAY, 'pending'), (FILLED_DAY, 'filled'), (REJECTED_DAY, 'rejected'))
+
+
+def day_status_class(status, is_today):
+    """
+        Returns the CSS classes of a day on the month table. Calendars
+        rendered in the browser use the same rules, so both give the same
+        table.
+    :param status: (int) the status flags of the day, 0 if it is empty
+    :param is_today: (bool) whether the day is today
+    :return: (str) the CSS classes
+    """
+    cssclass = 'today' if is_today else ''
+    if not status:
+        return cssclass + ' unfilled'
+    for flag, name in DAY_STATUS_CLASSES:
+        if status & flag:
+            cssclass += ' ' + name
+    return cssclass
+
+
+def calendar_owner(role):
+    """
+        Returns whose appointments the role sees on its calendar: patients
+        and doctors see their own, nurses see their whole hospital's
+    :param role: (Role) the role of the user viewing the calendar
+    :return: (tuple) 'patient', 'doctor' or 'hospital', and the owner's id
+    """
+    if role.is_patient:
+        return 'patient', role.user.pk
+    if role.is_doctor:
+        return 'doctor', role.user.pk
+    return 'hospital', role.hospital_id
+
+
+def owner_appointments(role):
+    """
+        Returns the appointments the role sees on its calendar. Doctors do
+        not see the appointments they rejected.
+    :param role: (Role) the role of the user viewing the calendar
+    :return: (QuerySet) the appointments
+    """
+    owner, owner_id = calendar_owner(role)
+    if owner == 'patient':
+        return Appointment.objects.filter(patient_id=owner_id)
+    if owner == 'doctor':
+        return Appointment.objects.filter(doctor_id=owner_id).exclude(accept_state=Appointment.REJECTED)
+    return Appointment.objects.filter(doctor__hospital_id=owner_id)
+
+
+def owner_occurrences(role, window):
+    """
+        Works out the occurrences of the recurring series the role sees on
+        its calendar, only for the window being shown
+    :param role: (Role) the role of the user viewing the calendar
+    :param window: (DateWindow) the window being shown
+    :return: (iterator) the occurrences, in time order
+    """
+    series = series_of(*calendar_owner(role)).select_related('doctor', 'patient')
+    return expand(series_in(window, series), window)
+
+
+def month_cache_key(role, month, year):
+    """
+        Returns the key of a rendered month calendar. It holds the version of
+        the owner's appointments, so it changes whenever one of them is
+        saved or deleted, and today's date, since today is highlighted.
+    :param role: (Role) the role of the user viewing the calendar
+    :param month: (int) the month
+    :param year: (int) the year
+    :return: (str) the cache key
+    """
+    scope = calendar_scope(*calendar_owner(role))
+    return 'healthnet:calendar:%s:%s:%d:%d:%s:%s' % (role.name, scope, month, year, get_versions(scope)[0],
+                                                      date.today().isoformat())
 
-class Month(object):
-
-    ### CONSTANTS ###
-
-    # The months shifted so that March = 1, February = 12
-    # this array is used in the calculation for finding
-    # the first day of a month
-    shifted_months = [11, 12, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
-
-    # the number of days in a month
-    days_in_month = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
 
-    ### FIELDS ###
-    month = datetime.date.today().month # default for month is this month
-    year = datetime.date.today().year   # default for year is this year
-    days = []                               # a list representing all of the days
-                                            # index 0 represents a sunday
+class Month(object):
 
     def __init__(self, month, year):
         """
             Initialization for a month. If a month or year should use the
-            defaults, then a value of -1 is passed in. Otherwise, the passed
-            in value is used. Months are enumerated from 1 - 12.
-
-            Assumptions:
-                The given year and month values are valid
+            defaults, then a value of -1 is passed in, and the current month
+            or year is used. Invalid values fall back to the defaults as
+            well. Months are enumerated from 1 - 12.
 
         :param month: (int) the current month
         :param year:  (int) the current year
         """
 
-        if(month != -1 ):       # we don't want to use the default
-            self.month = month
+        # the defaults are worked out per month, not once when the module
+        # is loaded, so they never go stale
+        today = datetime.date.today()
 
-        if(year != -1):         # we don't want to use the default
-            self.year = year
+        self.month = month if 1 <= month <= 12 else today.month
+        self.year = year if datetime.MINYEAR <= year <= datetime.MAXYEAR else today.year
 
-        # fill in the days so that they are aligned by day of the
-        # week
+        # the days aligned by day of the week
+        self.weeks = month_grid(self.month, self.year)
         self.days = self.fill_days()
 
-
     def calculate_starting_day(self):
         """
-            Determines the starting day of the given month using the
-            following formula:
-
-            w = ( d + floor(2.6m - 0.2) + Y + floor(y/4) + floor(c/4)
-                    -2c ) % 7
-            where:
-                Y is the year minus 1 for January/February, and the year
-                for any other month (0 - 100)
-                y is the last 2 digits of Y
-                c is the first 2 digits of Y
-                d is the day of the month
-
+            Determines the starting day of the month
         :return: (int) the starting day for this month ( 0 is sunday, 6 is
                                                             saturday )
         """
-
-        m = self.shifted_months[self.month - 1]  # the month in question shifted for the formula
-        c = int(str(self.year)[:2])              # the century in question
-
-        Y = self.year % 100                      # getting the year. Numbered 1 - 100
-        if(Y == 0):
-            Y = 100
-
-        # shifting the year if it is January or February
-        if( (m == 11) or (m == 12)):
-            Y = Y - 1
-
-        term1 = int( (2.6 * m) - 0.2)
-        term2 = int(Y/4)
-        term3 = int(c/4)
-
-        return (1 + term1 + Y + term2 + term3 - (2 * c)) % 7
-
+        return self.days.index(1)
 
     def is_leap_year(self):
         """
             Determines if a month's year is a leap year
         :return True if the month is a leap year, False otherwise
         """
-
-        if((self.year % 4) == 0):
-            if((self.year % 100) == 0):
-                if((self.year % 400) == 0):
-                    return True
-                else:
-                    return False
-            else:
-                return True
-        else:
-            return False
+        return stdlib_calendar.isleap(self.year)
 
     def fill_days(self):
         """
-            Fills in the days array for the given month such that
-            the numeration for the days begins on the starting day
-            for that month
+            Lists the days of the month such that the numeration for the
+            days begins on the starting day for that month. Days before the
+            first are 0.
 
             Days are numbered 0 - 6
 
         """
-
-        starting_day = self.calculate_starting_day()
-        currDay = 0
-        days = []
-
-        # Append 0s while we are not on the starting day
-        while(currDay < starting_day):
-            days.append(0)
-            currDay = currDay + 1
-
-        num_of_days = self.days_in_month[self.month - 1]
-        if(self.is_leap_year() and (self.month == 2)):
-            num_of_days = num_of_days + 1
-
-        # now we are on the correct starting day
-        # so it is time to fill in all of
-        # the days in the month
-        for day in range(num_of_days):
-            days.append(day + 1)
-
-        return days
+        return month_days(self.month, self.year)
 
     def get_days(self):
         """ Getter function for the days display """
@@ -149,15 +294,41 @@ class ApptCalendar(object):
     weekdays = ["Sunday", "Monday", "Tuesday", "Wednesday",
              "Thursday", "Friday", "Saturday"]
 
-    def __init__(self, month, year, appts):
+    # the fragments the month table is put together from
+    week_header = '<tr class=\"weekdays\">%s</tr>' % ''.join('<th>%s</th>' % day for day in weekdays)
+    empty_cell = '<td class="noday">&nbsp;</td>'
+
+    # a day number that can't otherwise show up in a day view url; the url
+    # is reversed once with it and the real days are put in its place
+    url_sentinel = 987654321
+
+    def __init__(self, month, year, appts, occurrences=()):
         """
-            Init function for a calendar that will group
+            Init function for a calendar that will summarize
             the appointments by day
-        :param appointments:
+        :param appts: (QuerySet) the appointments of the month
+        :param occurrences: (iterable) the occurrences of recurring series
+                            in the month
         """
         self.month = month
         self.year = year
-        self.appointments = self.group_days(appts)
+        self.summary = count_occurrences(self.summarize(appts), self.shown_occurrences(occurrences))
+
+    def shown_occurrences(self, occurrences):
+        """
+            Picks the occurrences of recurring series shown on the calendar
+        :param occurrences: (iterable) the occurrences of the month
+        :return: (iterable) the occurrences shown
+        """
+        return occurrences
+
+    def summarize(self, appointments):
+        """
+            Summarizes the appointments shown on the calendar by day
+        :param appointments: (QuerySet) the appointments of the month
+        :return: (dict) a DaySummary for each day that has appointments
+        """
+        return summarize_days(appointments)
 
     def get_absolute_url(self, day):
         """
@@ -180,6 +351,35 @@ class ApptCalendar(object):
             return '<td class="%s"><a href="%s">%s</a></td>' % (cssclass, self.get_absolute_url(day), day)
         return'<td class="%s">&nbsp;</td>' % cssclass
 
+    def day_status(self, day):
+        """
+            Works out the status flags of a day from its appointment summary
+        :param day: (int) the day, 1 - 31
+        :return: (int) the flags, 0 if the day has no appointments
+        """
+        summary = self.summary.get(day)
+        if summary is None:
+            return 0
+        # as when the day's appointments were gone through in time order, up
+        # to the first rejected one, only states seen before it are shown
+        cutoff = summary.first_rejected
+
+        def shown(first):
+            return first is not None and (cutoff is None or first < cutoff)
+
+        return ((PENDING_DAY if shown(summary.first_pending) else 0)
+                | (FILLED_DAY if shown(summary.first_accepted) else 0)
+                | (REJECTED_DAY if summary.rejected else 0))
+
+    def day_class(self, day, is_today):
+        """
+            Picks the CSS classes of a day from its appointment summary
+        :param day: (int) the day, 1 - 31
+        :param is_today: (bool) whether the day is today
+        :return: (str) the CSS classes
+        """
+        return day_status_class(self.day_status(day), is_today)
+
     def format_day(self, day):
         """
             Formats a day. If the day is 0, then it is represented by
@@ -187,22 +387,7 @@ class ApptCalendar(object):
         :return: (str) the HTML representation of a day
         """
         if day != 0:
-            cssclass = ''
-            if date.today() == date(self.year, self.month, day):
-                cssclass += 'today'
-            if day in self.appointments:
-                for appt in self.appointments[day]:
-                    if appt.accept_state == Appointment.REJECTED:
-                        cssclass+= ' rejected'
-                        break
-                    elif appt.accept_state == Appointment.PENDING:
-                        cssclass += ' pending'
-                    else:
-                        cssclass += ' filled'
-                return self.day_cell(cssclass, day)
-            else:
-                cssclass += ' unfilled'
-                return self.day_cell(cssclass, day)
+            return self.day_cell(self.day_class(day, date.today() == date(self.year, self.month, day)), day)
         return self.day_cell('noday', 0)
 
     def format_week(self, week):
@@ -219,112 +404,110 @@ class ApptCalendar(object):
             Formats the week header
         :return: (str) the string representation
         """
-        s = '<tr class=\"weekdays\">'
-        for i in range(7):
-            s += '<th>' + self.weekdays[i] + '</th>'
-        return s + '</tr>'
+        return self.week_header
+
+    def day_url_format(self):
+        """
+            Returns the day view url of this calendar's month as a format
+            string, reversing the url just once
+        :return: (str) a format string taking the day
+        """
+        url = self.get_absolute_url(self.url_sentinel).replace('%', '%%')
+        return url.replace(str(self.url_sentinel), '%d')
+
+    def compile_day_cell(self):
+        """
+            Builds the format string of a day cell for this calendar's month
+        :return: (str) a format string taking the CSS classes and the day
+                    twice
+        """
+        return '<td class="%%s"><a href="%s">%%d</a></td>' % self.day_url_format()
+
+    def month_data(self):
+        """
+            Describes the month for calendars rendered in the browser: the
+            grid of days, the status flags of the days that have
+            appointments and what is needed to link to them. It is much
+            smaller than the month table and holds nothing the browser
+            can't turn back into the same table.
+        :return: (dict) the month, ready to be sent as JSON
+        """
+        today = date.today()
+        prev_month, prev_year = (self.month - 1, self.year) if self.month > 1 else (12, self.year - 1)
+        next_month, next_year = (self.month + 1, self.year) if self.month < 12 else (1, self.year + 1)
+
+        return {
+            'month': self.month,
+            'year': self.year,
+            'name': self.months[self.month],
+            'weeks': month_grid(self.month, self.year),
+            'status': {day: self.day_status(day) for day in self.summary},
+            'today': today.day if (today.year, today.month) == (self.year, self.month) else 0,
+            'day_url': self.day_url_format(),
+            'prev': {'month': prev_month, 'year': prev_year, 'name': self.months[prev_month]},
+            'next': {'month': next_month, 'year': next_year, 'name': self.months[next_month]},
+        }
 
     def format_month(self, themonth, theyear):
         """
-            Return a month as an HTML table
+            Return a month as an HTML table. The day view url is resolved
+            and today is worked out once per month rather than once per day,
+            giving the same HTML as formatting every day with format_day.
         :param month: the month to represent
         :param year:  the year
         :return: (str) the HTML markup to represent the month
         """
         month = Month(themonth, theyear)
 
-        html = ['<table class=\"month\">']
-        html.append('\n')
-        html.append(self.format_week_header())
-
-        iterator = 0
-        week = []
-        for day in month.days:
-            if(iterator < 7):                                   # the full week isn't full
-                week.append(day)
-                iterator += 1
-
-                if ((iterator == 7)):  # if one week has been added to the array,
-                    # then it is time to add it to the html
-                    html.append(self.format_week(week))
-                    html.append('\n')
-                    week = []
-                    iterator = 0
-
-        if(iterator != 0):                          # then there are still days to add
-            while(iterator != 7):
-                week.append(0)
-                iterator += 1
-            html.append(self.format_week(week))
-            html.append('\n')
+        today = date.today()
+        today_day = today.day if (today.year, today.month) == (self.year, self.month) else 0
+        day_cell = self.compile_day_cell()
+        empty_cell = self.empty_cell
+        day_class = self.day_class
 
+        html = ['<table class=\"month\">', '\n', self.week_header]
+        for week in month.weeks:
+            html.append('<tr class=\"days\">')
+            html.extend(day_cell % (day_class(day, day == today_day), day, day) if day else empty_cell
+                        for day in week)
+            html.append('</tr>\n')
 
         html.append('</table>')
         html.append('\n')
         return ''.join(html)
 
-    def group_days(self, appointments):
-        """
-            Function that returns a dictionary of appointments grouped
-            by day
-            :param appointments: List of appointments held in the calendar
-            :return: a dictionary of days with appointments as the values
-        """
-        appt_by_day = {}
-        appointments = list(appointments)
-
-        for appt in appointments:
-            day = appt.appointment_time.day
-            if not appt_by_day.__contains__(day):
-                appt_by_day[day] = [appt]
-            else :
-                appt_by_day[day].append(appt)
-
-        return appt_by_day
 
 class DoctorCalendar(ApptCalendar):
 
-    def __init__(self, month, year, appointments):
-        ApptCalendar.__init__(self, month, year, appointments)
+    def __init__(self, month, year, appointments, occurrences=()):
+        ApptCalendar.__init__(self, month, year, appointments, occurrences)
 
-    def format_day(self, day):
+    def day_status(self, day):
         """
-            Formats a day. If the day is 0, then it is represented by
-            an empty space. Otherwise, it's number is put into <td> tags
-        :return: (str) the HTML representation of a day
+            Works out the status flags of a day from its appointment summary.
+            Days with appointments are filled, and pending as well if any
+            of them are pending.
+        :param day: (int) the day, 1 - 31
+        :return: (int) the flags, 0 if the day has no appointments
         """
-        if day != 0:
-            cssclass = ''
-            if date.today() == date(self.year, self.month, day):
-                cssclass += 'today'
-            if day in self.appointments:
-                for appt in self.appointments[day]:
-                    if appt.accept_state == Appointment.PENDING:
-                        cssclass+= ' pending'
-                        break
-                cssclass += ' filled'
-                return self.day_cell(cssclass, day)
-            else:
-                cssclass += ' unfilled'
-                return self.day_cell(cssclass, day)
-        return self.day_cell('noday', 0)
+        if day in self.summary:
+            return FILLED_DAY | (PENDING_DAY if self.summary[day].pending else 0)
+        return 0
 
-    def group_days(self, appointments):
+    def summarize(self, appointments):
         """
-            Function that returns a dictionary of appointments grouped
-            by day
-            :param appointments: List of appointments held in the calendar
-            :return: a dictionary of days with appointments as the values
+            Summarizes the appointments shown on the calendar by day.
+            Doctors do not see the appointments they rejected.
+        :param appointments: (QuerySet) the appointments of the month
+        :return: (dict) a DaySummary for each day that has appointments
         """
-        appt_by_day = {}
-        appointments = list(appointments)
+        return summarize_days(appointments.exclude(accept_state=Appointment.REJECTED))
 
-        for appt in appointments:
-            if appt.accept_state != Appointment.REJECTED:
-                day = appt.appointment_time.day
-                if not appt_by_day.__contains__(day):
-                    appt_by_day[day] = [appt]
-                else :
-                    appt_by_day[day].append(appt)
-
-        return appt_by_day
\ No newline at end of file
+    def shown_occurrences(self, occurrences):
+        """
+            Picks the occurrences of recurring series shown on the calendar.
+            Doctors do not see the series they rejected.
+        :param occurrences: (iterable) the occurrences of the month
+        :return: (iterable) the occurrences shown
+        """
+        return (occurrence for occurrence in occurrences if occurrence.accept_state != Appointment.REJECTED)
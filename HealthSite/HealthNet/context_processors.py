@@ -0,0 +1,33 @@
+"""
+    File containing the template context processors used by HealthNet
+"""
+
+from django.utils.functional import SimpleLazyObject
+
+from .roles import get_role
+from .messaging import cached_unread_count
+
+
+def healthnet_role(request):
+    """
+        Provides the role of the requesting user to templates, along with the
+        role flags and unread message count used by the navigation bar. Every
+        value is lazy, so a template only pays for the fields that it
+        actually reads. Values passed in by a view take precedence over these.
+    :param request: the current request
+    :return: (dict) the role context
+    """
+    role = getattr(request, 'healthnet_role', None)
+    if role is None:
+        role = SimpleLazyObject(lambda: get_role(request.user))
+
+    return {
+        'role': role,
+        'patient': SimpleLazyObject(lambda: role.is_patient),
+        'doctor': SimpleLazyObject(lambda: role.is_doctor),
+        'nurse': SimpleLazyObject(lambda: role.is_nurse),
+        'admin': SimpleLazyObject(lambda: role.is_admin),
+        'hosp': SimpleLazyObject(lambda: role.hospital if role.is_admin else None),
+        'unread_messages': SimpleLazyObject(
+            lambda: cached_unread_count(request.user.pk) if request.user.is_authenticated() else 0),
+    }
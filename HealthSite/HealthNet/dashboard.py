@@ -0,0 +1,258 @@
+"""
+    File containing the queries behind the panels of the HealthNet dashboard.
+    Each panel is answered by a small, fixed number of queries no matter how
+    much data is in the system, and is loaded by the dashboard on its own
+    (see views.dashboard_panel).
+"""
+
+import datetime
+from collections import OrderedDict
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Appointment, Message, TransferRequest, TransferRequestReply, LogEntry
+from .roles import Role
+from .cache_versions import get_versions, user_scope, hospital_scope, LOG_SCOPE
+from .calendar import calendar_owner
+from .messaging import unread_count
+from .recurrence import expand, series_in, series_of, with_occurrences
+from .windows import DateWindow
+
+# format of the date part of a log cursor
+LOG_CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def upcoming_appointments(role, horizon=None, limit=None):
+    """
+        Returns the upcoming appointments of the given role, with the
+        occurrences of recurring series in among them. Filtering, ordering
+        and limiting are all done by the database, and the doctor and
+        patient are joined in so the template can show them for free. Only
+        the occurrences up to the horizon are worked out, and only as many
+        as are needed to fill the limit.
+    :param role: (Role) the role of the user viewing the dashboard
+    :param horizon: (timedelta) how far ahead to look; defaults to the
+                    HEALTHNET_UPCOMING_APPOINTMENTS_DAYS setting
+    :param limit: (int) the most appointments to return; defaults to the
+                    HEALTHNET_UPCOMING_APPOINTMENTS_LIMIT setting
+    :return: (list) the appointments and occurrences ordered by time
+    """
+    if horizon is None:
+        horizon = datetime.timedelta(days=settings.HEALTHNET_UPCOMING_APPOINTMENTS_DAYS)
+    if limit is None:
+        limit = settings.HEALTHNET_UPCOMING_APPOINTMENTS_LIMIT
+
+    if role.is_patient:
+        appointments = Appointment.objects.filter(patient_id=role.user.pk)
+    elif role.is_doctor:
+        appointments = Appointment.objects.filter(doctor_id=role.user.pk)
+    elif role.is_nurse:
+        appointments = Appointment.objects.filter(doctor__hospital_id=role.hospital_id)
+    else:
+        return []
+
+    now = timezone.now()
+    window = DateWindow(now, now + horizon)
+    appointments = appointments.filter(**window.lookup()).exclude(
+        accept_state=Appointment.REJECTED
+    ).select_related('doctor', 'patient').order_by('appointment_time')[:limit]
+
+    series = series_of(*calendar_owner(role)).exclude(
+        accept_state=Appointment.REJECTED
+    ).select_related('doctor', 'patient')
+    return list(islice(with_occurrences(appointments, expand(series_in(window, series), window)), limit))
+
+
+def unread_messages(user, limit=None):
+    """
+        Returns how many unread messages the user has, from the counters of
+        their conversations, along with previews of the newest ones read on
+        the (receiver, status) index. This is two queries no matter how big
+        the inbox is.
+    :param user: (User) the receiver of the messages
+    :param limit: (int) the most previews to return; defaults to the
+                    HEALTHNET_DASHBOARD_PREVIEW_LIMIT setting
+    :return: (tuple) the unread count and a list of the newest unread messages
+    """
+    if limit is None:
+        limit = settings.HEALTHNET_DASHBOARD_PREVIEW_LIMIT
+
+    count = unread_count(user.pk)
+    if count == 0:
+        return 0, []
+
+    unread = Message.objects.filter(receiver_id=user.pk, status=False)
+    return count, list(unread.select_related('sender').order_by('-created_at', '-id')[:limit])
+
+
+def pending_transfer_requests(user):
+    """
+        Returns the transfer requests waiting on the given admin. The pending
+        state is checked in the same query through the request's reply, and
+        everything description() reads is joined in.
+    :param user: (User) the receiving admin
+    :return: (QuerySet) the pending transfer requests
+    """
+    return TransferRequest.objects.filter(
+        receiving_admin_id=user.pk, Transfer_request__acceptance_reply=TransferRequestReply.PENDING,
+    ).select_related(
+        'patient_to_transfer', 'receiving_hospital', 'new_doctor',
+    ).order_by('patient_to_transfer__last_name')
+
+
+def transfer_replies(user):
+    """
+        Returns the replies to the transfer requests made by the given user,
+        with everything description() reads joined in
+    :param user: (User) the user who made the requests
+    :return: (QuerySet) the replies
+    """
+    return TransferRequestReply.objects.filter(
+        receiver_id=user.pk,
+    ).select_related(
+        'transfer_request__patient_to_transfer', 'transfer_request__receiving_hospital',
+        'transfer_request__new_doctor',
+    ).order_by('transfer_request__patient_to_transfer__last_name')
+
+
+def recent_log_entries(cursor=None, window=None, limit=None):
+    """
+        Returns a page of the system log entries made within the window,
+        newest first. The window is a range query on the indexed date
+        column, and pages are keyed on (date, id) so that loading more never
+        rescans the entries already shown.
+    :param cursor: (str) the cursor returned with the previous page, or None
+                    for the first page
+    :param window: (timedelta) how far back to look; defaults to 24 hours
+    :param limit: (int) the most entries per page; defaults to the
+                    HEALTHNET_LOG_PANEL_LIMIT setting
+    :return: (tuple) the list of entries, and the cursor of the next page or
+                None if there are no more entries
+    """
+    if window is None:
+        window = datetime.timedelta(days=1)
+    if limit is None:
+        limit = settings.HEALTHNET_LOG_PANEL_LIMIT
+
+    now = timezone.now()
+    entries = LogEntry.objects.filter(date__gte=now - window, date__lte=now)
+
+    position = parse_log_cursor(cursor)
+    if position is not None:
+        date, entry_id = position
+        entries = entries.filter(Q(date__lt=date) | Q(date=date, id__lt=entry_id))
+
+    # fetch one extra entry to find out if there is another page
+    entries = list(entries.select_related('requester').order_by('-date', '-id')[:limit + 1])
+    if len(entries) <= limit:
+        return entries, None
+
+    entries = entries[:limit]
+    last = entries[-1]
+    return entries, '%s_%d' % (last.date.strftime(LOG_CURSOR_FORMAT), last.id)
+
+
+def parse_log_cursor(cursor):
+    """
+        Parses a cursor made by recent_log_entries
+    :param cursor: (str) the cursor
+    :return: (tuple) the date and id of the last entry shown, or None if the
+                cursor is missing or malformed
+    """
+    if not cursor:
+        return None
+    try:
+        date, entry_id = cursor.split('_')
+        return datetime.datetime.strptime(date, LOG_CURSOR_FORMAT), int(entry_id)
+    except ValueError:
+        return None
+
+
+
+def appointments_panel(role, request):
+    """
+        Builds the upcoming appointments panel
+    :return: (tuple) the template context and the number of appointments
+    """
+    apps = list(upcoming_appointments(role))
+    return {'apps': apps}, len(apps)
+
+
+def messages_panel(role, request):
+    """
+        Builds the new messages panel
+    :return: (tuple) the template context and the number of unread messages
+    """
+    unread_count, new_messages = unread_messages(role.user)
+    return {'new_messages': new_messages, 'unread_count': unread_count}, unread_count
+
+
+def transfers_panel(role, request):
+    """
+        Builds the pending transfer requests panel
+    :return: (tuple) the template context and the number of requests
+    """
+    transferReqs = list(pending_transfer_requests(role.user))
+    return {'transferReqs': transferReqs}, len(transferReqs)
+
+
+def transfer_replies_panel(role, request):
+    """
+        Builds the transfer request updates panel
+    :return: (tuple) the template context and the number of replies
+    """
+    transferReplies = list(transfer_replies(role.user))
+    return {'transferReplies': transferReplies}, len(transferReplies)
+
+
+def log_panel(role, request):
+    """
+        Builds the system log panel, starting from the request's log_before
+        cursor if it has one
+    :return: (tuple) the template context and the number of entries
+    """
+    entries, log_cursor = recent_log_entries(request.GET.get('log_before'))
+    return {'entries': entries, 'log_cursor': log_cursor}, len(entries)
+
+
+# the panels of the dashboard in the order they are shown, as
+# name: (roles that see the panel, function that builds it)
+PANELS = OrderedDict([
+    ('log', ((Role.ADMIN,), log_panel)),
+    ('appointments', ((Role.PATIENT, Role.DOCTOR, Role.NURSE), appointments_panel)),
+    ('messages', ((Role.PATIENT, Role.DOCTOR, Role.NURSE, Role.ADMIN), messages_panel)),
+    ('transfers', ((Role.ADMIN,), transfers_panel)),
+    ('transfer_replies', ((Role.DOCTOR, Role.ADMIN), transfer_replies_panel)),
+])
+
+
+def panels_for(role):
+    """
+        Returns the names of the panels shown to the given role
+    :param role: (Role) the role of the user viewing the dashboard
+    :return: (list) the panel names, in the order they are shown
+    """
+    return [name for name, (roles, _) in PANELS.items() if role.name in roles]
+
+
+def panel_cache_key(name, role):
+    """
+        Returns the key of a cached dashboard panel. The key holds the
+        versions of everything the panel is built from, so it changes
+        whenever one of them is saved or deleted. The system log looks the
+        same to every admin, so they all share one copy of it.
+    :param name: (str) the name of the panel
+    :param role: (Role) the role of the user viewing the dashboard
+    :return: (str) the cache key
+    """
+    if name == 'log':
+        return 'healthnet:panel:log:%s' % get_versions(LOG_SCOPE)[0]
+
+    scopes = [user_scope(role.user.pk)]
+    if name == 'appointments' and role.is_nurse:
+        scopes.append(hospital_scope(role.hospital_id))
+
+    return 'healthnet:panel:%s:%s:%s:%s' % (name, role.user.pk, role.name, ':'.join(get_versions(*scopes)))
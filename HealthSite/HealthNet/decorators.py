@@ -0,0 +1,55 @@
+"""
+    File containing the view decorators used to guard views by role
+"""
+
+from functools import wraps
+
+from django.shortcuts import render_to_response
+
+from .roles import Role, get_request_role
+
+
+def require_role(*roles, profile=True):
+    """
+        Decorator that only lets users with one of the given roles through to
+        the view. The role is resolved once per request, and the user's
+        Patient, Doctor, Nurse or HospitalAdmin instance is loaded once and
+        passed to the view as the argument after the request. Views that only
+        need the user's id and hospital can pass profile=False to be given
+        the Role instead, which costs no query. Anyone else is shown the
+        error page.
+
+        Usage:
+            @require_role(Role.DOCTOR, Role.NURSE)
+            def view(request, profile, ...):
+
+            @require_role(Role.DOCTOR, Role.NURSE, profile=False)
+            def view(request, role, ...):
+
+    :param roles: (str) the roles that are allowed to use the view
+    :param profile: (bool) whether to pass the profile instance or the Role
+    :return: the decorator
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            role = get_request_role(request)
+
+            if role.name not in roles:
+                return render_to_response('error.html')
+
+            if not profile:
+                return view(request, role, *args, **kwargs)
+
+            # role.instance is cached, so the view and anything it calls can
+            # read it again from request.healthnet_role for free
+            return view(request, role.instance, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# shortcuts for views that are only open to a single role
+patient_required = require_role(Role.PATIENT)
+doctor_required = require_role(Role.DOCTOR)
+nurse_required = require_role(Role.NURSE)
+admin_required = require_role(Role.ADMIN)
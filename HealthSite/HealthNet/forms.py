@@ -7,12 +7,15 @@ from datetime import datetime, timedelta
 from django.utils import timezone
 
 from django import forms
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.forms import Textarea
 from django.forms import ValidationError
 
 from .models import Doctor, HospitalAdmin
 from . import models
+from . import scheduling
+from . import triage
 from itertools import chain
 
 class PatientForm(forms.ModelForm):
@@ -262,60 +265,31 @@ class LoginForm(forms.Form):
             raise forms.ValidationError("This user is no longer active")
         return super(LoginForm, self).clean()
 
-class CreateAppointmentForm(forms.ModelForm):
+class AppointmentTimeMixin(object):
     """
-        Creation form for an appointment
+        Checks the time of an appointment form against the doctor's and the
+        patient's other appointments. Forms set conflict_messages to the
+        error shown for each kind of conflict.
     """
 
-    class Meta:
-        model = models.Appointment
-        fields = ['appointment_time', 'reason', 'doctor', 'patient']
-        widgets = {
-            'appointment_time': forms.DateTimeInput(attrs={'class': 'datetime-input'}),
-            'reason': forms.Textarea(attrs={'style': 'height: 50px; width: 300px;'})
-        }
-        help_texts = {'appointment_time': 'Format: YYYY-MM-DD   HH:MM:SS (military time)'}
-
-    def save(self, commit=True):
-        """
-            Save function for saving the created instance of an appointment
-        :return the created Appointment object
-        """
-        instance = super(CreateAppointmentForm, self).save(commit=False)
-        if commit:
-            instance.save()
-        return instance
-
-    def is_valid(self):
-        """
-            Validation function for an appointment associated form
-        :return: true if the form is valid, false otherwise
-        """
-
-        # use the super's validation form to check base functionality
-        valid = super(CreateAppointmentForm, self).is_valid()
-
-        if not valid:
-            return valid
-
-        else:
-            return self.check_datetime()
+    # the error for each party, for a clash at the same time and for an
+    # appointment within half an hour
+    conflict_messages = {
+        (scheduling.DOCTOR, True): 'The doctor already has an appointment at this time. Please choose another.',
+        (scheduling.DOCTOR, False): 'The doctor is not available at this time. Please choose another time',
+        (scheduling.PATIENT, True): 'The patient already has an appointment at this time. Please choose another time.',
+        (scheduling.PATIENT, False): 'The patient has an appointment within half an hour of this time. '
+                                     'Please choose another time',
+    }
 
     def check_datetime(self):
         """
             Checks to see if the date and time for the appointment is
             appropriate
-            1. The doctor doesn't have another appointment at the same
-            time
-            2. The doctor doesn't have another appointment within a half
-            hour of this appointment
-            3. The patient doesn't have another appointment at the same
-            time as this appointment
-            4. The patient doesn't have another appointment within a half
-            hour of this appointment
-            5. The appointment is being made in the past
-        :return: true if the appointment has the same doctor and time,
-                false otherwise
+            1. The appointment isn't being made in the past
+            2. Neither the doctor nor the patient has another appointment
+            at the same time, or within half an hour of it
+        :return: true if the time is free, false otherwise
         """
 
         # first, check to make sure that the time isn't in the past
@@ -324,114 +298,128 @@ class CreateAppointmentForm(forms.ModelForm):
             self.add_error('appointment_time', ValidationError(message='Entered time is in the past', code='invalid'))
             return False
 
-        # try to get an appointment with the same datetime and doctor
-        try:
-            appointment = models.Appointment.objects.get(
-                appointment_time=time,
-                doctor=self.cleaned_data['doctor'].id
-            )
-            self.add_error('appointment_time', ValidationError(message='The doctor already has an appointment at this time. Please choose another.', code='invalid'))
-            return False # if it exists, return false
-
-        except models.Appointment.MultipleObjectsReturned:
-            self.add_error('appointment_time', ValidationError(
-                message='The doctor is not available at this time. Please choose another time.', code='invalid'))
-            return False    # sanity check; possible exception raised when
-                            # using get(), and should return false
-
-        # if there is not an appointment with the same date and time,
-        # then check to see if the doctor has another appointment with
-        # another patient at around this date and time
-        except models.Appointment.DoesNotExist:
-
-            try:
-                appointments = models.Appointment.objects.filter(
-                    appointment_time__day=time.day,
-                    doctor=self.cleaned_data['doctor'].id
-                )
-
-                for appt in appointments:
-
-                    # check to see if times are within a half hour of each other
-                    if self.is_within_halfhour(appt):
-                        self.add_error('appointment_time',
-                                       ValidationError(message='The doctor is not available at this time. Please choose another time', code='invalid'))
-                        return False
+        series = self.series()
+        if series is not None:
+            # a repeating appointment is checked over its whole series
+            if series.until is not None and series.until < time.date():
+                self.add_error('repeat_until', ValidationError(message='The series ends before it starts',
+                                                               code='invalid'))
+                return False
+            found = scheduling.find_series_conflict(series)
+            if found is not None:
+                self.add_conflict_error(found[1], occurrence=found[0])
+                return False
+            return True
 
+        conflict = scheduling.find_conflict(time, self.cleaned_data['doctor'].pk, self.cleaned_data['patient'].pk,
+                                            exclude_id=self.instance.pk)
+        if conflict is not None:
+            self.add_conflict_error(conflict)
+            return False
 
-            except models.Appointment.DoesNotExist:
-                pass
+        # if all tests are passed, then return true
+        return True
 
-        # attempt to see if this patient has another appointment at the
-        # same date and time
-        try:
-            appointment = models.Appointment.objects.get(
-                appointment_time=time,
-                patient=self.cleaned_data['patient'].id
+    def series(self):
+        """
+            Builds the recurring series the form asks for, if it repeats.
+            Only forms with a repeat field can ask for one.
+        :return: (RecurringAppointment) the series, not yet saved, or None
+        """
+        if not self.cleaned_data.get('repeat'):
+            return None
+        if getattr(self, '_series', None) is None:
+            self._series = models.RecurringAppointment(
+                start=self.cleaned_data['appointment_time'], frequency=self.cleaned_data['repeat'],
+                interval=self.cleaned_data.get('repeat_every') or 1, until=self.cleaned_data.get('repeat_until'),
+                reason=self.cleaned_data['reason'], doctor=self.cleaned_data['doctor'],
+                patient=self.cleaned_data['patient'],
             )
-            self.add_error('appointment_time', ValidationError(
-                message='The patient already has an appointment at this time. Please choose another time.', code='invalid'))
-            return False # if it exists, return false
+        return self._series
 
-        except models.Appointment.MultipleObjectsReturned:
-            self.add_error('appointment_time', ValidationError(
-                message='The patient already have an appointment at this time. Please choose another time.', code='invalid'))
-            return False    # sanity check; possible exception raised when
-                            # using get(), and should return false
+    def add_conflict_error(self, conflict, occurrence=None):
+        """
+            Shows the error for a conflict on the appointment time
+        :param conflict: (Conflict) the conflict
+        :param occurrence: (datetime) for a series, the time of the
+                            occurrence that conflicts
+        :return: none
+        """
+        message = self.conflict_messages[conflict.party, conflict.exact]
+        if occurrence is not None:
+            message = 'On %s: %s' % (occurrence.strftime('%Y-%m-%d %H:%M'), message)
+        self.add_error('appointment_time', ValidationError(message=message, code='invalid'))
 
-        # if there is not an appointment with the same date and time,
-        # then check to see if the patient has another appointment with
-        # a doctor at around this date and time
-        except models.Appointment.DoesNotExist:
+    def save(self, commit=True):
+        """
+            Saves the appointment through the booking service, which checks
+            the time again as it saves. A repeating appointment is saved as
+            a series instead.
+        :return: the saved Appointment or RecurringAppointment object
+        :raises SlotTaken: if the time was taken since the form was checked
+        """
+        series = self.series()
+        if series is not None:
+            if commit:
+                scheduling.book_series(series)
+            return series
 
-            try:
-                appointments = models.Appointment.objects.filter(
-                    appointment_time__day=time.day,
-                    patient=self.cleaned_data['patient'].id
-                )
+        instance = super(AppointmentTimeMixin, self).save(commit=False)
+        if commit:
+            scheduling.book(instance)
+        return instance
 
+    def book(self):
+        """
+            Saves a valid form, for views. A time taken by someone else since
+            the form was checked is shown as an error on the form.
+        :return: true if the appointment was saved, false otherwise
+        """
+        try:
+            self.save()
+        except scheduling.SlotTaken as taken:
+            self.add_conflict_error(taken.conflict, occurrence=taken.occurrence)
+            return False
+        return True
 
-                for appt in appointments:
 
-                    # check to see if times are within a half hour of each other
-                    if self.is_within_halfhour(appt):
-                        self.add_error('appointment_time',
-                                       ValidationError(message='The patient has an appointment within half an hour of this time. '
-                                                               'Please choose another time', code='invalid'))
-                        return False
+class CreateAppointmentForm(AppointmentTimeMixin, forms.ModelForm):
+    """
+        Creation form for an appointment, which can repeat weekly or monthly
+    """
 
-            except models.Appointment.DoesNotExist:
-                pass
+    repeat = forms.ChoiceField(choices=(('', 'Does not repeat'),) + models.RecurringAppointment.FREQUENCIES,
+                               required=False)
+    repeat_every = forms.IntegerField(min_value=1, max_value=12, initial=1, required=False,
+                                      help_text='Weeks or months between appointments')
+    repeat_until = forms.DateField(required=False, help_text='Format: YYYY-MM-DD, leave empty to keep repeating')
 
-        # if all tests are passed, then return true
-        return True
+    class Meta:
+        model = models.Appointment
+        fields = ['appointment_time', 'reason', 'doctor', 'patient']
+        widgets = {
+            'appointment_time': forms.DateTimeInput(attrs={'class': 'datetime-input'}),
+            'reason': forms.Textarea(attrs={'style': 'height: 50px; width: 300px;'})
+        }
+        help_texts = {'appointment_time': 'Format: YYYY-MM-DD   HH:MM:SS (military time)'}
 
-    def is_within_halfhour(self, appt):
+    def is_valid(self):
         """
-            Helper function that determines if the given appointment is within
-            half an hour of the appointment associated with this form
-        :param appt: the other appointment
-        :return: true if the times are <= 30 minutes, false otherwise
+            Validation function for an appointment associated form
+        :return: true if the form is valid, false otherwise
         """
 
-        time = self.cleaned_data['appointment_time'] # this appointments time
-        otherTime = appt.appointment_time
-
-        hourDiff = time.hour - otherTime.hour
-        if abs(hourDiff) <= 1:    # times aren't conflicting if the hour is off by 2+
-            minuteDiff = time.minute - otherTime.minute
-            if abs(minuteDiff) < 30:                      # need to check the time
-                # if the times are within different hours and the minute is 45, then
-                # they are fine
-                if(abs(hourDiff) == 1) and (time.minute == 15 or otherTime.minute == 15):
-                    return False
-                else:       # otherwise, the times are not fine
-                    return True
+        # use the super's validation form to check base functionality
+        valid = super(CreateAppointmentForm, self).is_valid()
+
+        if not valid:
+            return valid
+
         else:
-            return False
+            return self.check_datetime()
 
 
-class EditAppointmentForm(forms.ModelForm):
+class EditAppointmentForm(AppointmentTimeMixin, forms.ModelForm):
     """
         Edit form for an appointment
     """
@@ -446,6 +434,14 @@ class EditAppointmentForm(forms.ModelForm):
         }
         help_texts = {'appointment_time': 'Format: YYYY-MM-DD   HH:MM:SS (military time)'}
 
+    # patients edit their own appointments
+    conflict_messages = dict(AppointmentTimeMixin.conflict_messages)
+    conflict_messages.update({
+        (scheduling.PATIENT, True): 'You already have an appointment at this time. Please choose another time.',
+        (scheduling.PATIENT, False): 'You have an appointment within half an hour of this time. '
+                                     'Please choose another time',
+    })
+
     def is_valid(self):
         """
             Validation function for an appointment associated form
@@ -461,140 +457,6 @@ class EditAppointmentForm(forms.ModelForm):
         else:
             return self.check_datetime()
 
-    def check_datetime(self):
-        """
-            Checks to see if the date and time for the appointment is
-            appropriate
-            1. The doctor doesn't have another appointment at the same
-            time
-            2. The doctor doesn't have another appointment within a half
-            hour of this appointment
-            3. The patient doesn't have another appointment at the same
-            time as this appointment
-            4. The patient doesn't have another appointment within a half
-            hour of this appointment
-            5. The appointment is being made in the past
-        :return: true if the appointment has the same doctor and time,
-                false otherwise
-        """
-
-        # first, check to make sure that the time isn't in the past
-        time = self.cleaned_data['appointment_time'] # this appointments time
-        if time <= timezone.now():
-            self.add_error('appointment_time', ValidationError(message='Entered time is in the past', code='invalid'))
-            return False
-
-        # try to get an appointment with the same datetime and doctor
-        try:
-            appointment = models.Appointment.objects.get(
-                appointment_time=time,
-                doctor=self.cleaned_data['doctor'].id
-            )
-            if(appointment.id != self.instance.id):
-                self.add_error('appointment_time', ValidationError(message='The doctor already has an appointment at this time. Please choose another.', code='invalid'))
-                return False # if it exists, return false
-
-        except models.Appointment.MultipleObjectsReturned:
-            self.add_error('appointment_time', ValidationError(
-                message='The doctor is not available at this time. Please choose another time.', code='invalid'))
-            return False    # sanity check; possible exception raised when
-                            # using get(), and should return false
-
-        # if there is not an appointment with the same date and time,
-        # then check to see if the doctor has another appointment with
-        # another patient at around this date and time
-        except models.Appointment.DoesNotExist:
-
-            try:
-                appointments = models.Appointment.objects.filter(
-                    appointment_time__day=time.day,
-                    doctor=self.cleaned_data['doctor'].id
-                )
-
-                for appt in appointments:
-
-                    if (appt.id != self.instance.id):
-                        currTime = appt.appointment_time
-
-                        # check to see if times are within a half hour of each other
-                        if self.is_within_halfhour(appt):
-                            self.add_error('appointment_time',
-                                           ValidationError(message='The doctor is not available at this time. Please choose another time', code='invalid'))
-                            return False
-
-
-            except models.Appointment.DoesNotExist:
-                pass
-
-        # attempt to see if this patient has another appointment at the
-        # same date and time
-        try:
-            appointment = models.Appointment.objects.get(
-                appointment_time=time,
-                patient=self.cleaned_data['patient'].id
-            )
-            if (appointment.id != self.instance.id):
-                self.add_error('appointment_time', ValidationError(
-                    message='You already have an appointment at this time. Please choose another time.', code='invalid'))
-                return False # if it exists, return false
-
-        except models.Appointment.MultipleObjectsReturned:
-            self.add_error('appointment_time', ValidationError(
-                message='You already have an appointment at this time. Please choose another time.', code='invalid'))
-            return False    # sanity check; possible exception raised when
-                            # using get(), and should return false
-
-        # if there is not an appointment with the same date and time,
-        # then check to see if the patient has another appointment with
-        # a doctor at around this date and time
-        except models.Appointment.DoesNotExist:
-
-            try:
-                appointments = models.Appointment.objects.filter(
-                    appointment_time__day=time.day,
-                    patient=self.cleaned_data['patient'].id
-                )
-
-
-                for appt in appointments:
-                    if (appt.id != self.instance.id):
-
-                        # check to see if times are within a half hour of each other
-                        if self.is_within_halfhour(appt):
-                            self.add_error('appointment_time',
-                                           ValidationError(message='You have an appointment within half an hour of this time. '
-                                                                   'Please choose another time', code='invalid'))
-                            return False
-
-            except models.Appointment.DoesNotExist:
-                pass
-
-        # if all tests are passed, then return true
-        return True
-
-    def is_within_halfhour(self, appt):
-        """
-            Helper function that determines if the given appointment is within
-            half an hour of the appointment associated with this form
-        :param appt: the other appointment
-        :return: true if the times are <= 30 minutes, false otherwise
-        """
-
-        time = self.cleaned_data['appointment_time'] # this appointments time
-        otherTime = appt.appointment_time
-
-        hourDiff = time.hour - otherTime.hour
-        if abs(hourDiff) <= 1:    # times aren't conflicting if the hour is off by 2+
-            minuteDiff = time.minute - otherTime.minute
-            if abs(minuteDiff) < 30:                      # need to check the time
-                # if the times are within different hours and the minute is 45, then
-                # they are fine
-                if(abs(hourDiff) == 1) and (time.minute == 15 or otherTime.minute == 15):
-                    return False
-                else:       # otherwise, the times are not fine
-                    return True
-        else:
-            return False
 
 class HospitalAdminForm(forms.ModelForm):
     model = models.HospitalAdmin
@@ -644,6 +506,46 @@ class TimeFrameFrom(forms.ModelForm):
         fields = {'startTime', 'endTime'}
 
 
+class AppointmentImportForm(forms.Form):
+    """
+        Form for uploading a batch of appointments to import
+    """
+    batch = forms.FileField(label='Appointments',
+                            help_text='A .csv or .json file with the columns doctor, patient, '
+                                      'appointment_time (YYYY-MM-DD HH:MM) and reason')
+    dry_run = forms.BooleanField(required=False, label='Only check the appointments')
+
+
+class AppointmentIdsField(forms.Field):
+    """
+        Field for the ids of the appointments ticked on a list
+    """
+    widget = forms.MultipleHiddenInput
+
+    def to_python(self, value):
+        ids = []
+        for appt_id in value or []:
+            if not str(appt_id).isdigit():
+                raise ValidationError('Pick the appointments from the list', code='invalid')
+            ids.append(int(appt_id))
+        return ids
+
+
+class TriageForm(forms.Form):
+    """
+        Form for accepting or rejecting a batch of pending appointments
+    """
+    action = forms.ChoiceField(choices=triage.ACTIONS)
+    appointments = AppointmentIdsField(error_messages={'required': 'Pick at least one appointment'})
+
+    def clean_appointments(self):
+        ids = self.cleaned_data['appointments']
+        if len(ids) > settings.HEALTHNET_TRIAGE_MAX_APPOINTMENTS:
+            raise ValidationError('Pick at most %d appointments at a time' % settings.HEALTHNET_TRIAGE_MAX_APPOINTMENTS,
+                                  code='invalid')
+        return ids
+
+
 class Log(forms.ModelForm):
     """
     form for the system log
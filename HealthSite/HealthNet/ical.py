@@ -0,0 +1,206 @@
+"""
+    File containing the iCalendar (.ics) feed of a user's appointments, which
+    external calendar apps subscribe to instead of opening the calendar pages.
+    The feed is written out one event at a time while the appointments are
+    read, so it never holds a whole schedule in memory.
+"""
+
+import datetime
+import hashlib
+import heapq
+
+from django.conf import settings
+
+from .models import Appointment, CalendarFeed
+from .calendar import calendar_owner, owner_appointments, owner_occurrences
+from .cache_versions import get_versions, calendar_scope
+from .windows import DateWindow
+
+# the format of the start and end parameters of the feed
+WINDOW_FORMAT = '%Y%m%d'
+
+# how long an appointment is shown as lasting
+APPOINTMENT_LENGTH = datetime.timedelta(minutes=30)
+
+# the iCalendar status of each appointment state
+STATUSES = {
+    Appointment.PENDING: 'TENTATIVE',
+    Appointment.ACCEPTED: 'CONFIRMED',
+    Appointment.REJECTED: 'CANCELLED',
+}
+
+
+def feed_token(user_id):
+    """
+        Returns the token that authenticates a user's feed, making one the
+        first time. Calendar apps can't log in, so the token stands in for
+        the session.
+    :param user_id: (int) id of the user
+    :return: (str) the token
+    """
+    feed, _ = CalendarFeed.objects.get_or_create(user_id=user_id, defaults={'token': CalendarFeed.new_token()})
+    return feed.token
+
+
+def reset_feed_token(user_id):
+    """
+        Gives a user's feed a new token, so the url with the old one stops
+        working
+    :param user_id: (int) id of the user
+    :return: (str) the new token
+    """
+    feed, _ = CalendarFeed.objects.update_or_create(user_id=user_id, defaults={'token': CalendarFeed.new_token()})
+    return feed.token
+
+
+def feed_user(token):
+    """
+        Returns the user a feed token belongs to, in one query. Accounts
+        that were disabled have no feed.
+    :param token: (str) the token
+    :return: (User) the user, or None if the token is not valid
+    """
+    feed = CalendarFeed.objects.filter(token=token, user__is_active=True).select_related('user').first()
+    return feed.user if feed is not None else None
+
+
+def feed_window(start=None, end=None):
+    """
+        Works out the window of appointments a feed request asks for. Clients
+        that sync incrementally pass start and end as YYYYMMDD; anything else,
+        or a window that would run past the last date there is, gets the
+        default window around today. Windows are capped in length so a
+        single request can't ask for the whole table.
+    :param start: (str) the first day of the window
+    :param end: (str) the day after the last day of the window
+    :return: (tuple) the start and end datetimes of the half open window
+    """
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+    default_start = today - datetime.timedelta(days=settings.HEALTHNET_ICS_PAST_DAYS)
+    default_end = today + datetime.timedelta(days=settings.HEALTHNET_ICS_FUTURE_DAYS)
+
+    longest = datetime.timedelta(days=settings.HEALTHNET_ICS_MAX_DAYS)
+
+    try:
+        start = datetime.datetime.strptime(start, WINDOW_FORMAT) if start else default_start
+        end = datetime.datetime.strptime(end, WINDOW_FORMAT) if end else default_end
+        if end <= start or end - start > longest:
+            end = start + min(longest, default_end - default_start)
+    except (ValueError, OverflowError):
+        start, end = default_start, default_end
+
+    return start, end
+
+
+def feed_appointments(role, start, end):
+    """
+        Returns the appointments shown in a role's feed within the window,
+        as tuples rather than model instances. The window is a range on the
+        appointment time, so the query stays on the owner's index. The
+        occurrences of recurring series in the window are merged in, each
+        with an id made of its series and time.
+    :param role: (Role) the role of the feed's user
+    :param start: (datetime) the start of the window
+    :param end: (datetime) the end of the window, not included
+    :return: (iterator) tuples of id, time, reason, state and the doctor's
+                and patient's names
+    """
+    window = DateWindow(start, end)
+    appointments = owner_appointments(role).filter(**window.lookup()).order_by('appointment_time').values_list(
+        'id', 'appointment_time', 'reason', 'accept_state',
+        'doctor__first_name', 'doctor__last_name', 'patient__first_name', 'patient__last_name',
+    ).iterator()
+    occurrences = (('series-%d-%s' % (occurrence.series.pk, occurrence.token), occurrence.appointment_time,
+                    occurrence.reason, occurrence.accept_state, occurrence.doctor.first_name,
+                    occurrence.doctor.last_name, occurrence.patient.first_name, occurrence.patient.last_name)
+                   for occurrence in owner_occurrences(role, window))
+    # merged on (time, stream, position) rather than with key=, which heapq
+    # only has from Python 3.5; the rows themselves are never compared
+    streams = [((row[1], stream, position, row) for position, row in enumerate(rows))
+               for stream, rows in enumerate((appointments, occurrences))]
+    return (row for _, _, _, row in heapq.merge(*streams))
+
+
+def feed_etag(role, start, end):
+    """
+        Returns the ETag of a feed. It is worked out from the cached version
+        of the owner's appointments, so a client polling an unchanged feed is
+        answered without reading any appointments. The ETag is weak since
+        each response is stamped with the time it was made.
+    :param role: (Role) the role of the feed's user
+    :param start: (datetime) the start of the window
+    :param end: (datetime) the end of the window
+    :return: (str) the ETag value, unquoted
+    """
+    scope = calendar_scope(*calendar_owner(role))
+    key = '%s:%s:%s:%s:%s' % (role.user.pk, role.name, get_versions(scope)[0],
+                              start.strftime(WINDOW_FORMAT), end.strftime(WINDOW_FORMAT))
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def escape_text(text):
+    """
+        Escapes a value for an iCalendar text property
+    :param text: (str) the value
+    :return: (str) the escaped value
+    """
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def content_line(name, value):
+    """
+        Formats an iCalendar content line, folding it so that no line is
+        longer than 75 octets
+    :param name: (str) the property name
+    :param value: (str) the property value
+    :return: (str) the line, ending in CRLF
+    """
+    line = ('%s:%s' % (name, value)).encode('utf-8')
+    parts = []
+    while len(line) > 75:
+        cut = 75 if not parts else 74
+        # don't split a multi-byte character
+        while cut and (line[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+    parts.append(line)
+    return b'\r\n '.join(parts).decode('utf-8') + '\r\n'
+
+
+def format_time(value):
+    """ Formats a datetime as an iCalendar date-time """
+    return value.strftime('%Y%m%dT%H%M%S')
+
+
+def ics_feed(appointments, host):
+    """
+        Writes out the feed a piece at a time. Appointment times are
+        written as floating local times, as they are stored.
+    :param appointments: (iterator) the rows from feed_appointments
+    :param host: (str) the domain the event ids are made unique with
+    :return: (generator) the pieces of the feed
+    """
+    stamp = format_time(datetime.datetime.utcnow()) + 'Z'
+
+    yield ('BEGIN:VCALENDAR\r\n'
+           'VERSION:2.0\r\n'
+           'PRODID:-//HealthNet//Appointments//EN\r\n'
+           'CALSCALE:GREGORIAN\r\n'
+           + content_line('X-WR-CALNAME', 'HealthNet'))
+
+    for appt_id, time, reason, state, doctor_first, doctor_last, patient_first, patient_last in appointments:
+        yield ''.join((
+            'BEGIN:VEVENT\r\n',
+            content_line('UID', 'appointment-%s@%s' % (appt_id, host)),
+            content_line('DTSTAMP', stamp),
+            content_line('DTSTART', format_time(time)),
+            content_line('DTEND', format_time(time + APPOINTMENT_LENGTH)),
+            content_line('SUMMARY', escape_text('%s: Dr. %s %s with %s %s' % (
+                reason, doctor_first, doctor_last, patient_first, patient_last))),
+            content_line('STATUS', STATUSES.get(state, 'CONFIRMED')),
+            'END:VEVENT\r\n',
+        ))
+
+    yield 'END:VCALENDAR\r\n'
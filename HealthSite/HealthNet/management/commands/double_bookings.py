@@ -0,0 +1,29 @@
+"""
+    Management command that lists the appointments a doctor was double
+    booked for before slots were checked. They keep their state, but have no
+    slot until they are booked again, which turns them down if the time is
+    still taken.
+
+    Usage:
+        python manage.py double_bookings
+"""
+
+from django.core.management.base import BaseCommand
+
+from HealthNet.models import Appointment
+
+
+class Command(BaseCommand):
+    help = 'Lists the appointments that were double booked before slots were checked'
+
+    def handle(self, *args, **options):
+        clashes = Appointment.objects.filter(slot__isnull=True).exclude(accept_state=Appointment.REJECTED)\
+            .select_related('doctor', 'patient').order_by('appointment_time', 'pk')
+
+        count = 0
+        for appointment in clashes:
+            count += 1
+            self.stdout.write('Appointment %d: %s with %s at %s (%s)' % (
+                appointment.pk, appointment.patient, appointment.doctor,
+                appointment.appointment_time.strftime('%Y-%m-%d %H:%M'), appointment.accept_state))
+        self.stdout.write('%d double booked appointment%s' % (count, '' if count == 1 else 's'))
@@ -0,0 +1,40 @@
+"""
+    Management command that imports a batch of appointments from a CSV or
+    JSON file
+
+    Usage:
+        python manage.py import_appointments schedule.csv [--hospital ID] [--dry-run]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from HealthNet.appointment_import import FORMATS, ImportFileError, guess_format, read_rows, import_appointments
+
+
+class Command(BaseCommand):
+    help = 'Imports a batch of appointments from a CSV or JSON file, reporting the rows that were turned down'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='the CSV or JSON file')
+        parser.add_argument('--format', choices=FORMATS, help='the format of the file, if not its extension')
+        parser.add_argument('--hospital', type=int, help='only book doctors and patients of this hospital')
+        parser.add_argument('--dry-run', action='store_true', help='check the rows without booking them')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or guess_format(options['path'])
+        if file_format is None:
+            raise CommandError('Give the format of %s with --format' % options['path'])
+
+        try:
+            with open(options['path'], encoding='utf-8-sig') as batch:
+                rows = read_rows(batch.read(), file_format)
+        except (IOError, UnicodeDecodeError, ImportFileError) as error:
+            raise CommandError(str(error))
+
+        report = import_appointments(rows, hospital_id=options['hospital'], dry_run=options['dry_run'])
+
+        for number, reason in report.rejected:
+            self.stderr.write('Row %d: %s' % (number, reason))
+        self.stdout.write('%d of %d appointments %s, %d turned down' % (
+            len(report.created), len(rows), 'would be booked' if options['dry_run'] else 'booked',
+            len(report.rejected)))
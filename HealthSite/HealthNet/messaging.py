@@ -0,0 +1,147 @@
+"""
+    File containing the queries behind the messages pages. Every message is
+    filed under the Conversation of its two users, so a user's conversations
+    come from one query on the conversation's participant indexes, newest
+    first, and a thread from one query on (conversation, created_at, id),
+    a page at a time from the newest message back. No page reads messages
+    outside the part of the thread it shows.
+
+    Each conversation counts the messages each of its users hasn't read, as
+    they are sent, so how many unread messages a user has is a sum over
+    their conversations rather than a count of their inbox.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, F, Case, When, Sum, IntegerField
+from django.db.models.functions import Greatest
+
+from .models import Conversation, Message
+from .cache_versions import bump, get_versions, user_scope
+
+# format of the date part of a thread cursor
+THREAD_CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def conversations_of(user_id):
+    """
+        Returns the conversations of a user, the most recently active first,
+        each with the user they are with as other_user
+    :param user_id: (int) id of the user
+    :return: (list) the conversations
+    """
+    conversations = list(Conversation.objects.filter(
+        Q(user_a_id=user_id) | Q(user_b_id=user_id), last_message_at__isnull=False,
+    ).select_related('user_a', 'user_b').order_by('-last_message_at', '-id'))
+
+    for conversation in conversations:
+        conversation.other_user = conversation.other(user_id)
+        conversation.unread = conversation.unread_for(user_id)
+    return conversations
+
+
+def unread_count(user_id):
+    """
+        Returns how many messages a user hasn't read, from the counters of
+        their conversations, in one query
+    :param user_id: (int) id of the user
+    :return: (int) the number of unread messages
+    """
+    total = Conversation.objects.filter(Q(user_a_id=user_id) | Q(user_b_id=user_id)).aggregate(unread=Sum(Case(
+        When(user_a_id=user_id, then=F('unread_a')), default=F('unread_b'), output_field=IntegerField(),
+    )))['unread']
+    return total or 0
+
+
+def cached_unread_count(user_id):
+    """
+        Returns how many messages a user hasn't read, cached until a message
+        to them is sent or read, for the navigation bar on every page
+    :param user_id: (int) id of the user
+    :return: (int) the number of unread messages
+    """
+    key = 'healthnet:unread:%s:%s' % (user_id, get_versions(user_scope(user_id))[0])
+    count = cache.get(key)
+    if count is None:
+        count = unread_count(user_id)
+        cache.set(key, count, settings.HEALTHNET_DASHBOARD_CACHE_TIMEOUT)
+    return count
+
+
+def thread(user_id, conversation_id, cursor=None, limit=None):
+    """
+        Returns a page of the messages of a conversation. Pages go from the
+        newest message back and are keyed on (created_at, id), so loading
+        older messages never rescans the ones already shown. Only the
+        conversation's own users can read it, which the same query checks.
+    :param user_id: (int) id of the user reading the conversation
+    :param conversation_id: (int) id of the conversation
+    :param cursor: (str) the cursor returned with the previous page, or None
+                    for the newest messages
+    :param limit: (int) the most messages per page; defaults to the
+                    HEALTHNET_CONVERSATION_PAGE_SIZE setting
+    :return: (tuple) the messages of the page, oldest first, with their
+                senders and receivers, and the cursor of the older messages
+                or None if there are no more. The list is empty if there is
+                no such conversation or the user isn't in it.
+    """
+    if limit is None:
+        limit = settings.HEALTHNET_CONVERSATION_PAGE_SIZE
+
+    messages = Message.objects.filter(Q(sender_id=user_id) | Q(receiver_id=user_id), conversation_id=conversation_id)
+
+    position = parse_thread_cursor(cursor)
+    if position is not None:
+        created_at, message_id = position
+        messages = messages.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id))
+
+    # fetch one extra message to find out if there are older ones
+    messages = list(messages.select_related('sender', 'receiver').order_by('-created_at', '-id')[:limit + 1])
+    older = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        oldest = messages[-1]
+        older = '%s_%d' % (oldest.created_at.strftime(THREAD_CURSOR_FORMAT), oldest.id)
+
+    messages.reverse()
+    return messages, older
+
+
+def parse_thread_cursor(cursor):
+    """
+        Parses a cursor made by thread
+    :param cursor: (str) the cursor
+    :return: (tuple) the time and id of the oldest message shown, or None if
+                the cursor is missing or malformed
+    """
+    if not cursor:
+        return None
+    try:
+        created_at, message_id = cursor.split('_')
+        return datetime.datetime.strptime(created_at, THREAD_CURSOR_FORMAT), int(message_id)
+    except ValueError:
+        return None
+
+
+def mark_read(user_id, conversation_id):
+    """
+        Marks the messages a user received in a conversation as read, with
+        one UPDATE of the messages and one of the conversation's counter
+    :param user_id: (int) id of the user
+    :param conversation_id: (int) id of the conversation
+    :return: (int) the number of messages marked
+    """
+    marked = Message.objects.filter(conversation_id=conversation_id, receiver_id=user_id,
+                                    status=False).update(status=True)
+    if marked:
+        # the user's counter is taken down by as many as were marked, so
+        # messages sent in the meantime stay counted
+        Conversation.objects.filter(pk=conversation_id).update(**{field: Case(
+            When(**{lookup: user_id, 'then': Greatest(F(field) - marked, 0)}),
+            default=F(field), output_field=IntegerField(),
+        ) for field, lookup in (('unread_a', 'user_a_id'), ('unread_b', 'user_b_id'))})
+        # update() skips the signals that keep the dashboard's unread count current
+        bump(user_scope(user_id))
+    return marked
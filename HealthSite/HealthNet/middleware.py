@@ -0,0 +1,19 @@
+"""
+    File containing the middleware used by HealthNet
+"""
+
+from django.utils.functional import SimpleLazyObject
+
+from .roles import get_role
+
+
+class RoleMiddleware(object):
+    """
+        Attaches the role of the requesting user to the request as
+        request.healthnet_role. The role is lazy, so requests that never
+        look at it never pay for the lookup. Must come after the
+        AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        request.healthnet_role = SimpleLazyObject(lambda: get_role(request.user))
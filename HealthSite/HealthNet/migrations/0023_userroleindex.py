@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 15:45
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0007_alter_validators_add_error_messages'),
+        ('HealthNet', '0022_auto_20170508_0354'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserRoleIndex',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='role_index', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('role', models.SlugField(choices=[('patient', 'Patient'), ('doctor', 'Doctor'), ('nurse', 'Nurse'), ('admin', 'Hospital Administrator')], max_length=10)),
+                ('hospital', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='role_index', to='HealthNet.Hospital')),
+            ],
+            options={
+                'verbose_name': 'User Role',
+                'verbose_name_plural': 'User Roles',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='userroleindex',
+            index_together=set([('hospital', 'role')]),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def backfill_role_index(apps, schema_editor):
+    """
+        Fills in the role index for every existing patient, doctor, nurse and
+        hospital admin. Roles are written from lowest to highest precedence so
+        that a user in more than one table ends up with the role that
+        get_user_type has always given them.
+    """
+    UserRoleIndex = apps.get_model('HealthNet', 'UserRoleIndex')
+
+    roles = [
+        ('admin', apps.get_model('HealthNet', 'HospitalAdmin'), 'hptal_id'),
+        ('nurse', apps.get_model('HealthNet', 'Nurse'), 'hospital_id'),
+        ('doctor', apps.get_model('HealthNet', 'Doctor'), 'hospital_id'),
+        ('patient', apps.get_model('HealthNet', 'Patient'), 'hospital_id'),
+    ]
+
+    entries = {}
+    for role, model, hospital_field in roles:
+        for user_id, hospital_id in model.objects.values_list('pk', hospital_field):
+            entries[user_id] = UserRoleIndex(user_id=user_id, role=role, hospital_id=hospital_id)
+
+    UserRoleIndex.objects.all().delete()
+    UserRoleIndex.objects.bulk_create(entries.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNet', '0023_userroleindex'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_role_index, migrations.RunPython.noop),
+    ]
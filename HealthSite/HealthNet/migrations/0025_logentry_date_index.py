@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 15:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNet', '0024_backfill_userroleindex'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='logentry',
+            name='date',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 18:40
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import migrations, models
+
+
+SLOT_MINUTES = 30
+
+logger = logging.getLogger(__name__)
+
+
+def fill_slots(apps, schema_editor):
+    """
+        Gives every appointment that isn't rejected its slot. Where a doctor
+        was already double booked, the appointment booked first keeps the
+        slot and the later ones are left without one, until they are booked
+        again. manage.py double_bookings lists them.
+    """
+    Appointment = apps.get_model('HealthNet', 'Appointment')
+    taken = set()
+    clashes = 0
+    for appointment in Appointment.objects.exclude(accept_state='Rejected').order_by('pk').iterator():
+        time = appointment.appointment_time
+        slot = time.replace(minute=time.minute - time.minute % SLOT_MINUTES, second=0, microsecond=0)
+        if (appointment.doctor_id, slot) in taken:
+            clashes += 1
+            continue
+        taken.add((appointment.doctor_id, slot))
+        Appointment.objects.filter(pk=appointment.pk).update(slot=slot)
+
+    if clashes:
+        logger.warning('%d double booked appointment(s) were left without a slot; '
+                       'run manage.py double_bookings to list them', clashes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNet', '0027_appointment_patient_time_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='slot',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fill_slots, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='appointment',
+            unique_together=set([('doctor', 'slot')]),
+        ),
+    ]
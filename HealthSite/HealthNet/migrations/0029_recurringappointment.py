@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 16:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNet', '0028_appointment_slot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringAppointment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField(verbose_name='First Appointment')),
+                ('frequency', models.SlugField(choices=[('weekly', 'Weekly'), ('monthly', 'Monthly')], max_length=10)),
+                ('interval', models.PositiveSmallIntegerField(default=1)),
+                ('until', models.DateField(blank=True, null=True)),
+                ('accept_state', models.SlugField(default='Pending', max_length=10)),
+                ('reason', models.CharField(max_length=250)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recurring_appointments', to='HealthNet.Doctor')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recurring_appointments', to='HealthNet.Patient')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SkippedOccurrence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('occurrence', models.DateTimeField()),
+                ('series', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='skipped', to='HealthNet.RecurringAppointment')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='skippedoccurrence',
+            unique_together=set([('series', 'occurrence')]),
+        ),
+    ]
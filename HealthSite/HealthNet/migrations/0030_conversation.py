@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 16:29
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+PREVIEW_LENGTH = 100
+
+
+def fill_conversations(apps, schema_editor):
+    """
+        Starts a conversation for every pair of users that has exchanged
+        messages, with its newest message, and files their messages under it
+    """
+    Conversation = apps.get_model('HealthNet', 'Conversation')
+    Message = apps.get_model('HealthNet', 'Message')
+
+    newest = {}
+    for sender_id, receiver_id, created_at, content in Message.objects.order_by('created_at', 'pk').values_list(
+            'sender_id', 'receiver_id', 'created_at', 'msg_content').iterator():
+        newest[min(sender_id, receiver_id), max(sender_id, receiver_id)] = (created_at, content)
+
+    for (user_a, user_b), (created_at, content) in newest.items():
+        conversation = Conversation.objects.create(user_a_id=user_a, user_b_id=user_b, last_message_at=created_at,
+                                                   last_preview=content[:PREVIEW_LENGTH])
+        Message.objects.filter(models.Q(sender_id=user_a, receiver_id=user_b) |
+                               models.Q(sender_id=user_b, receiver_id=user_a)).update(conversation=conversation)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('HealthNet', '0029_recurringappointment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('last_preview', models.CharField(blank=True, max_length=100)),
+                ('user_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations_as_a', to=settings.AUTH_USER_MODEL)),
+                ('user_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations_as_b', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='conversation',
+            unique_together=set([('user_a', 'user_b')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='conversation',
+            index_together=set([('user_b', 'last_message_at'), ('user_a', 'last_message_at')]),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='HealthNet.Conversation'),
+        ),
+        migrations.RunPython(fill_conversations, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='HealthNet.Conversation'),
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('conversation', 'created_at')]),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 16:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_unread(apps, schema_editor):
+    """
+        Counts the messages each user of a conversation hasn't read yet
+    """
+    Conversation = apps.get_model('HealthNet', 'Conversation')
+    Message = apps.get_model('HealthNet', 'Message')
+
+    unread = Message.objects.filter(status=False).values('conversation_id', 'receiver_id').annotate(
+        count=models.Count('id')).values_list('conversation_id', 'receiver_id', 'count')
+    pairs = dict(Conversation.objects.values_list('pk', 'user_a_id'))
+    for conversation_id, receiver_id, count in unread:
+        field = 'unread_a' if pairs[conversation_id] == receiver_id else 'unread_b'
+        Conversation.objects.filter(pk=conversation_id).update(**{field: count})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('HealthNet', '0030_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='unread_a',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='unread_b',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('conversation', 'created_at'), ('receiver', 'status')]),
+        ),
+    ]
@@ -8,6 +8,8 @@
     Hospital
     Prescription
     HospitalAdmin
+    UserRoleIndex
+    CalendarFeed
 
     @authors: Laura Corrigan, Benjamin Kirby, Ethan Della Posta, Theodora Bendlin
 """
@@ -16,9 +18,12 @@ from __future__ import unicode_literals
 
 import django
 from django.utils import timezone
+from django.utils.crypto import get_random_string
 from django.db import models
 from django.contrib.auth.models import User
 from django.db.models.signals import post_init
+import calendar
+import datetime
 from datetime import date
 from itertools import groupby
 from django.core.urlresolvers import reverse
@@ -225,11 +230,19 @@ class Appointment(models.Model):
     REJECTED = 'Rejected'
     PENDING = 'Pending'
 
+    # The length of the slots a doctor's day is divided into
+    SLOT_MINUTES = 30
+
 
     ### FIELDS ###
     # The date and time of the appointment
     appointment_time = models.DateTimeField('Appointment Time', default=timezone.now, )
 
+    # The start of the slot the appointment takes, or empty if it was
+    # rejected. A doctor's slots can only be taken once, so two bookings racing
+    # for the same one can't both be saved.
+    slot = models.DateTimeField(null=True, blank=True, editable=False)
+
     # Status of the Appointment -- Accepted, rejected or pending
     accept_state = models.SlugField(max_length=10, default="Pending")
 
@@ -242,6 +255,40 @@ class Appointment(models.Model):
     # The patient associated with the appointment
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='Patient',)
 
+    @staticmethod
+    def slot_for(time):
+        """
+            Returns the start of the slot a time falls in
+        :param time: (datetime) the time
+        :return: (datetime) the start of its slot
+        """
+        return time.replace(minute=time.minute - time.minute % Appointment.SLOT_MINUTES, second=0, microsecond=0)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+            Builds an appointment read from the database, remembering who
+            it belonged to, so a save that moves it to another patient or
+            doctor can invalidate the caches of the old ones too
+        """
+        appointment = super(Appointment, cls).from_db(db, field_names, values)
+        loaded = dict(zip(field_names, values))
+        appointment._loaded_owners = (loaded.get('patient_id'), loaded.get('doctor_id'))
+        return appointment
+
+    def save(self, *args, **kwargs):
+        """
+            Saves the appointment, keeping its slot in step with its time
+            and state
+        """
+        self.slot = Appointment.slot_for(self.appointment_time) if self.accept_state != Appointment.REJECTED else None
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'appointment_time', 'accept_state'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'slot'}
+
+        super(Appointment, self).save(*args, **kwargs)
+
     def modify_appointment(self, doctor, date_time, reason):
         """
             Modifies the editable appointment information with the
@@ -303,6 +350,143 @@ class Appointment(models.Model):
         self.accept_state = Appointment.PENDING
         self.save()
 
+    class Meta:
+        # a doctor's or patient's appointments over a span of time are read
+        # with a single range scan (see windows.py)
+        index_together = [('doctor', 'appointment_time'), ('patient', 'appointment_time')]
+        unique_together = [('doctor', 'slot')]
+
+class RecurringAppointment(models.Model):
+    """
+        Class representing a series of appointments that repeats, such as
+        weekly physio or a monthly checkup. Only the rule is stored; the
+        occurrences are worked out from it for whatever span of time is
+        being looked at, less the ones that were skipped.
+    """
+
+    ### CONSTANTS ###
+
+    # How often a series repeats
+    WEEKLY = 'weekly'
+    MONTHLY = 'monthly'
+    FREQUENCIES = ((WEEKLY, 'Weekly'), (MONTHLY, 'Monthly'))
+
+
+    ### FIELDS ###
+    # The date and time of the first appointment of the series
+    start = models.DateTimeField('First Appointment')
+
+    # Weekly or monthly
+    frequency = models.SlugField(max_length=10, choices=FREQUENCIES)
+
+    # The series repeats every this many weeks or months
+    interval = models.PositiveSmallIntegerField(default=1)
+
+    # The last day the series can fall on, or empty if it doesn't end
+    until = models.DateField(null=True, blank=True)
+
+    # Status of the whole series -- Accepted, rejected or pending
+    accept_state = models.SlugField(max_length=10, default=Appointment.PENDING)
+
+    # Reason for the appointments
+    reason = models.CharField(max_length=250)
+
+    # The doctor associated with the series
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='recurring_appointments')
+
+    # The patient associated with the series
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='recurring_appointments')
+
+    def occurrence_at(self, n):
+        """
+            Works out the time of an occurrence straight from the rule,
+            without stepping through the ones before it. Monthly series that
+            start late in the month fall on the last day of shorter months.
+        :param n: (int) the number of the occurrence, counting from 0
+        :return: (datetime) the time of the occurrence
+        """
+        if self.frequency == RecurringAppointment.WEEKLY:
+            return self.start + datetime.timedelta(weeks=n * self.interval)
+
+        month = self.start.month - 1 + n * self.interval
+        year = self.start.year + month // 12
+        month = month % 12 + 1
+        return self.start.replace(year=year, month=month,
+                                  day=min(self.start.day, calendar.monthrange(year, month)[1]))
+
+    def first_occurrence_from(self, time):
+        """
+            Works out the number of the first occurrence at or after a time
+        :param time: (datetime) the time
+        :return: (int) the number of the occurrence
+        """
+        if time <= self.start:
+            return 0
+        if self.frequency == RecurringAppointment.WEEKLY:
+            step = datetime.timedelta(weeks=self.interval)
+            return -((self.start - time) // step)
+
+        # close to the answer from the months between them, then settled exactly
+        months = (time.year - self.start.year) * 12 + time.month - self.start.month
+        n = max(0, months // self.interval - 1)
+        while self.occurrence_at(n) < time:
+            n += 1
+        return n
+
+    def occurrences(self, start, end, skipped=None):
+        """
+            Lists the times of the occurrences in a half open span of time
+            as they are needed, stopping at the end of the span or of the
+            series
+        :param start: (datetime) the start of the span
+        :param end: (datetime) the end of the span, not included
+        :param skipped: (set) times of skipped occurrences; read from the
+                        prefetched skips if not given
+        :return: (generator) the times, in order
+        """
+        if skipped is None:
+            skipped = self.skipped_times()
+
+        n = self.first_occurrence_from(start)
+        while True:
+            try:
+                time = self.occurrence_at(n)
+            except (ValueError, OverflowError):
+                # the series runs on past the last date there is
+                return
+            if time >= end or (self.until is not None and time.date() > self.until):
+                return
+            if time not in skipped:
+                yield time
+            n += 1
+
+    def skipped_times(self):
+        """
+            Returns the times of the occurrences that were skipped
+        :return: (set) the times
+        """
+        return {skip.occurrence for skip in self.skipped.all()}
+
+    def __str__(self):
+        return '%s %s from %s' % (self.get_frequency_display(), self.reason, self.start)
+
+
+class SkippedOccurrence(models.Model):
+    """
+        Class representing an occurrence of a recurring appointment that
+        won't take place
+    """
+
+    # The series the occurrence belongs to
+    series = models.ForeignKey(RecurringAppointment, on_delete=models.CASCADE, related_name='skipped')
+
+    # The time the occurrence would have been at
+    occurrence = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('series', 'occurrence')]
+
+
 class Hospital(models.Model):
     """
         Hospital class that represents a hopsital that is part of
@@ -463,12 +647,123 @@ class Prescription(models.Model):
     # Date the Prescription was assigned
     datePrescribed = models.DateField('Date Prescribed', default=date.today)
 
+class Conversation(models.Model):
+    """
+        Class representing the thread of messages between two users. The
+        pair is stored in order, lower id first, so there is exactly one
+        conversation for any two users whichever of them writes first. The
+        time and text of the newest message are kept on it, so the list of
+        conversations doesn't have to read any messages.
+    """
+
+    ### CONSTANTS ###
+
+    # how much of the newest message is kept for the list of conversations
+    PREVIEW_LENGTH = 100
+
+
+    ### FIELDS ###
+    # The user of the pair with the lower id
+    user_a = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations_as_a')
+
+    # The user of the pair with the higher id
+    user_b = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations_as_b')
+
+    # When the newest message was sent
+    last_message_at = models.DateTimeField(null=True, blank=True)
+
+    # The start of the newest message
+    last_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+
+    # How many messages each user of the pair hasn't read yet
+    unread_a = models.PositiveIntegerField(default=0)
+    unread_b = models.PositiveIntegerField(default=0)
+
+    @staticmethod
+    def pair(user_id, other_id):
+        """
+            Puts the ids of two users in the order conversations store them
+        :return: (tuple) the lower id and the higher id
+        """
+        return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
+
+    @staticmethod
+    def between(user_id, other_id):
+        """
+            Returns the conversation of two users, starting it if they have
+            none yet
+        :param user_id: (int) id of one of the users
+        :param other_id: (int) id of the other user
+        :return: (Conversation) the conversation
+        """
+        user_a, user_b = Conversation.pair(user_id, other_id)
+        return Conversation.objects.get_or_create(user_a_id=user_a, user_b_id=user_b)[0]
+
+    def unread_field(self, user_id):
+        """
+            Returns the name of the counter of the messages a user of the
+            conversation hasn't read
+        :param user_id: (int) id of one of the users of the conversation
+        :return: (str) 'unread_a' or 'unread_b'
+        """
+        return 'unread_a' if self.user_a_id == user_id else 'unread_b'
+
+    def unread_for(self, user_id):
+        """
+            Returns how many messages a user of the conversation hasn't read
+        :param user_id: (int) id of one of the users of the conversation
+        :return: (int) the number of unread messages
+        """
+        return getattr(self, self.unread_field(user_id))
+
+    def other(self, user_id):
+        """
+            Returns the user the given user is talking to
+        :param user_id: (int) id of one of the users of the conversation
+        :return: (User) the other user
+        """
+        return self.user_b if self.user_a_id == user_id else self.user_a
+
+    class Meta:
+        unique_together = [('user_a', 'user_b')]
+        index_together = [('user_a', 'last_message_at'), ('user_b', 'last_message_at')]
+
+
 class Message(models.Model):
     sender = models.ForeignKey(User, related_name="sender")
     receiver = models.ForeignKey(User, related_name="receiver", verbose_name="To")
     msg_content = models.TextField(verbose_name='', max_length=200)
     created_at = models.DateTimeField()
     status = models.BooleanField(default=False)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
+
+    def save(self, *args, **kwargs):
+        """
+            Saves the message into the conversation of its sender and
+            receiver. A new message makes it the conversation's newest
+            message, unless a newer one is there already, and counts as
+            unread for the receiver, both in a single UPDATE.
+        """
+        if self.conversation_id is None:
+            self.conversation = Conversation.between(self.sender_id, self.receiver_id)
+        adding = self._state.adding
+        super(Message, self).save(*args, **kwargs)
+        if not adding:
+            return
+
+        newer = models.Q(last_message_at__isnull=True) | models.Q(last_message_at__lte=self.created_at)
+        changes = {
+            'last_message_at': models.Case(models.When(newer, then=models.Value(self.created_at)),
+                                           default=models.F('last_message_at'), output_field=models.DateTimeField()),
+            'last_preview': models.Case(models.When(newer, then=models.Value(
+                self.msg_content[:Conversation.PREVIEW_LENGTH])), default=models.F('last_preview'),
+                output_field=models.CharField()),
+        }
+        if not self.status:
+            unread = 'unread_a' if Conversation.pair(self.sender_id, self.receiver_id)[0] == self.receiver_id \
+                else 'unread_b'
+            changes[unread] = models.F(unread) + 1
+        Conversation.objects.filter(pk=self.conversation_id).update(**changes)
 
     def getUserType(self, user):
         if self.sender.id != user.id:
@@ -476,6 +771,9 @@ class Message(models.Model):
         else:
             return self.receiver
 
+    class Meta:
+        index_together = [('conversation', 'created_at', 'id'), ('receiver', 'status')]
+
 
 def get_full_name(self):
     return self.first_name + " " + self.last_name
@@ -610,8 +908,8 @@ class LogEntry(models.Model):
     #the action that was done to make an entry
     action = models.CharField(max_length=50, blank=False)
 
-    #the date and time the entry was logged
-    date = models.DateTimeField()
+    #the date and time the entry was logged, indexed for the dashboard's time window
+    date = models.DateTimeField(db_index=True)
 
     class Meta:
         verbose_name = "Entry"
@@ -630,3 +928,96 @@ class TimeFrame(models.Model):
     endTime = models.DateTimeField()
 
 
+
+
+class UserRoleIndex(models.Model):
+    """
+        Denormalized index holding the role and hospital of every HealthNet
+        user. Patients, doctors, nurses and hospital admins are all children of
+        User, so without this table finding a user's role means probing four
+        tables. The index is kept current by the signals in signals.py.
+    """
+
+    ### CONSTANTS ###
+
+    PATIENT = 'patient'
+    DOCTOR = 'doctor'
+    NURSE = 'nurse'
+    ADMIN = 'admin'
+
+    ROLE_CHOICES = (
+        (PATIENT, 'Patient'),
+        (DOCTOR, 'Doctor'),
+        (NURSE, 'Nurse'),
+        (ADMIN, 'Hospital Administrator'),
+    )
+
+    # the role a user in more than one table is indexed with, highest first,
+    # as get_user_type has always given it (the backfill in migration 0024
+    # uses the same order)
+    PRECEDENCE = (PATIENT, DOCTOR, NURSE, ADMIN)
+
+    ### FIELDS ###
+
+    # the user that this entry is for
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='role_index')
+
+    # the role of the user
+    role = models.SlugField(max_length=10, choices=ROLE_CHOICES)
+
+    # the hospital that the user belongs to
+    hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE, null=True, related_name='role_index')
+
+    ### METHODS ###
+
+    @classmethod
+    def record(cls, user_id, role, hospital_id):
+        """
+            Creates or updates the index entry of a user. An entry for a role
+            of higher precedence is left as it is.
+        :param user_id: (int) the id of the user
+        :param role: (str) one of the role constants
+        :param hospital_id: (int) the id of the user's hospital
+        :return: none
+        """
+        current = cls.objects.filter(user_id=user_id).values_list('role', flat=True).first()
+        if current is not None and cls.PRECEDENCE.index(current) < cls.PRECEDENCE.index(role):
+            return
+        cls.objects.update_or_create(user_id=user_id, defaults={'role': role, 'hospital_id': hospital_id})
+
+    class Meta:
+        index_together = [('hospital', 'role')]
+        verbose_name = 'User Role'
+        verbose_name_plural = 'User Roles'
+
+
+class CalendarFeed(models.Model):
+    """
+        The secret that a user's calendar feed url is made from. Calendar
+        apps can't log in, so anyone with the url can read the feed; the
+        user can swap the token for a new one at any time, which stops the
+        old url from working.
+    """
+
+    ### CONSTANTS ###
+
+    # how many random characters a token has
+    TOKEN_LENGTH = 32
+
+    ### FIELDS ###
+
+    # the user whose feed this is
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='calendar_feed')
+
+    # the secret part of the feed url
+    token = models.CharField(max_length=TOKEN_LENGTH, unique=True)
+
+    ### METHODS ###
+
+    @staticmethod
+    def new_token():
+        """
+            Makes a new random token
+        :return: (str) the token
+        """
+        return get_random_string(CalendarFeed.TOKEN_LENGTH)
@@ -0,0 +1,131 @@
+"""
+    File containing the expansion of recurring appointments. A series only
+    stores its rule, so whatever is shown or checked reads the series that
+    overlap the span of time at hand and works out their occurrences there
+    and then, in order, one at a time. Nothing is stored per occurrence
+    unless it is skipped.
+"""
+
+import heapq
+
+from django.db.models import Q
+
+from .models import Appointment, RecurringAppointment
+
+# the format an occurrence's time is given in urls
+OCCURRENCE_FORMAT = '%Y%m%d%H%M'
+
+
+class Occurrence(object):
+    """
+        One occurrence of a recurring appointment. It stands in for an
+        Appointment wherever appointments are listed, so it has the
+        attributes that templates and views read from one.
+    """
+
+    # occurrences aren't rows of their own
+    id = None
+    pk = None
+    is_occurrence = True
+
+    def __init__(self, series, time):
+        self.series = series
+        self.appointment_time = time
+
+    @property
+    def reason(self):
+        return self.series.reason
+
+    @property
+    def accept_state(self):
+        return self.series.accept_state
+
+    @property
+    def doctor(self):
+        return self.series.doctor
+
+    @property
+    def doctor_id(self):
+        return self.series.doctor_id
+
+    @property
+    def patient(self):
+        return self.series.patient
+
+    @property
+    def patient_id(self):
+        return self.series.patient_id
+
+    @property
+    def token(self):
+        """ The occurrence's time as it is given in urls """
+        return self.appointment_time.strftime(OCCURRENCE_FORMAT)
+
+    timeToString = Appointment.timeToString
+
+
+def series_in(window, series=None):
+    """
+        Narrows series down to the ones that may have occurrences in a span
+        of time, with their skipped occurrences read in one more query
+    :param window: (DateWindow) the span of time
+    :param series: (QuerySet) the series to narrow down; all of them if
+                    not given
+    :return: (QuerySet) the series
+    """
+    if series is None:
+        series = RecurringAppointment.objects.all()
+    return series.filter(
+        Q(until__isnull=True) | Q(until__gte=window.start.date()), start__lt=window.end,
+    ).prefetch_related('skipped')
+
+
+def series_of(owner, owner_id):
+    """
+        Returns the series shown on a patient's, doctor's or hospital's
+        calendar, as with calendar.owner_appointments. Doctors don't see the
+        series they rejected.
+    :param owner: (str) 'patient', 'doctor' or 'hospital'
+    :param owner_id: (int) id of the patient, doctor or hospital
+    :return: (QuerySet) the series
+    """
+    if owner == 'patient':
+        return RecurringAppointment.objects.filter(patient_id=owner_id)
+    if owner == 'doctor':
+        return RecurringAppointment.objects.filter(doctor_id=owner_id).exclude(accept_state=Appointment.REJECTED)
+    return RecurringAppointment.objects.filter(doctor__hospital_id=owner_id)
+
+
+def expand(series, window):
+    """
+        Works out the occurrences of series within a span of time, merged
+        into time order as they are read
+    :param series: (iterable) the series, such as from series_in
+    :param window: (DateWindow) the span of time
+    :return: (iterator) the occurrences, in time order
+    """
+    return _in_time_order([(Occurrence(one, time) for time in one.occurrences(window.start, window.end))
+                           for one in series])
+
+
+def with_occurrences(appointments, occurrences):
+    """
+        Merges appointments and occurrences, both already in time order
+    :param appointments: (iterable) the appointments
+    :param occurrences: (iterable) the occurrences
+    :return: (iterator) both, in time order
+    """
+    return _in_time_order([appointments, occurrences])
+
+
+def _in_time_order(streams):
+    """
+        Merges streams of appointments or occurrences that are each in time
+        order. They are merged on (time, stream, position) rather than with
+        heapq.merge's key, which only came in Python 3.5.
+    :param streams: (list) the streams
+    :return: (iterator) all of them, in time order
+    """
+    return (item for _, _, _, item in heapq.merge(*[
+        ((item.appointment_time, stream, position, item) for position, item in enumerate(items))
+        for stream, items in enumerate(streams)]))
@@ -0,0 +1,136 @@
+"""
+    File containing the role resolution for HealthNet users. A role answers
+    the question "what kind of user is this, and which hospital are they in"
+    so that views and templates no longer need to probe the Patient, Doctor,
+    Nurse and HospitalAdmin tables one after another.
+"""
+
+from django.utils.functional import cached_property
+
+from .models import Patient, Doctor, Nurse, HospitalAdmin, Hospital, UserRoleIndex
+
+
+class Role(object):
+    """
+        The resolved role of a user. Only the role name and the hospital id
+        are loaded up front; the hospital and the Patient/Doctor/Nurse/
+        HospitalAdmin instance are loaded the first time they are read.
+    """
+
+    ### CONSTANTS ###
+
+    PATIENT = UserRoleIndex.PATIENT
+    DOCTOR = UserRoleIndex.DOCTOR
+    NURSE = UserRoleIndex.NURSE
+    ADMIN = UserRoleIndex.ADMIN
+
+    # the model holding the profile of each role
+    MODELS = {
+        PATIENT: Patient,
+        DOCTOR: Doctor,
+        NURSE: Nurse,
+        ADMIN: HospitalAdmin,
+    }
+
+    def __init__(self, user, name=None, hospital_id=None):
+        """
+            Init function for a role
+        :param user: (User) the user the role belongs to
+        :param name: (str) one of the role constants, or None if the user
+                        is anonymous or has no HealthNet role
+        :param hospital_id: (int) the id of the user's hospital
+        """
+        self.user = user
+        self.name = name
+        self.hospital_id = hospital_id
+
+    def __bool__(self):
+        return self.name is not None
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        return self.name or ''
+
+    @property
+    def is_patient(self):
+        return self.name == Role.PATIENT
+
+    @property
+    def is_doctor(self):
+        return self.name == Role.DOCTOR
+
+    @property
+    def is_nurse(self):
+        return self.name == Role.NURSE
+
+    @property
+    def is_admin(self):
+        return self.name == Role.ADMIN
+
+    @cached_property
+    def hospital(self):
+        """
+            The hospital of the user, loaded on first access
+        :return: (Hospital) the user's hospital, or None
+        """
+        if self.hospital_id is None:
+            return None
+        return Hospital.objects.get(pk=self.hospital_id)
+
+    @cached_property
+    def instance(self):
+        """
+            The Patient, Doctor, Nurse or HospitalAdmin instance of the user,
+            loaded on first access
+        :return: the profile instance, or None if the user has no role
+        """
+        if self.name is None:
+            return None
+        return Role.MODELS[self.name].objects.get(pk=self.user.pk)
+
+
+def resolve_role(user):
+    """
+        Resolves the role of the given user with a single indexed lookup on
+        the UserRoleIndex table
+    :param user: (User) the user to resolve
+    :return: (Role) the resolved role
+    """
+    if user is None or not user.is_authenticated():
+        return Role(user)
+
+    row = UserRoleIndex.objects.filter(user_id=user.pk).values_list('role', 'hospital_id').first()
+    if row is None:
+        return Role(user)
+
+    return Role(user, row[0], row[1])
+
+
+def get_role(user):
+    """
+        Returns the role of the given user, resolving it only once per user
+        instance. Since request.user is the same object for the length of a
+        request, the role is resolved at most once per request.
+    :param user: (User) the user in question
+    :return: (Role) the role of the user
+    """
+    role = getattr(user, '_healthnet_role', None)
+    if role is None:
+        role = resolve_role(user)
+        if user is not None:
+            user._healthnet_role = role
+    return role
+
+
+def get_request_role(request):
+    """
+        Returns the role of the requesting user, as set on the request by
+        RoleMiddleware
+    :param request: the current request
+    :return: (Role) the role of the user
+    """
+    role = getattr(request, 'healthnet_role', None)
+    if role is None:
+        role = get_role(request.user)
+    return role
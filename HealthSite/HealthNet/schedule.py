@@ -0,0 +1,105 @@
+"""
+    File containing the hospital schedule: a week of a hospital's
+    appointments laid out in lanes, one per doctor, so nurses can see who is
+    free when. A page of lanes is built from a single range query, plus one
+    for the doctors' recurring series, and only the occupied slots are kept,
+    not the appointments themselves.
+"""
+
+import datetime
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+
+from .models import Appointment, Doctor, RecurringAppointment
+from .recurrence import series_in
+from .windows import DateWindow, week_start
+
+# the length of a slot in the schedule
+SLOT_MINUTES = 30
+
+# how far apart the weeks of the schedule are
+WEEK = datetime.timedelta(days=7)
+
+# when appointments share a slot, the slot shows the highest ranked state
+STATE_RANK = {Appointment.REJECTED: 0, Appointment.PENDING: 1, Appointment.ACCEPTED: 2}
+
+# an occupied slot: when it starts, and the state of its appointment
+Slot = namedtuple('Slot', ['start', 'state'])
+
+# the week of a doctor: a list of occupied slots for each day, sunday first
+Lane = namedtuple('Lane', ['doctor', 'days'])
+
+
+def parse_week(value):
+    """
+        Returns the week asked for by a request. Weeks at the very start or
+        end of the calendar, which have no week before or after them to
+        link to, get this week too.
+    :param value: (str) any day of the week as YYYY-MM-DD, or None for this
+                    week
+    :return: (date) the sunday that starts the week
+    """
+    try:
+        week = week_start(datetime.datetime.strptime(value, '%Y-%m-%d').date())
+    except (TypeError, ValueError, OverflowError):
+        week = None
+    if week is None or not datetime.date.min + WEEK <= week <= datetime.date.max - WEEK:
+        week = week_start(datetime.date.today())
+    return week
+
+
+def schedule_lanes(hospital_id, week, page=1, per_page=None):
+    """
+        Returns a page of the hospital's doctors along with the week of each
+        of them. The appointments of the whole page are read with one range
+        query on (doctor, appointment_time).
+    :param hospital_id: (int) id of the hospital
+    :param week: (date) the sunday that starts the week
+    :param page: the page of doctors, counting from 1
+    :param per_page: (int) doctors per page; defaults to the
+                        HEALTHNET_SCHEDULE_DOCTORS_PER_PAGE setting
+    :return: (tuple) the page of doctors and their lanes
+    """
+    if per_page is None:
+        per_page = settings.HEALTHNET_SCHEDULE_DOCTORS_PER_PAGE
+
+    doctors = Doctor.objects.filter(hospital_id=hospital_id).only(
+        'first_name', 'last_name').order_by('last_name', 'first_name', 'pk')
+    paginator = Paginator(doctors, per_page)
+    try:
+        doctors = paginator.page(page)
+    except PageNotAnInteger:
+        doctors = paginator.page(1)
+    except EmptyPage:
+        doctors = paginator.page(paginator.num_pages)
+
+    # the occupied slots of each day of each doctor, by slot number
+    occupied = {doctor.pk: [{} for _ in range(7)] for doctor in doctors}
+
+    if occupied:
+        window = DateWindow.week(week)
+        rows = list(Appointment.objects.filter(
+            doctor_id__in=list(occupied), **window.lookup()
+        ).values_list('doctor_id', 'appointment_time', 'accept_state'))
+
+        # the occurrences of the doctors' series take slots the same way
+        for series in series_in(window, RecurringAppointment.objects.filter(doctor_id__in=list(occupied))):
+            rows.extend((series.doctor_id, time, series.accept_state) for time in series.occurrences(*window))
+
+        for doctor_id, time, state in rows:
+            slots = occupied[doctor_id][(time.date() - week).days]
+            slot = (time.hour * 60 + time.minute) // SLOT_MINUTES
+            if slot not in slots or STATE_RANK.get(state, 0) > STATE_RANK.get(slots[slot], 0):
+                slots[slot] = state
+
+    lanes = []
+    for doctor in doctors:
+        days = []
+        for slots in occupied[doctor.pk]:
+            days.append([Slot(datetime.time(slot * SLOT_MINUTES // 60, slot * SLOT_MINUTES % 60), state)
+                         for slot, state in sorted(slots.items())])
+        lanes.append(Lane(doctor, days))
+
+    return doctors, lanes
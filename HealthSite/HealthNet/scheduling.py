@@ -0,0 +1,271 @@
+"""
+    File containing the scheduling rules appointments are booked by. A doctor
+    or a patient can't have two appointments less than half an hour apart,
+    and both are checked with a single range query on the appointment time,
+    which stays on the (doctor, appointment_time) and
+    (patient, appointment_time) indexes.
+
+    Bookings are saved by book(), which checks and saves in one transaction
+    while holding locks on just the doctor and the patient, so bookings for
+    other people go ahead at the same time. The unique (doctor, slot)
+    constraint backs it up where the database can't lock rows.
+
+    Recurring series are checked too, by working out just their occurrences
+    near the time. A new series is checked by book_series() in one pass:
+    everything of its doctor and patient up to the end of the series goes
+    into an IntervalIndex, and each of its occurrences is looked up there.
+"""
+
+import bisect
+import datetime
+import random
+import time as clock
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction, IntegrityError, OperationalError
+from django.db.models import Q
+
+from .models import Appointment, RecurringAppointment
+from .recurrence import series_in
+from .windows import DateWindow
+
+# how far apart two appointments of the same doctor or patient must be
+CONFLICT_WINDOW = datetime.timedelta(minutes=30)
+
+# the parties an appointment can conflict for, in the order they're reported
+DOCTOR = 'doctor'
+PATIENT = 'patient'
+
+# how many times a booking is tried when it loses a race or a lock
+BOOKING_ATTEMPTS = 8
+
+# an appointment in the way of a booking: whose schedule it is in, and
+# whether it is at exactly the same time; an occurrence of a series has
+# no appointment id
+Conflict = namedtuple('Conflict', ['party', 'exact', 'appointment_id'])
+
+
+class SlotTaken(Exception):
+    """
+        Raised when a booking conflicts with another appointment
+    """
+
+    def __init__(self, conflict, occurrence=None):
+        super(SlotTaken, self).__init__('The time %s conflicts with appointment %s'
+                                        % (occurrence or '', conflict.appointment_id or 'of a series'))
+        self.conflict = conflict
+        # for a series, the time of the occurrence that is in the way
+        self.occurrence = occurrence
+
+
+class IntervalIndex(object):
+    """
+        The appointment times of a set of doctors and patients, each kept
+        sorted so a conflict is found with a binary search
+    """
+
+    def __init__(self):
+        self.times = {}
+
+    def add(self, party_id, time):
+        """
+            Adds an appointment time of a doctor or patient
+        :param party_id: (int) id of the doctor or patient
+        :param time: (datetime) the time
+        :return: none
+        """
+        bisect.insort(self.times.setdefault(party_id, []), time)
+
+    def conflicts(self, party_id, time):
+        """
+            Determines if a doctor or patient has an appointment less than
+            half an hour either side of a time
+        :param party_id: (int) id of the doctor or patient
+        :param time: (datetime) the time
+        :return: True if there is a conflict, False otherwise
+        """
+        times = self.times.get(party_id)
+        if not times:
+            return False
+        # the first appointment that isn't half an hour or more before the time
+        i = bisect.bisect_right(times, time - CONFLICT_WINDOW)
+        return i < len(times) and times[i] < time + CONFLICT_WINDOW
+
+
+def find_conflict(time, doctor_id, patient_id, exclude_id=None):
+    """
+        Finds an appointment of the doctor or the patient less than half an
+        hour either side of a time, including the occurrences of their
+        series. Rejected appointments give up their time, so they are left
+        out. The window is open, so appointments
+        exactly half an hour apart don't conflict. It is a plain range on the
+        appointment time, so it is correct across hours, days, months and
+        years alike.
+    :param time: (datetime) the time being booked
+    :param doctor_id: (int) id of the doctor being booked
+    :param patient_id: (int) id of the patient being booked
+    :param exclude_id: (int) id of an appointment to leave out, such as the
+                        one being edited
+    :return: (Conflict) the conflict, doctor first and then the one closest
+                to the time, or None if the time is free
+    """
+    appointments = Appointment.objects.filter(
+        Q(doctor_id=doctor_id) | Q(patient_id=patient_id),
+        appointment_time__gt=time - CONFLICT_WINDOW,
+        appointment_time__lt=time + CONFLICT_WINDOW,
+    ).exclude(accept_state=Appointment.REJECTED)
+    if exclude_id is not None:
+        appointments = appointments.exclude(pk=exclude_id)
+
+    conflicts = []
+    for appt_id, appt_doctor, appt_patient, appt_time in appointments.values_list(
+            'id', 'doctor_id', 'patient_id', 'appointment_time'):
+        party = DOCTOR if appt_doctor == doctor_id else PATIENT
+        conflicts.append((party != DOCTOR, abs(appt_time - time), Conflict(party, appt_time == time, appt_id)))
+
+    around = DateWindow(time - CONFLICT_WINDOW, time + CONFLICT_WINDOW)
+    for series in series_in(around, _series_of(doctor_id, patient_id)):
+        party = DOCTOR if series.doctor_id == doctor_id else PATIENT
+        for occurrence in series.occurrences(*around):
+            # the window is open at the start as well
+            if occurrence > around.start:
+                conflicts.append((party != DOCTOR, abs(occurrence - time), Conflict(party, occurrence == time, None)))
+
+    if not conflicts:
+        return None
+    return min(conflicts, key=lambda conflict: conflict[:2])[2]
+
+
+def _series_of(doctor_id, patient_id):
+    return RecurringAppointment.objects.filter(
+        Q(doctor_id=doctor_id) | Q(patient_id=patient_id)).exclude(accept_state=Appointment.REJECTED)
+
+
+def _lock(*user_ids):
+    # always locked in the same order, so two bookings can't deadlock
+    list(User.objects.select_for_update().filter(pk__in=user_ids).order_by('pk').values_list('pk', flat=True))
+
+
+def series_end(series):
+    """
+        Returns how far a series needs checking: to the end of its last day,
+        or as far ahead as series are checked if it doesn't end
+    :param series: (RecurringAppointment) the series
+    :return: (datetime) the end, not included
+    """
+    # series that run to the end of the calendar are checked as far as it goes
+    last = datetime.datetime.max - CONFLICT_WINDOW
+    try:
+        if series.until is not None:
+            end = datetime.datetime.combine(series.until, datetime.time.min) + datetime.timedelta(days=1)
+        else:
+            end = series.start + datetime.timedelta(days=settings.HEALTHNET_SERIES_HORIZON_DAYS)
+    except OverflowError:
+        return last
+    return min(end, last)
+
+
+def find_series_conflict(series):
+    """
+        Finds the first occurrence of a series that comes less than half an
+        hour from another appointment, or an occurrence of another series,
+        of its doctor or patient. The appointments and the other series'
+        occurrences up to the end of the series are read once into an
+        IntervalIndex, and then the series' own occurrences are looked up in
+        it one after another, rather than running a query for each of them.
+    :param series: (RecurringAppointment) the series, saved or not
+    :return: (tuple) the time of the occurrence and its Conflict, doctor
+                first, or None if every occurrence is free
+    """
+    end = series_end(series)
+    window = DateWindow(series.start - CONFLICT_WINDOW, end + CONFLICT_WINDOW)
+    index = IntervalIndex()
+
+    for appt_doctor, appt_patient, appt_time in Appointment.objects.filter(
+            Q(doctor_id=series.doctor_id) | Q(patient_id=series.patient_id),
+            appointment_time__gt=window.start, appointment_time__lt=window.end,
+    ).exclude(accept_state=Appointment.REJECTED).order_by('appointment_time').values_list(
+            'doctor_id', 'patient_id', 'appointment_time'):
+        index.add(appt_doctor, appt_time)
+        index.add(appt_patient, appt_time)
+
+    others = series_in(window, _series_of(series.doctor_id, series.patient_id))
+    if series.pk is not None:
+        others = others.exclude(pk=series.pk)
+    for other in others:
+        for occurrence in other.occurrences(*window):
+            index.add(other.doctor_id, occurrence)
+            index.add(other.patient_id, occurrence)
+
+    # a series that isn't saved yet has nothing skipped
+    skipped = None if series.pk is not None else set()
+    for occurrence in series.occurrences(series.start, end, skipped):
+        if index.conflicts(series.doctor_id, occurrence):
+            return occurrence, Conflict(DOCTOR, occurrence in index.times[series.doctor_id], None)
+        if index.conflicts(series.patient_id, occurrence):
+            return occurrence, Conflict(PATIENT, occurrence in index.times[series.patient_id], None)
+    return None
+
+
+def book_series(series):
+    """
+        Saves a recurring series, new or changed, unless one of its
+        occurrences conflicts with the doctor's or the patient's other
+        appointments. It is checked and saved under the same locks as a
+        single booking.
+    :param series: (RecurringAppointment) the series, not yet saved
+    :return: (RecurringAppointment) the saved series
+    :raises SlotTaken: if an occurrence conflicts
+    """
+    for attempt in range(BOOKING_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                _lock(series.doctor_id, series.patient_id)
+
+                if series.accept_state != Appointment.REJECTED:
+                    found = find_series_conflict(series)
+                    if found is not None:
+                        raise SlotTaken(found[1], occurrence=found[0])
+
+                series.save()
+            return series
+
+        except OperationalError:
+            if attempt == BOOKING_ATTEMPTS - 1:
+                raise
+            clock.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+
+def book(appointment):
+    """
+        Saves an appointment, new or changed, unless the doctor or the
+        patient has another appointment less than half an hour from it. The
+        check and the save happen in one transaction that locks the doctor's
+        and the patient's rows, so a booking racing for the same time waits
+        and then sees this one. Bookings that lose a race on the slot
+        constraint, or a lock, are tried again.
+    :param appointment: (Appointment) the appointment, not yet saved
+    :return: (Appointment) the saved appointment
+    :raises SlotTaken: if the time conflicts with another appointment
+    """
+    for attempt in range(BOOKING_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                _lock(appointment.doctor_id, appointment.patient_id)
+
+                if appointment.accept_state != Appointment.REJECTED:
+                    conflict = find_conflict(appointment.appointment_time, appointment.doctor_id,
+                                             appointment.patient_id, exclude_id=appointment.pk)
+                    if conflict is not None:
+                        raise SlotTaken(conflict)
+
+                appointment.save()
+            return appointment
+
+        except (IntegrityError, OperationalError):
+            if attempt == BOOKING_ATTEMPTS - 1:
+                raise
+            # back off a little, so the bookings that collided don't collide again
+            clock.sleep(random.uniform(0, 0.01 * 2 ** attempt))
@@ -0,0 +1,126 @@
+"""
+    File containing the signal receivers used by HealthNet. They are connected
+    when the app is ready (see apps.py). Saves made while loading fixtures
+    (raw) are left alone, since the fixtures hold whatever they need.
+"""
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Patient, Doctor, Nurse, HospitalAdmin, UserRoleIndex, Appointment, Message, TransferRequest, \
+    TransferRequestReply, LogEntry, RecurringAppointment, SkippedOccurrence
+from .cache_versions import bump, user_scope, appointment_scopes, LOG_SCOPE
+
+
+@receiver(post_save, sender=Patient)
+def index_patient(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    UserRoleIndex.record(instance.pk, UserRoleIndex.PATIENT, instance.hospital_id)
+
+
+@receiver(post_save, sender=Doctor)
+def index_doctor(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    UserRoleIndex.record(instance.pk, UserRoleIndex.DOCTOR, instance.hospital_id)
+
+
+@receiver(post_save, sender=Nurse)
+def index_nurse(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    UserRoleIndex.record(instance.pk, UserRoleIndex.NURSE, instance.hospital_id)
+
+
+@receiver(post_save, sender=HospitalAdmin)
+def index_admin(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    UserRoleIndex.record(instance.pk, UserRoleIndex.ADMIN, instance.hptal_id)
+
+
+@receiver(post_delete, sender=Patient)
+@receiver(post_delete, sender=Doctor)
+@receiver(post_delete, sender=Nurse)
+@receiver(post_delete, sender=HospitalAdmin)
+def unindex_user(sender, instance, **kwargs):
+    UserRoleIndex.objects.filter(user_id=instance.pk).delete()
+
+
+# the receivers below bump the cache versions of whoever's dashboard or calendar
+# shows the saved or deleted object, so their cached copy is built again
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def appointment_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    owners = {(instance.patient_id, instance.doctor_id)}
+    # an appointment moved to another patient or doctor is gone from the old
+    # ones' dashboards and calendars as well
+    loaded = getattr(instance, '_loaded_owners', None)
+    if loaded is not None and None not in loaded:
+        owners.add(loaded)
+    instance._loaded_owners = (instance.patient_id, instance.doctor_id)
+
+    hospitals = dict(Doctor.objects.filter(pk__in={doctor_id for _, doctor_id in owners}).values_list(
+        'pk', 'hospital_id'))
+    scopes = set()
+    for patient_id, doctor_id in owners:
+        scopes.update(appointment_scopes(patient_id, doctor_id, hospitals.get(doctor_id)))
+    bump(*scopes)
+
+
+@receiver(post_save, sender=RecurringAppointment)
+@receiver(post_delete, sender=RecurringAppointment)
+def series_changed(sender, instance, raw=False, **kwargs):
+    appointment_changed(sender, instance, raw)
+
+
+@receiver(post_save, sender=SkippedOccurrence)
+@receiver(post_delete, sender=SkippedOccurrence)
+def skipped_occurrence_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # a series deleted along with its skips bumps the caches itself
+    series = RecurringAppointment.objects.filter(pk=instance.series_id).values_list(
+        'patient_id', 'doctor_id', 'doctor__hospital_id').first()
+    if series is not None:
+        bump(*appointment_scopes(*series))
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def message_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    bump(user_scope(instance.receiver_id))
+
+
+@receiver(post_save, sender=TransferRequest)
+@receiver(post_delete, sender=TransferRequest)
+def transfer_request_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    bump(user_scope(instance.receiving_admin_id), user_scope(instance.requester_id))
+
+
+@receiver(post_save, sender=TransferRequestReply)
+@receiver(post_delete, sender=TransferRequestReply)
+def transfer_reply_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # the reply decides whether the request is still pending for its admin
+    admin_id = TransferRequest.objects.filter(
+        pk=instance.transfer_request_id).values_list('receiving_admin_id', flat=True).first()
+    bump(user_scope(instance.receiver_id), user_scope(admin_id) if admin_id is not None else None)
+
+
+@receiver(post_save, sender=LogEntry)
+@receiver(post_delete, sender=LogEntry)
+def log_entry_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    bump(LOG_SCOPE)
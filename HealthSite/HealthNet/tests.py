@@ -12,12 +12,45 @@
 """
 
 
-from django.test import TestCase
-from .models import Patient, Appointment, Doctor
-from .forms import CreateAppointmentForm
-from .calendar import Month
+from django.apps import apps as django_apps
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core import serializers
+from django.core.management import call_command
+from django.db import connection, transaction, IntegrityError
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from .models import Patient, Appointment, Doctor, Nurse, HospitalAdmin, Hospital, TransferRequest, UserRoleIndex, \
+    Prescription, Message, TransferRequestReply, LogEntry, RecurringAppointment, SkippedOccurrence, Conversation, \
+    CalendarFeed
+from .forms import CreateAppointmentForm, EditAppointmentForm
+from .calendar import Month, month_grid, month_days, year_grid, ApptCalendar, DoctorCalendar, summarize_days, \
+    day_status_class, PENDING_DAY, FILLED_DAY, REJECTED_DAY
+from .roles import Role, resolve_role, get_role
+from .middleware import RoleMiddleware
+from .context_processors import healthnet_role
+from .dashboard import upcoming_appointments, pending_transfer_requests, recent_log_entries
+from .ical import feed_token, feed_window, feed_appointments, content_line
+from .schedule import schedule_lanes, parse_week
+from .scheduling import find_conflict, find_series_conflict, book, SlotTaken, IntervalIndex, DOCTOR, PATIENT
+from .availability import free_slots, day_slots, sweep, parse_days
+from .appointment_import import ImportFileError, import_appointments, read_rows, guess_format, CSV, JSON
+from .cache_versions import get_versions, calendar_scope, LOG_SCOPE
+from .triage import triage, ACCEPT, REJECT
+from .messaging import conversations_of, thread, unread_count, mark_read
+from .windows import DateWindow, week_start, is_valid_day, is_valid_month
 from django.utils import timezone
 import datetime
+import importlib
+import io
+import json
+import os
+import tempfile
+import threading
+import timeit
+import re
 
 class AppointmentTests(TestCase):
 
@@ -110,6 +143,768 @@ class AppointmentFormTests(TestCase):
         # make sure that the validation returns false
         self.assertEqual(apptForm.is_valid(), False)
 
+class SchedulingTests(TestCase):
+    """
+        Class dedicated to testing the half hour conflict check shared by the
+        appointment forms
+    """
+
+    def setUp(self):
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.other_doctor = make_doctor(self.hospital, "otherdoctor")
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.other_patient = make_patient(self.hospital, self.doctor, "otherpatient")
+
+    def book(self, time, doctor=None, patient=None):
+        return Appointment.objects.create(doctor=doctor or self.doctor, patient=patient or self.patient,
+                                          reason="Checkup", appointment_time=time)
+
+    def conflict(self, time, doctor=None, patient=None, exclude_id=None):
+        doctor = doctor or self.other_doctor
+        patient = patient or self.other_patient
+        return find_conflict(time, doctor.pk, patient.pk, exclude_id)
+
+    def test_one_query(self):
+        # one for the appointments and one for the recurring series
+        self.book(datetime.datetime(2018, 3, 5, 9, 0))
+        with self.assertNumQueries(2):
+            self.conflict(datetime.datetime(2018, 3, 5, 9, 15), doctor=self.doctor)
+
+    def test_exact_and_near(self):
+        appointment = self.book(datetime.datetime(2018, 3, 5, 9, 0))
+
+        conflict = self.conflict(datetime.datetime(2018, 3, 5, 9, 0), doctor=self.doctor)
+        self.assertEqual(conflict, (DOCTOR, True, appointment.pk))
+        conflict = self.conflict(datetime.datetime(2018, 3, 5, 8, 31), patient=self.patient)
+        self.assertEqual(conflict, (PATIENT, False, appointment.pk))
+
+    def test_half_an_hour_apart_is_free(self):
+        self.book(datetime.datetime(2018, 3, 5, 9, 0))
+        self.assertIsNone(self.conflict(datetime.datetime(2018, 3, 5, 9, 30), doctor=self.doctor))
+        self.assertIsNone(self.conflict(datetime.datetime(2018, 3, 5, 8, 30), doctor=self.doctor))
+
+    def test_hour_boundary(self):
+        self.book(datetime.datetime(2018, 3, 5, 9, 45))
+        self.assertIsNotNone(self.conflict(datetime.datetime(2018, 3, 5, 10, 10), doctor=self.doctor))
+        self.assertIsNotNone(self.conflict(datetime.datetime(2018, 3, 5, 10, 14), doctor=self.doctor))
+        self.assertIsNone(self.conflict(datetime.datetime(2018, 3, 5, 10, 15), doctor=self.doctor))
+
+    def test_month_boundary(self):
+        self.book(datetime.datetime(2018, 3, 31, 23, 50))
+        self.assertIsNotNone(self.conflict(datetime.datetime(2018, 4, 1, 0, 10), doctor=self.doctor))
+        self.assertIsNotNone(self.conflict(datetime.datetime(2018, 4, 1, 0, 10), patient=self.patient))
+
+        self.book(datetime.datetime(2018, 12, 31, 23, 45))
+        self.assertIsNotNone(self.conflict(datetime.datetime(2019, 1, 1, 0, 0), doctor=self.doctor))
+
+    def test_same_day_of_another_month_is_free(self):
+        self.book(datetime.datetime(2018, 3, 5, 9, 0))
+        self.assertIsNone(self.conflict(datetime.datetime(2018, 4, 5, 9, 0), doctor=self.doctor))
+
+    def test_other_people_are_free(self):
+        self.book(datetime.datetime(2018, 3, 5, 9, 0))
+        self.assertIsNone(self.conflict(datetime.datetime(2018, 3, 5, 9, 0)))
+
+    def test_doctor_reported_first(self):
+        self.book(datetime.datetime(2018, 3, 5, 9, 0), doctor=self.other_doctor)
+        doctors = self.book(datetime.datetime(2018, 3, 5, 9, 20), patient=self.other_patient)
+
+        conflict = self.conflict(datetime.datetime(2018, 3, 5, 9, 0), doctor=self.doctor, patient=self.patient)
+        self.assertEqual(conflict, (DOCTOR, False, doctors.pk))
+
+    def test_exclude(self):
+        appointment = self.book(datetime.datetime(2018, 3, 5, 9, 0))
+        self.assertIsNone(self.conflict(datetime.datetime(2018, 3, 5, 9, 10), doctor=self.doctor,
+                                        exclude_id=appointment.pk))
+
+    def test_forms(self):
+        time = (timezone.now() + datetime.timedelta(days=5)).replace(hour=9, minute=0, second=0, microsecond=0)
+        appointment = self.book(time)
+        data = {'doctor': self.doctor.pk, 'patient': self.other_patient.pk, 'reason': "Test",
+                'appointment_time': (time + datetime.timedelta(minutes=20)).strftime('%Y-%m-%d %H:%M:%S')}
+
+        form = CreateAppointmentForm(data)
+        self.assertFalse(form.is_valid())
+        self.assertIn('The doctor is not available at this time. Please choose another time',
+                      form.errors['appointment_time'])
+
+        # an appointment doesn't conflict with itself when it is moved
+        data['patient'] = self.patient.pk
+        self.assertTrue(EditAppointmentForm(data, instance=appointment).is_valid())
+
+
+class BookingTests(TestCase):
+    """
+        Class dedicated to testing appointment slots and the booking service
+    """
+
+    def setUp(self):
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.other_patient = make_patient(self.hospital, self.doctor, "otherpatient")
+
+    def appointment(self, hour, minute, patient=None):
+        return Appointment(doctor=self.doctor, patient=patient or self.patient, reason="Checkup",
+                           appointment_time=datetime.datetime(2018, 3, 5, hour, minute, 12))
+
+    def test_slot_follows_time_and_state(self):
+        appointment = self.appointment(9, 45)
+        appointment.save()
+        self.assertEqual(appointment.slot, datetime.datetime(2018, 3, 5, 9, 30))
+
+        appointment.rejectAppointment(commit=True)
+        self.assertIsNone(Appointment.objects.get(pk=appointment.pk).slot)
+
+        appointment.accept_state = Appointment.PENDING
+        appointment.save(update_fields=['accept_state'])
+        self.assertEqual(Appointment.objects.get(pk=appointment.pk).slot, datetime.datetime(2018, 3, 5, 9, 30))
+
+    def test_slots_are_unique(self):
+        self.appointment(9, 0).save()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self.appointment(9, 20, self.other_patient).save()
+
+        # rejected appointments don't hold their slot
+        rejected = self.appointment(10, 0)
+        rejected.rejectAppointment(commit=True)
+        self.appointment(10, 0, self.other_patient).save()
+
+    def test_book(self):
+        book(self.appointment(9, 0))
+        with self.assertRaises(SlotTaken) as taken:
+            book(self.appointment(9, 20, self.other_patient))
+        self.assertEqual(taken.exception.conflict.party, DOCTOR)
+
+        book(self.appointment(9, 30, self.other_patient))
+        self.assertEqual(Appointment.objects.count(), 2)
+
+    def test_moving_an_appointment(self):
+        appointment = book(self.appointment(9, 0))
+        appointment.appointment_time += datetime.timedelta(minutes=10)
+        book(appointment)
+        self.assertEqual(Appointment.objects.get().slot, datetime.datetime(2018, 3, 5, 9, 0))
+
+    def test_backfill(self):
+        book(self.appointment(9, 0))
+        rejected = self.appointment(11, 0)
+        rejected.rejectAppointment(commit=True)
+        Appointment.objects.update(slot=None)
+
+        migration = importlib.import_module('HealthNet.migrations.0028_appointment_slot')
+        migration.fill_slots(django_apps, None)
+
+        self.assertEqual(sorted(Appointment.objects.values_list('slot', flat=True), key=str),
+                         [datetime.datetime(2018, 3, 5, 9, 0), None])
+
+    def test_backfill_leaves_double_bookings_without_a_slot(self):
+        first = book(self.appointment(9, 0))
+        Appointment.objects.update(slot=None)
+        # booked before slots were checked
+        second = self.appointment(9, 10, self.other_patient)
+        Appointment.objects.bulk_create([second])
+
+        migration = importlib.import_module('HealthNet.migrations.0028_appointment_slot')
+        with self.assertLogs(migration.logger, 'WARNING'):
+            migration.fill_slots(django_apps, None)
+        self.assertEqual(list(Appointment.objects.order_by('pk').values_list('accept_state', 'slot')),
+                         [(Appointment.PENDING, first.slot), (Appointment.PENDING, None)])
+
+        out = io.StringIO()
+        call_command('double_bookings', stdout=out)
+        self.assertIn('with Dr. Doc doctor at 2018-03-05 09:10 (Pending)', out.getvalue())
+        self.assertIn('1 double booked appointment', out.getvalue())
+
+        # booking it again turns it down while the time is still taken
+        second = Appointment.objects.get(slot__isnull=True)
+        self.assertRaises(SlotTaken, book, second)
+
+    def test_accepting_a_taken_time(self):
+        rejected = self.appointment(9, 0)
+        rejected.rejectAppointment(commit=True)
+        book(self.appointment(9, 0, self.other_patient))
+
+        self.client.login(username="doctor", password="password")
+        response = self.client.get(reverse('accept_appointment', args=[rejected.pk]), follow=True)
+        self.assertRedirects(response, reverse('day_view', args=[5, 3, 2018]))
+        self.assertContains(response, "the doctor has another appointment")
+        self.assertEqual(Appointment.objects.get(pk=rejected.pk).accept_state, Appointment.REJECTED)
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    """
+        Class dedicated to testing that bookings made at the same time never
+        double book a doctor
+    """
+
+    THREADS = 8
+    BOOKINGS_PER_THREAD = 15
+
+    def setUp(self):
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patients = [make_patient(self.hospital, self.doctor, "patient%d" % i) for i in range(self.THREADS)]
+
+    def test_no_double_bookings(self):
+        start = datetime.datetime(2018, 3, 5, 9, 0)
+        # every thread goes after the same few times, most of them conflicting
+        times = [start + datetime.timedelta(minutes=10 * i) for i in range(12)]
+        outcomes = []
+
+        def patient_books(patient):
+            booked = taken = 0
+            try:
+                for i in range(self.BOOKINGS_PER_THREAD):
+                    appointment = Appointment(doctor=self.doctor, patient=patient, reason="Checkup",
+                                              appointment_time=times[(i * 7 + patient.pk) % len(times)])
+                    try:
+                        book(appointment)
+                        booked += 1
+                    except SlotTaken:
+                        taken += 1
+            finally:
+                connection.close()
+            outcomes.append((booked, taken))
+
+        threads = [threading.Thread(target=patient_books, args=(patient,)) for patient in self.patients]
+        began = timeit.default_timer()
+        for worker in threads:
+            worker.start()
+        for worker in threads:
+            worker.join()
+        elapsed = timeit.default_timer() - began
+
+        booked = sum(outcome[0] for outcome in outcomes)
+        self.assertEqual(len(outcomes), self.THREADS)
+        self.assertEqual(booked + sum(outcome[1] for outcome in outcomes), self.THREADS * self.BOOKINGS_PER_THREAD)
+
+        booked_times = sorted(Appointment.objects.filter(doctor=self.doctor).values_list('appointment_time', flat=True))
+        self.assertEqual(len(booked_times), booked)
+        for earlier, later in zip(booked_times, booked_times[1:]):
+            self.assertGreaterEqual(later - earlier, datetime.timedelta(minutes=30))
+
+        print('\n%d bookings attempted by %d threads: %d booked, %.0f bookings/s'
+              % (self.THREADS * self.BOOKINGS_PER_THREAD, self.THREADS, booked,
+                 self.THREADS * self.BOOKINGS_PER_THREAD / elapsed))
+
+
+class AppointmentImportTests(TestCase):
+    """
+        Class dedicated to testing the bulk appointment import
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.other_doctor = make_doctor(self.hospital, "otherdoctor")
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.other_patient = make_patient(self.hospital, self.doctor, "otherpatient")
+        self.admin = make_admin(self.hospital)
+        self.day = datetime.date.today() + datetime.timedelta(days=3)
+
+    def at(self, hour, minute=0):
+        return datetime.datetime.combine(self.day, datetime.time(hour, minute))
+
+    def row(self, hour, minute=0, doctor="doctor", patient="patient", reason="Checkup"):
+        return {'doctor': doctor, 'patient': patient, 'reason': reason,
+                'appointment_time': self.at(hour, minute).strftime('%Y-%m-%d %H:%M')}
+
+    def test_interval_index(self):
+        index = IntervalIndex()
+        index.add(1, self.at(9))
+        index.add(1, self.at(11))
+        self.assertTrue(index.conflicts(1, self.at(9, 29)))
+        self.assertTrue(index.conflicts(1, self.at(10, 31)))
+        self.assertFalse(index.conflicts(1, self.at(9, 30)))
+        self.assertFalse(index.conflicts(1, self.at(10, 30)))
+        self.assertFalse(index.conflicts(2, self.at(9)))
+
+    def test_read_rows(self):
+        rows = read_rows('doctor,patient,appointment_time,reason\ndoctor,patient,2018-03-05 09:00,Checkup\n', CSV)
+        self.assertEqual(rows[0]['appointment_time'], '2018-03-05 09:00')
+        self.assertEqual(read_rows('{"appointments": [{"doctor": "doctor"}]}', JSON), [{'doctor': 'doctor'}])
+
+        with self.assertRaises(ImportFileError):
+            read_rows('doctor,patient\n', CSV)
+        with self.assertRaises(ImportFileError):
+            read_rows('{"doctor": ', JSON)
+        self.assertEqual(guess_format('Schedule.CSV'), CSV)
+        self.assertIsNone(guess_format('schedule.xlsx'))
+
+    def test_import(self):
+        Appointment.objects.create(doctor=self.doctor, patient=self.other_patient, reason="Booked",
+                                   appointment_time=self.at(9))
+        version = get_versions(calendar_scope('patient', self.patient.pk))
+
+        report = import_appointments([
+            self.row(9, 20),                                            # the doctor is booked at 9
+            self.row(10),
+            self.row(10, 15, doctor="otherdoctor"),                     # the patient is booked at 10 above
+            self.row(10, 30, doctor=str(self.other_doctor.pk)),         # by id
+            self.row(11, doctor="nobody"),
+            self.row(11, patient="nobody"),
+            {'doctor': "doctor", 'patient': "patient", 'appointment_time': "tomorrow", 'reason': "Checkup"},
+            {'doctor': "doctor", 'patient': "patient", 'reason': "Checkup"},
+            dict(self.row(12), appointment_time="2001-01-01 09:00"),
+        ])
+
+        self.assertEqual([(a.doctor_id, a.appointment_time) for a in report.created],
+                         [(self.doctor.pk, self.at(10)), (self.other_doctor.pk, self.at(10, 30))])
+        self.assertEqual([number for number, _ in report.rejected], [1, 3, 5, 6, 7, 8, 9])
+        self.assertEqual(report.rejected[0][1], 'The doctor is not available at this time')
+        self.assertEqual(report.rejected[6][1], 'Appointment time is in the past')
+
+        self.assertEqual(Appointment.objects.filter(patient=self.patient).count(), 2)
+        self.assertEqual(Appointment.objects.get(patient=self.patient, doctor=self.doctor).slot, self.at(10))
+        self.assertNotEqual(get_versions(calendar_scope('patient', self.patient.pk)), version)
+
+    def test_hospital_only(self):
+        faraway = make_doctor(make_hospital("Rochester General"), "faraway")
+        report = import_appointments([self.row(9, doctor="faraway")], hospital_id=self.hospital.pk)
+        self.assertEqual(report.rejected, [(1, 'No doctor faraway')])
+        self.assertFalse(Appointment.objects.filter(doctor=faraway).exists())
+
+    def test_dry_run(self):
+        report = import_appointments([self.row(9), self.row(9, 10)], dry_run=True)
+        self.assertEqual((len(report.created), len(report.rejected)), (1, 1))
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_queries_do_not_grow(self):
+        def queries(count):
+            rows = [self.row(9 + i // 2, 30 * (i % 2)) for i in range(count)]
+            with CaptureQueriesContext(connection) as captured:
+                report = import_appointments(rows, dry_run=True)
+            self.assertEqual(len(report.created), count)
+            return len(captured)
+
+        self.assertEqual(queries(4), queries(20))
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as batch:
+            json.dump([self.row(9), self.row(9, 10)], batch)
+        try:
+            out, err = io.StringIO(), io.StringIO()
+            call_command('import_appointments', batch.name, stdout=out, stderr=err)
+        finally:
+            os.remove(batch.name)
+
+        self.assertIn('1 of 2 appointments booked, 1 turned down', out.getvalue())
+        self.assertIn('Row 2: The doctor is not available at this time', err.getvalue())
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_upload(self):
+        batch = SimpleUploadedFile('schedule.csv', ('doctor,patient,appointment_time,reason\n'
+                                                    'doctor,patient,%s,Checkup\n' % self.row(9)['appointment_time']
+                                                    ).encode())
+        self.client.login(username="admin", password="password")
+        response = self.client.post(reverse('import_appointments'), {'batch': batch})
+
+        self.assertContains(response, '1 of 1 appointments booked')
+        self.assertEqual(Appointment.objects.count(), 1)
+        self.assertTrue(LogEntry.objects.filter(action="Appointment Import").exists())
+
+        self.client.login(username="doctor", password="password")
+        response = self.client.get(reverse('import_appointments'))
+        self.assertTemplateUsed(response, 'error.html')
+
+
+class RecurrenceTests(TestCase):
+    """
+        Class dedicated to testing recurring series, which are expanded only
+        for the window being looked at
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.other_patient = make_patient(self.hospital, self.doctor, "other")
+        self.nurse = make_nurse(self.hospital)
+        # mondays at 9:00 from the 5th of March 2018
+        self.series = RecurringAppointment.objects.create(
+            doctor=self.doctor, patient=self.patient, reason="Physio", frequency=RecurringAppointment.WEEKLY,
+            start=datetime.datetime(2018, 3, 5, 9, 0))
+
+    def times(self, series, start, end):
+        return list(series.occurrences(start, end))
+
+    def test_weekly(self):
+        self.assertEqual(self.times(self.series, datetime.datetime(2018, 3, 6), datetime.datetime(2018, 3, 27)),
+                         [datetime.datetime(2018, 3, 12, 9, 0), datetime.datetime(2018, 3, 19, 9, 0),
+                          datetime.datetime(2018, 3, 26, 9, 0)])
+        # far ahead, the first occurrence is worked out rather than stepped to
+        time = datetime.datetime(2038, 3, 1, 12, 0)
+        n = self.series.first_occurrence_from(time)
+        self.assertLess(self.series.occurrence_at(n - 1), time)
+        self.assertGreaterEqual(self.series.occurrence_at(n), time)
+
+    def test_monthly_falls_back_to_the_last_day(self):
+        series = RecurringAppointment(start=datetime.datetime(2018, 1, 31, 9, 0), frequency=RecurringAppointment.MONTHLY,
+                                      interval=1)
+        self.assertEqual([time.date() for time in series.occurrences(
+            datetime.datetime(2018, 1, 1), datetime.datetime(2018, 5, 1), skipped=set())],
+            [datetime.date(2018, 1, 31), datetime.date(2018, 2, 28), datetime.date(2018, 3, 31),
+             datetime.date(2018, 4, 30)])
+
+    def test_series_end_with_the_calendar(self):
+        for frequency, interval in ((RecurringAppointment.WEEKLY, 6), (RecurringAppointment.MONTHLY, 12)):
+            series = RecurringAppointment(start=datetime.datetime(9999, 11, 25, 9, 0), frequency=frequency,
+                                          interval=interval)
+            self.assertEqual(list(series.occurrences(datetime.datetime(9999, 11, 1), datetime.datetime.max,
+                                                     skipped=set())), [datetime.datetime(9999, 11, 25, 9, 0)])
+
+        series = RecurringAppointment(doctor=self.doctor, patient=self.patient, reason="Physio",
+                                      frequency=RecurringAppointment.WEEKLY, start=datetime.datetime(9999, 6, 7, 14, 0))
+        self.assertIsNone(find_series_conflict(series))
+
+    def test_until_and_skipped(self):
+        self.series.until = datetime.date(2018, 3, 26)
+        self.series.save()
+        SkippedOccurrence.objects.create(series=self.series, occurrence=datetime.datetime(2018, 3, 12, 9, 0))
+        self.assertEqual(self.times(self.series, datetime.datetime(2018, 3, 1), datetime.datetime(2019, 1, 1)),
+                         [datetime.datetime(2018, 3, 5, 9, 0), datetime.datetime(2018, 3, 19, 9, 0),
+                          datetime.datetime(2018, 3, 26, 9, 0)])
+
+    def test_single_booking_conflicts_with_an_occurrence(self):
+        self.assertEqual(find_conflict(datetime.datetime(2018, 3, 19, 9, 15), self.doctor.pk, self.other_patient.pk),
+                         (DOCTOR, False, None))
+        self.assertIsNone(find_conflict(datetime.datetime(2018, 3, 19, 9, 30), self.doctor.pk, self.other_patient.pk))
+
+    def test_series_checked_in_one_pass(self):
+        Appointment.objects.create(doctor=self.doctor, patient=self.other_patient, reason="Checkup",
+                                   appointment_time=datetime.datetime(2018, 9, 3, 10, 10))
+        series = RecurringAppointment(doctor=self.doctor, patient=self.other_patient, reason="Checkup",
+                                      frequency=RecurringAppointment.WEEKLY, start=datetime.datetime(2018, 3, 6, 10, 0))
+        with self.assertNumQueries(3):
+            self.assertIsNone(find_series_conflict(series))
+
+        # a month later, the other patient's tuesdays meet the first series' mondays
+        series.start = datetime.datetime(2018, 4, 2, 10, 0)
+        self.assertEqual(find_series_conflict(series), (datetime.datetime(2018, 9, 3, 10, 0), (DOCTOR, False, None)))
+        series.start = datetime.datetime(2018, 4, 2, 9, 0)
+        self.assertEqual(find_series_conflict(series), (datetime.datetime(2018, 4, 2, 9, 0), (DOCTOR, True, None)))
+
+        series.start = datetime.datetime(2018, 4, 2, 9, 0)
+        series.until = datetime.date(2018, 4, 1)
+        self.assertIsNone(find_series_conflict(series))
+
+    def test_book_series_with_the_form(self):
+        start = (timezone.now() + datetime.timedelta(days=2)).replace(hour=14, minute=0, second=0, microsecond=0)
+        form = CreateAppointmentForm({'doctor': self.doctor.pk, 'patient': self.other_patient.pk, 'reason': "Checkup",
+                                      'appointment_time': start.strftime('%Y-%m-%d %H:%M'),
+                                      'repeat': RecurringAppointment.MONTHLY, 'repeat_every': 2})
+        self.assertTrue(form.is_valid() and form.book())
+        series = RecurringAppointment.objects.get(patient=self.other_patient)
+        self.assertEqual((series.frequency, series.interval, series.start), (RecurringAppointment.MONTHLY, 2, start))
+        self.assertFalse(Appointment.objects.filter(patient=self.other_patient).exists())
+
+        # a single booking on one of its occurrences is turned down
+        form = CreateAppointmentForm({'doctor': self.doctor.pk, 'patient': self.patient.pk, 'reason': "Checkup",
+                                      'appointment_time': series.occurrence_at(3).strftime('%Y-%m-%d %H:%M')})
+        self.assertFalse(form.is_valid())
+        self.assertIn('appointment_time', form.errors)
+
+    def test_calendar_and_day(self):
+        self.client.login(username="patient", password="password")
+        data = self.client.get(reverse('calendar_month_json', args=[3, 2018])).json()
+        self.assertEqual(data['status'], {'5': PENDING_DAY, '12': PENDING_DAY, '19': PENDING_DAY, '26': PENDING_DAY})
+
+        data = self.client.get(reverse('calendar_day_json', args=[12, 3, 2018])).json()
+        self.assertEqual([(row['id'], row['series'], row['time']) for row in data['appointments']],
+                         [(None, self.series.pk, '09:00')])
+
+        response = self.client.get(reverse('day_view', args=[12, 3, 2018]))
+        self.assertContains(response, reverse('skip_occurrence', args=[self.series.pk, '201803120900']))
+
+    def test_skip(self):
+        self.client.login(username="patient", password="password")
+        self.client.get(reverse('calendar_month_json', args=[3, 2018]))
+        url = reverse('skip_occurrence', args=[self.series.pk, '201803120900'])
+        self.assertEqual(self.client.get(url).status_code, 405)
+        response = self.client.post(url)
+        self.assertRedirects(response, reverse('day_view', args=[12, 3, 2018]))
+
+        # the skip invalidates the cached month
+        data = self.client.get(reverse('calendar_month_json', args=[3, 2018])).json()
+        self.assertNotIn('12', data['status'])
+        # a time the series doesn't fall on can't be skipped
+        response = self.client.post(reverse('skip_occurrence', args=[self.series.pk, '201803130900']))
+        self.assertEqual(response.status_code, 404)
+
+    def test_feed_merges_occurrences(self):
+        first = Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                           appointment_time=datetime.datetime(2018, 3, 6, 9, 0))
+        second = Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                            appointment_time=datetime.datetime(2018, 3, 12, 14, 0))
+        rows = feed_appointments(resolve_role(self.patient), datetime.datetime(2018, 3, 1),
+                                 datetime.datetime(2018, 3, 15))
+        self.assertEqual([row[0] for row in rows],
+                         ['series-%d-201803050900' % self.series.pk, first.pk,
+                          'series-%d-201803120900' % self.series.pk, second.pk])
+
+    def test_doctor_rejects_series(self):
+        self.client.login(username="doctor", password="password")
+        self.assertEqual(self.client.get(reverse('accept_series', args=[self.series.pk])).status_code, 405)
+        self.client.post(reverse('accept_series', args=[self.series.pk]))
+        self.series.refresh_from_db()
+        self.assertEqual(self.series.accept_state, Appointment.ACCEPTED)
+
+        self.client.post(reverse('reject_series', args=[self.series.pk]))
+        data = self.client.get(reverse('calendar_month_json', args=[3, 2018])).json()
+        self.assertEqual(data['status'], {})
+        self.assertIsNone(find_conflict(datetime.datetime(2018, 3, 19, 9, 0), self.doctor.pk, self.other_patient.pk))
+
+    def test_accepting_a_rejected_series_after_its_time_is_taken(self):
+        self.client.login(username="doctor", password="password")
+        self.client.post(reverse('reject_series', args=[self.series.pk]))
+        Appointment.objects.create(doctor=self.doctor, patient=self.other_patient, reason="Checkup",
+                                   appointment_time=datetime.datetime(2018, 3, 19, 9, 0))
+
+        response = self.client.post(reverse('accept_series', args=[self.series.pk]), follow=True)
+        self.assertRedirects(response, reverse('day_view', args=[19, 3, 2018]))
+        self.assertContains(response, "on 2018-03-19 09:00 the doctor has another appointment")
+        self.series.refresh_from_db()
+        self.assertEqual(self.series.accept_state, Appointment.REJECTED)
+
+    def test_upcoming_and_availability(self):
+        now = timezone.now()
+        self.series.start = (now + datetime.timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+        self.series.save()
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                   appointment_time=self.series.start + datetime.timedelta(days=2))
+
+        apps = upcoming_appointments(resolve_role(self.nurse), limit=3)
+        self.assertEqual([app.appointment_time for app in apps],
+                         [self.series.start, self.series.start + datetime.timedelta(days=2),
+                          self.series.start + datetime.timedelta(days=7)])
+        self.assertTrue(apps[0].is_occurrence)
+
+        day = self.series.start.date()
+        free = free_slots([self.doctor.pk], day, day + datetime.timedelta(days=1))[self.doctor.pk][day]
+        self.assertNotIn(datetime.time(10, 0), free)
+        self.assertIn(datetime.time(10, 30), free)
+
+
+class TriageTests(TestCase):
+    """
+        Class dedicated to testing that doctors can accept or reject many
+        pending appointments at once
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.other_doctor = make_doctor(self.hospital, "other_doctor")
+        self.patients = [make_patient(self.hospital, self.doctor, "patient%d" % i) for i in range(3)]
+        start = datetime.datetime(2018, 3, 5, 9, 0)
+        self.pending = [Appointment.objects.create(doctor=self.doctor, patient=patient, reason="Checkup",
+                                                   appointment_time=start + datetime.timedelta(hours=i))
+                        for i, patient in enumerate(self.patients)]
+        self.accepted = Appointment.objects.create(doctor=self.doctor, patient=self.patients[0], reason="Checkup",
+                                                   accept_state=Appointment.ACCEPTED,
+                                                   appointment_time=start + datetime.timedelta(days=1))
+        self.someone_elses = Appointment.objects.create(doctor=self.other_doctor, patient=self.patients[0],
+                                                        reason="Checkup", appointment_time=start + datetime.timedelta(days=2))
+
+    def states(self):
+        return dict(Appointment.objects.values_list('pk', 'accept_state'))
+
+    def test_one_update_and_one_insert(self):
+        ids = [appointment.pk for appointment in self.pending] + [self.accepted.pk, self.someone_elses.pk]
+        logs = LogEntry.objects.count()
+        with CaptureQueriesContext(connection) as queries:
+            changed = triage(self.doctor.pk, self.hospital.pk, ids, ACCEPT, self.doctor)
+
+        self.assertEqual(changed, 3)
+        writes = [q['sql'].split()[0] for q in queries if q['sql'].split()[0] in ('UPDATE', 'INSERT')]
+        self.assertEqual(writes, ['UPDATE', 'INSERT'])
+        self.assertEqual(LogEntry.objects.count() - logs, 3)
+
+        states = self.states()
+        self.assertTrue(all(states[appointment.pk] == Appointment.ACCEPTED for appointment in self.pending))
+        self.assertEqual(states[self.someone_elses.pk], Appointment.PENDING)
+
+        # sent again, there is nothing left to change
+        self.assertEqual(triage(self.doctor.pk, self.hospital.pk, ids, ACCEPT, self.doctor), 0)
+
+    def test_reject_frees_the_slots(self):
+        triage(self.doctor.pk, self.hospital.pk, [self.pending[0].pk], REJECT, self.doctor)
+        self.assertEqual(Appointment.objects.get(pk=self.pending[0].pk).slot, None)
+        book(Appointment(doctor=self.doctor, patient=self.patients[1], reason="Checkup",
+                         appointment_time=self.pending[0].appointment_time))
+
+    def test_caches_invalidated(self):
+        scopes = [calendar_scope('patient', self.patients[1].pk), calendar_scope('doctor', self.doctor.pk),
+                  calendar_scope('hospital', self.hospital.pk), LOG_SCOPE]
+        before = get_versions(*scopes)
+        untouched = get_versions(calendar_scope('patient', self.patients[2].pk))
+        triage(self.doctor.pk, self.hospital.pk, [self.pending[1].pk], REJECT, self.doctor)
+
+        self.assertTrue(all(old != new for old, new in zip(before, get_versions(*scopes))))
+        self.assertEqual(get_versions(calendar_scope('patient', self.patients[2].pk)), untouched)
+
+    def test_view(self):
+        self.client.login(username="doctor", password="password")
+        response = self.client.get(reverse('triage_appointments'))
+        self.assertEqual(list(response.context['appointments']), self.pending)
+
+        response = self.client.post(reverse('triage_appointments'), {
+            'action': REJECT, 'appointments': [self.pending[0].pk, self.pending[2].pk]})
+        self.assertRedirects(response, reverse('triage_appointments'))
+        states = self.states()
+        self.assertEqual([states[appointment.pk] for appointment in self.pending],
+                         [Appointment.REJECTED, Appointment.PENDING, Appointment.REJECTED])
+
+        response = self.client.post(reverse('triage_appointments'), {'action': ACCEPT, 'appointments': ['x']})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors)
+
+    def test_only_doctors(self):
+        self.client.login(username="patient0", password="password")
+        self.client.post(reverse('triage_appointments'), {'action': ACCEPT, 'appointments': [self.pending[0].pk]})
+        self.assertEqual(self.states()[self.pending[0].pk], Appointment.PENDING)
+
+
+class ConversationTests(TestCase):
+    """
+        Class dedicated to testing that messages are filed under one
+        conversation per pair of users, and that the messages pages read
+        only what they show
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        # same name as the patient, which name based conversation ids mixed up
+        self.namesake = make_patient(self.hospital, self.doctor, "namesake")
+        self.namesake.last_name = self.patient.last_name
+        self.namesake.save()
+        self.time = datetime.datetime(2018, 3, 5, 9, 0)
+
+    def send(self, sender, receiver, content, minutes=0):
+        return Message.objects.create(sender=sender, receiver=receiver, msg_content=content,
+                                      created_at=self.time + datetime.timedelta(minutes=minutes))
+
+    def test_one_conversation_per_pair(self):
+        first = self.send(self.patient, self.doctor, "Hello")
+        answer = self.send(self.doctor, self.patient, "Hi", minutes=1)
+        other = self.send(self.namesake, self.doctor, "Hello too")
+
+        self.assertEqual(first.conversation_id, answer.conversation_id)
+        self.assertNotEqual(first.conversation_id, other.conversation_id)
+        self.assertEqual(first.conversation.user_a_id, min(self.patient.pk, self.doctor.pk))
+
+    def test_newest_message_kept(self):
+        message = self.send(self.patient, self.doctor, "Second", minutes=5)
+        # a message that is older than the newest one doesn't replace it
+        self.send(self.doctor, self.patient, "First")
+        conversation = Conversation.objects.get(pk=message.conversation_id)
+        self.assertEqual((conversation.last_message_at, conversation.last_preview),
+                         (self.time + datetime.timedelta(minutes=5), "Second"))
+
+    def test_list_and_thread_are_one_query_each(self):
+        for i in range(5):
+            self.send(self.patient, self.doctor, "Message %d" % i, minutes=i)
+        self.send(self.namesake, self.doctor, "Later", minutes=10)
+        conversation_id = Message.objects.filter(sender=self.patient).first().conversation_id
+
+        with self.assertNumQueries(1):
+            conversations = conversations_of(self.doctor.pk)
+            others = [str(conversation.other_user) for conversation in conversations]
+        self.assertEqual(others, [str(self.namesake), str(self.patient)])
+
+        with self.assertNumQueries(1):
+            messages, older = thread(self.doctor.pk, conversation_id)
+            [(str(message.sender), str(message.receiver)) for message in messages]
+        self.assertEqual([message.msg_content for message in messages], ["Message %d" % i for i in range(5)])
+        self.assertIsNone(older)
+
+        # nobody else can read it
+        self.assertEqual(thread(self.namesake.pk, conversation_id), ([], None))
+
+    def test_thread_pages(self):
+        # messages sent at the same time are kept apart by their ids
+        for i in range(7):
+            self.send(self.patient, self.doctor, "Message %d" % i, minutes=i // 2)
+        conversation_id = Message.objects.first().conversation_id
+
+        pages, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                messages, cursor = thread(self.doctor.pk, conversation_id, cursor, limit=3)
+            pages.append([message.msg_content for message in messages])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [["Message 4", "Message 5", "Message 6"], ["Message 1", "Message 2", "Message 3"],
+                                 ["Message 0"]])
+
+        # a malformed cursor starts from the newest messages again
+        self.assertEqual(thread(self.doctor.pk, conversation_id, "nonsense", limit=3)[0], thread(
+            self.doctor.pk, conversation_id, limit=3)[0])
+
+    def test_view_pages(self):
+        for i in range(3):
+            self.send(self.patient, self.doctor, "Message %d" % i, minutes=i)
+        conversation_id = Message.objects.first().conversation_id
+        self.client.login(username="doctor", password="password")
+        url = reverse('view_conversation', args=[conversation_id])
+
+        with self.settings(HEALTHNET_CONVERSATION_PAGE_SIZE=2):
+            response = self.client.get(url)
+            self.assertEqual([message.msg_content for message in response.context['messages']],
+                             ["Message 1", "Message 2"])
+            self.assertContains(response, "Load older messages")
+
+            response = self.client.get(url, {'before': response.context['older']})
+            self.assertEqual([message.msg_content for message in response.context['messages']], ["Message 0"])
+            self.assertNotContains(response, "Load older messages")
+
+    def test_view(self):
+        conversation_id = self.send(self.patient, self.doctor, "Hello").conversation_id
+        self.client.login(username="doctor", password="password")
+        response = self.client.get(reverse('view_conversation', args=[conversation_id]))
+        self.assertContains(response, "Hello")
+        self.assertFalse(Message.objects.filter(receiver=self.doctor, status=False).exists())
+
+        self.client.login(username="namesake", password="password")
+        response = self.client.get(reverse('view_conversation', args=[conversation_id]))
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.get(reverse('message'))
+        self.assertEqual(list(response.context['convos']), [])
+
+    def test_unread_counters(self):
+        for i in range(3):
+            self.send(self.patient, self.doctor, "Message %d" % i, minutes=i)
+        self.send(self.doctor, self.patient, "Answer", minutes=3)
+        self.send(self.namesake, self.doctor, "Hello", minutes=4)
+
+        conversation = Conversation.objects.get(pk=Message.objects.filter(sender=self.patient).first().conversation_id)
+        self.assertEqual((conversation.unread_for(self.doctor.pk), conversation.unread_for(self.patient.pk)), (3, 1))
+        with self.assertNumQueries(1):
+            self.assertEqual(unread_count(self.doctor.pk), 4)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(mark_read(self.doctor.pk, conversation.pk), 3)
+        self.assertEqual([q['sql'].split()[0] for q in queries], ['UPDATE', 'UPDATE'])
+        self.assertEqual(unread_count(self.doctor.pk), 1)
+        self.assertEqual(unread_count(self.patient.pk), 1)
+
+    def test_navigation_bar(self):
+        self.send(self.patient, self.doctor, "Hello")
+        self.client.login(username="doctor", password="password")
+        self.assertContains(self.client.get(reverse('message')), '<span class="badge">1</span>', count=2)
+
+        self.client.get(reverse('view_conversation', args=[Message.objects.get().conversation_id]))
+        self.assertNotContains(self.client.get(reverse('message')), 'class="badge"')
+
+
 class MonthClassTests(TestCase):
     """
         Class dedicated to testing simple functions for checking the correct
@@ -221,4 +1016,1283 @@ class MonthClassTests(TestCase):
         # check that the numberation for the month starts on that day
         self.assertEqual(month1.get_days()[1], 1)  # Monday
         self.assertEqual(month2.get_days()[5], 1)  # Friday
-        self.assertEqual(month3.get_days()[6], 1)  # Saturday
\ No newline at end of file
+        self.assertEqual(month3.get_days()[6], 1)  # Saturday
+
+def make_hospital(name="Strong"):
+    """
+        Creates and saves a hospital for testing
+    """
+    return Hospital.objects.create(name=name)
+
+
+def make_doctor(hospital, username="doctor"):
+    """
+        Creates and saves a doctor for testing
+    """
+    doctor = Doctor(username=username, first_name="Doc", last_name=username, hospital=hospital)
+    doctor.set_password("password")
+    doctor.save()
+    return doctor
+
+
+def make_patient(hospital, doctor, username="patient"):
+    """
+        Creates and saves a patient for testing
+    """
+    patient = Patient(username=username, first_name="Pat", last_name=username, hospital=hospital,
+                      patient_doctor=doctor)
+    patient.set_password("password")
+    patient.save()
+    return patient
+
+
+def make_nurse(hospital, username="nurse"):
+    """
+        Creates and saves a nurse for testing
+    """
+    nurse = Nurse(username=username, first_name="Nur", last_name=username, hospital=hospital)
+    nurse.set_password("password")
+    nurse.save()
+    return nurse
+
+
+def make_admin(hospital, username="admin"):
+    """
+        Creates and saves a hospital administrator for testing
+    """
+    admin = HospitalAdmin(username=username, first_name="Adm", last_name=username, hptal=hospital)
+    admin.set_password("password")
+    admin.save()
+    return admin
+
+
+class RoleTests(TestCase):
+    """
+        Class dedicated to testing the resolution of a user's role
+    """
+
+    def setUp(self):
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.nurse = make_nurse(self.hospital)
+        self.admin = make_admin(self.hospital)
+
+    def test_resolve_each_role(self):
+        """
+            Each kind of user should resolve to its role and hospital
+        """
+        for user, name in ((self.patient, Role.PATIENT), (self.doctor, Role.DOCTOR),
+                           (self.nurse, Role.NURSE), (self.admin, Role.ADMIN)):
+            role = resolve_role(User.objects.get(pk=user.pk))
+            self.assertEqual(role.name, name)
+            self.assertEqual(role.hospital_id, self.hospital.id)
+
+    def test_plain_user_has_no_role(self):
+        """
+            A user that is not a patient, doctor, nurse or admin has no role
+        """
+        user = User.objects.create_user(username="plain", password="password")
+        role = resolve_role(user)
+        self.assertFalse(role)
+        self.assertIsNone(role.hospital_id)
+
+    def test_resolve_is_a_single_query(self):
+        """
+            Resolving a role should take one query, and reading it again
+            from the same user should take none
+        """
+        user = User.objects.get(pk=self.nurse.pk)
+        with self.assertNumQueries(1):
+            get_role(user)
+        with self.assertNumQueries(0):
+            self.assertTrue(get_role(user).is_nurse)
+
+    def test_middleware_and_context_processor_are_lazy(self):
+        """
+            Neither the middleware nor the context processor should touch the
+            database until a role field is read
+        """
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=self.admin.pk)
+
+        with self.assertNumQueries(0):
+            RoleMiddleware().process_request(request)
+            context = healthnet_role(request)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(context['admin'])
+            self.assertFalse(context['patient'])
+        with self.assertNumQueries(1):
+            self.assertEqual(context['hosp'], self.hospital)
+
+
+class UpcomingAppointmentsTests(TestCase):
+    """
+        Class dedicated to testing the upcoming appointments shown on the
+        dashboard
+    """
+
+    def setUp(self):
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.nurse = make_nurse(self.hospital)
+
+        other_hospital = make_hospital("Rochester General")
+        other_doctor = make_doctor(other_hospital, "otherdoctor")
+        other_patient = make_patient(other_hospital, other_doctor, "otherpatient")
+
+        now = timezone.now()
+        self.soon = self.book(self.doctor, self.patient, now + datetime.timedelta(days=2))
+        self.sooner = self.book(self.doctor, self.patient, now + datetime.timedelta(days=1))
+        self.book(self.doctor, self.patient, now + datetime.timedelta(days=3), Appointment.REJECTED)
+        self.book(self.doctor, self.patient, now - datetime.timedelta(days=1))
+        self.book(self.doctor, self.patient, now + datetime.timedelta(days=400))
+        self.book(other_doctor, other_patient, now + datetime.timedelta(days=1))
+
+    def book(self, doctor, patient, time, state=Appointment.PENDING):
+        return Appointment.objects.create(doctor=doctor, patient=patient, appointment_time=time,
+                                          reason="Test", accept_state=state)
+
+    def test_patient_doctor_and_nurse_see_the_same_upcoming_appointments(self):
+        """
+            Past, rejected, far away and other hospitals' appointments are left out,
+            and the rest are ordered by time
+        """
+        for user in (self.patient, self.doctor, self.nurse):
+            apps = list(upcoming_appointments(resolve_role(user)))
+            self.assertEqual(apps, [self.sooner, self.soon])
+
+    def test_limit(self):
+        """
+            Only the requested number of appointments are returned
+        """
+        apps = list(upcoming_appointments(resolve_role(self.patient), limit=1))
+        self.assertEqual(apps, [self.sooner])
+
+    def test_query_count_does_not_grow(self):
+        """
+            The appointments, doctors and patients are loaded in one query,
+            and the recurring series in another
+        """
+        for i in range(20):
+            self.book(self.doctor, self.patient, timezone.now() + datetime.timedelta(days=5, minutes=30 * i))
+        role = resolve_role(self.nurse)
+        with self.assertNumQueries(2):
+            for app in upcoming_appointments(role):
+                str(app.doctor)
+                str(app.patient)
+
+
+class UserRoleIndexTests(TestCase):
+    """
+        Class dedicated to testing that the role index follows the role tables
+    """
+
+    def setUp(self):
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.nurse = make_nurse(self.hospital)
+        self.admin = make_admin(self.hospital)
+
+    def test_saving_indexes_the_user(self):
+        """
+            Every kind of user should be indexed with its role and hospital
+        """
+        entries = dict(UserRoleIndex.objects.values_list('user_id', 'role'))
+        self.assertEqual(entries, {
+            self.doctor.pk: UserRoleIndex.DOCTOR,
+            self.patient.pk: UserRoleIndex.PATIENT,
+            self.nurse.pk: UserRoleIndex.NURSE,
+            self.admin.pk: UserRoleIndex.ADMIN,
+        })
+
+    def test_deleting_unindexes_the_user(self):
+        """
+            Deleting a nurse should remove the nurse from the index
+        """
+        self.nurse.delete()
+        self.assertFalse(UserRoleIndex.objects.filter(user_id=self.nurse.pk).exists())
+
+    def test_fixtures_are_left_alone(self):
+        """
+            Loading a fixture saves raw, and its index entries come from the
+            fixture itself
+        """
+        fixture = serializers.serialize('json', [self.nurse])
+        UserRoleIndex.objects.filter(user_id=self.nurse.pk).delete()
+        for loaded in serializers.deserialize('json', fixture):
+            loaded.save()
+        self.assertFalse(UserRoleIndex.objects.filter(user_id=self.nurse.pk).exists())
+
+    def test_role_precedence(self):
+        """
+            A user in more than one table should keep the role the backfill
+            gives them, whichever profile was saved last
+        """
+        nurse = Nurse(user_id=self.patient.pk, username=self.patient.username, hospital=self.hospital)
+        nurse.save_base(raw=True)
+        nurse.save(update_fields=['hospital'])
+        self.assertEqual(UserRoleIndex.objects.get(user_id=self.patient.pk).role, UserRoleIndex.PATIENT)
+
+        migration = importlib.import_module('HealthNet.migrations.0024_backfill_userroleindex')
+        migration.backfill_role_index(django_apps, None)
+        self.assertEqual(UserRoleIndex.objects.get(user_id=self.patient.pk).role, UserRoleIndex.PATIENT)
+
+    def test_accepted_transfer_moves_the_patient(self):
+        """
+            Accepting a transfer request should move the patient's index entry
+            to the receiving hospital
+        """
+        other_hospital = make_hospital("Rochester General")
+        other_doctor = make_doctor(other_hospital, "otherdoctor")
+        other_admin = make_admin(other_hospital, "otheradmin")
+        transfer = TransferRequest.objects.create(patient_to_transfer=self.patient, receiving_hospital=other_hospital,
+                                                  new_doctor=other_doctor, receiving_admin=other_admin,
+                                                  requester=self.doctor)
+        transfer.accept_request()
+
+        self.assertEqual(UserRoleIndex.objects.get(user_id=self.patient.pk).hospital_id, other_hospital.id)
+        self.assertEqual(Patient.objects.get(pk=self.patient.pk).patient_doctor_id, other_doctor.id)
+
+    def test_backfill(self):
+        """
+            The data migration should rebuild the index from the role tables
+        """
+        UserRoleIndex.objects.all().delete()
+        migration = importlib.import_module('HealthNet.migrations.0024_backfill_userroleindex')
+        migration.backfill_role_index(django_apps, None)
+
+        self.assertEqual(UserRoleIndex.objects.count(), 4)
+        self.assertEqual(UserRoleIndex.objects.get(user_id=self.admin.pk).role, UserRoleIndex.ADMIN)
+
+    def test_employee_directory(self):
+        """
+            The employee directory should list the admin's hospital from the index
+        """
+        other_hospital = make_hospital("Rochester General")
+        make_doctor(other_hospital, "otherdoctor")
+
+        self.client.login(username="admin", password="password")
+        response = self.client.get(reverse('employees'))
+
+        self.assertEqual([u.pk for u in response.context['doctors']], [self.doctor.pk])
+        self.assertEqual([u.pk for u in response.context['nurses']], [self.nurse.pk])
+        self.assertEqual([u.pk for u in response.context['admins']], [self.admin.pk])
+        self.assertEqual([u.pk for u in response.context['patients']], [self.patient.pk])
+
+
+class RoleGuardTests(TestCase):
+    """
+        Class dedicated to testing the views guarded by require_role. Each view
+        should resolve the role once and load the user's profile once, instead
+        of probing the Patient, Doctor and Nurse tables.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.nurse = make_nurse(self.hospital)
+        self.admin = make_admin(self.hospital)
+        self.appointment = Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Test",
+                                                      appointment_time=timezone.now() + datetime.timedelta(days=1))
+
+    def make_prescription(self):
+        return Prescription.objects.create(prescription_name="Test", description="Test",
+                                           patientAssigned=self.patient, doctorAssigned=self.doctor)
+
+    def get(self, username, url, method='get'):
+        """
+            Requests the url as the given user, returning the response and the
+            queries that the request ran
+        """
+        self.client.login(username=username, password="password")
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url)
+        return response, queries
+
+    def assertNoRoleProbes(self, queries, user):
+        """
+            Asserts that the role tables were read for the requesting user only
+            once, when the profile was loaded
+        """
+        probes = [q['sql'] for q in queries
+                  if re.search(r'FROM "HealthNet_(patient|doctor|nurse|hospitaladmin)"', q['sql'])
+                  and re.search(r'"HealthNet_\w+"\."(user|user_ptr)_id" = %d\b' % user.pk, q['sql'])]
+        self.assertEqual(len(probes), 1, probes)
+
+    def test_calendar(self):
+        """
+            The calendar only needs the role, so no profile is loaded at all
+        """
+        response, queries = self.get("nurse", reverse('calendar', args=[1, 2017]))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries if 'HealthNet_nurse' in q['sql']])
+        self.assertEqual(len(queries), 5)
+
+    def test_create_appointment(self):
+        response, queries = self.get("patient", reverse('create_appointment'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNoRoleProbes(queries, self.patient)
+        # one of them sums the unread counters for the navigation bar
+        self.assertEqual(len(queries), 6)
+
+    def test_update_appointment(self):
+        response, queries = self.get("doctor", reverse('edit_appointment', args=[self.appointment.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNoRoleProbes(queries, self.doctor)
+        # one of them sums the unread counters for the navigation bar
+        self.assertEqual(len(queries), 6)
+
+    def test_view_patient_prescriptions(self):
+        self.make_prescription()
+        response, queries = self.get("nurse", reverse('prescriptions', args=[self.patient.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNoRoleProbes(queries, self.nurse)
+        self.assertEqual(len(queries), 6)
+
+    def test_delete_prescription(self):
+        prescription = self.make_prescription()
+        response, queries = self.get("doctor", reverse('delete_prescription', args=[prescription.id]))
+        self.assertEqual(response.status_code, 302)
+        self.assertNoRoleProbes(queries, self.doctor)
+        self.assertFalse(Prescription.objects.filter(pk=prescription.id).exists())
+        self.assertEqual(len(queries), 7)
+
+    def test_wrong_role_is_turned_away(self):
+        """
+            A hospital admin cannot see a calendar, and does not cost a profile load
+        """
+        response, queries = self.get("admin", reverse('calendar', args=[1, 2017]))
+        self.assertTemplateUsed(response, 'error.html')
+        self.assertEqual(len(queries), 3)
+
+
+class DashboardPanelTests(TestCase):
+    """
+        Class dedicated to testing that the dashboard panels cost a fixed
+        number of queries no matter how much is in them
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.admin = make_admin(self.hospital)
+        self.other_hospital = make_hospital("Rochester General")
+        self.other_doctor = make_doctor(self.other_hospital, "otherdoctor")
+
+    def add_inbox(self, receiver, count):
+        """
+            Sends the receiver the given number of unread messages and transfer
+            requests, and answers as many of the receiver's own requests
+        """
+        for i in range(count):
+            Message.objects.create(sender=self.patient, receiver=receiver, msg_content="Hello %d" % i,
+                                   created_at=timezone.now())
+
+            transfer = TransferRequest.objects.create(patient_to_transfer=self.patient,
+                                                      receiving_hospital=self.other_hospital,
+                                                      new_doctor=self.other_doctor, receiving_admin=self.admin,
+                                                      requester=receiver)
+            TransferRequestReply.objects.create(transfer_request=transfer, receiver=receiver,
+                                                acceptance_reply=TransferRequestReply.PENDING)
+
+    def dashboard_queries(self, username):
+        """
+            Loads the dashboard and every panel on it, uncached
+        :return: the panel responses by name, and the number of queries run
+        """
+        cache.clear()
+        self.client.login(username=username, password="password")
+        panels = {}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('base'))
+            for name in response.context['panels']:
+                panels[name] = self.client.get(reverse('dashboard_panel', args=[name]))
+                self.assertEqual(panels[name].status_code, 200)
+        return panels, len(queries)
+
+    def test_admin_dashboard_does_not_grow_with_inbox(self):
+        self.add_inbox(self.admin, 1)
+        _, small = self.dashboard_queries("admin")
+
+        self.add_inbox(self.admin, 15)
+        panels, large = self.dashboard_queries("admin")
+
+        self.assertEqual(small, large)
+        self.assertEqual(panels['messages'].json()['count'], 16)
+        self.assertEqual(len(panels['messages'].context['new_messages']), 5)
+        self.assertEqual(panels['transfers'].json()['count'], 16)
+
+    def test_doctor_dashboard_does_not_grow_with_inbox(self):
+        self.add_inbox(self.doctor, 1)
+        _, small = self.dashboard_queries("doctor")
+
+        self.add_inbox(self.doctor, 15)
+        panels, large = self.dashboard_queries("doctor")
+
+        self.assertEqual(small, large)
+        self.assertEqual(panels['transfer_replies'].json()['count'], 16)
+
+    def test_panels_follow_role(self):
+        self.client.login(username="patient", password="password")
+        response = self.client.get(reverse('base'))
+
+        self.assertEqual(response.context['panels'], ['appointments', 'messages'])
+        self.assertContains(response, reverse('dashboard_panel', args=['appointments']))
+        self.assertEqual(self.client.get(reverse('dashboard_panel', args=['log'])).status_code, 403)
+        self.assertEqual(self.client.get(reverse('dashboard_panel', args=['nothing'])).status_code, 404)
+
+    def test_answered_requests_are_not_pending(self):
+        self.add_inbox(self.admin, 2)
+        TransferRequestReply.objects.filter(pk=TransferRequestReply.objects.first().pk).update(
+            acceptance_reply=TransferRequestReply.REJECTED)
+
+        self.assertEqual(pending_transfer_requests(self.admin).count(), 1)
+
+
+class LogPanelTests(TestCase):
+    """
+        Class dedicated to testing the system log panel on the admin dashboard
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.admin = make_admin(self.hospital)
+        self.now = timezone.now()
+
+    def log(self, count, age=datetime.timedelta(minutes=1)):
+        for i in range(count):
+            LogEntry.objects.create(requester=self.admin, action="Action %d" % i, date=self.now - age)
+
+    def test_only_entries_in_window(self):
+        self.log(2)
+        self.log(3, datetime.timedelta(days=2))
+        self.log(1, -datetime.timedelta(hours=1))
+
+        entries, cursor = recent_log_entries()
+        self.assertEqual(len(entries), 2)
+        self.assertIsNone(cursor)
+
+    def test_pages_with_cursor(self):
+        self.log(7)
+
+        seen = []
+        entries, cursor = recent_log_entries(limit=3)
+        seen.extend(entries)
+        while cursor is not None:
+            self.assertEqual(len(entries), 3)
+            entries, cursor = recent_log_entries(cursor, limit=3)
+            seen.extend(entries)
+
+        self.assertEqual([e.pk for e in seen],
+                         list(LogEntry.objects.order_by('-date', '-id').values_list('pk', flat=True)))
+
+    def test_bad_cursor_starts_over(self):
+        self.log(2)
+        entries, _ = recent_log_entries("not-a-cursor")
+        self.assertEqual(len(entries), 2)
+
+    def test_dashboard_is_capped(self):
+        self.log(30)
+        self.client.login(username="admin", password="password")
+        with self.settings(HEALTHNET_LOG_PANEL_LIMIT=10):
+            with CaptureQueriesContext(connection) as small:
+                self.client.get(reverse('dashboard_panel', args=['log']))
+            self.log(30)
+            with CaptureQueriesContext(connection) as large:
+                response = self.client.get(reverse('dashboard_panel', args=['log']))
+
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(response.json()['count'], 10)
+        self.assertIn("?log_before=" + response.context['log_cursor'], response.json()['html'])
+
+        # the cursor is passed on from the dashboard to the panel
+        response = self.client.get(reverse('base'), {'log_before': 'cursor'})
+        self.assertContains(response, reverse('dashboard_panel', args=['log']) + "?log_before=cursor")
+
+
+class DashboardCacheTests(TestCase):
+    """
+        Class dedicated to testing that the dashboard panels are cached until
+        something shown on them changes
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.nurse = make_nurse(self.hospital)
+        self.admin = make_admin(self.hospital)
+
+    def load(self, username, panel):
+        self.client.login(username=username, password="password")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('dashboard_panel', args=[panel]))
+        return response.json(), len(queries)
+
+    def test_repeat_load_skips_panels(self):
+        first, cold = self.load("patient", 'appointments')
+        second, warm = self.load("patient", 'appointments')
+
+        self.assertLess(warm, cold)
+        self.assertEqual(first, second)
+        self.assertIn("Upcoming appointments:", second['html'])
+
+    def test_dashboard_page_skips_panels(self):
+        self.client.login(username="patient", password="password")
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('base'))
+        self.assertFalse([q for q in queries if 'healthnet_appointment' in q['sql'].lower() or
+                          'healthnet_message' in q['sql'].lower()])
+
+    def test_message_invalidates_receiver(self):
+        self.load("doctor", 'messages')
+        Message.objects.create(sender=self.patient, receiver=self.doctor, msg_content="Hello",
+                               created_at=timezone.now())
+
+        panel, _ = self.load("doctor", 'messages')
+        self.assertEqual(panel['count'], 1)
+        self.assertIn("New Messages (1):", panel['html'])
+
+    def test_appointment_invalidates_hospital_staff(self):
+        self.load("nurse", 'appointments')
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                   appointment_time=timezone.now() + datetime.timedelta(days=1))
+
+        panel, _ = self.load("nurse", 'appointments')
+        self.assertIn("Checkup", panel['html'])
+
+    def test_moved_appointment_invalidates_old_doctor(self):
+        other_doctor = make_doctor(make_hospital("Rochester General"), "otherdoctor")
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                   appointment_time=timezone.now() + datetime.timedelta(days=1))
+        self.load("doctor", 'appointments')
+
+        appointment = Appointment.objects.get()
+        appointment.doctor = other_doctor
+        appointment.save()
+
+        panel, _ = self.load("doctor", 'appointments')
+        self.assertNotIn("Checkup", panel['html'])
+
+    def test_log_entry_invalidates_admins(self):
+        self.load("admin", 'log')
+        LogEntry.objects.create(requester=self.patient, action="Logged in", date=timezone.now())
+
+        panel, _ = self.load("admin", 'log')
+        self.assertIn("Logged in", panel['html'])
+
+
+class MonthGridTests(TestCase):
+    """
+        Class dedicated to testing the cached month grids behind Month
+    """
+
+    def test_grid_matches_dates(self):
+        for year in (1899, 1900, 1999, 2000, 2016, 2100, 2101):
+            for month in range(1, 13):
+                first = datetime.date(year, month, 1)
+                days = month_days(month, year)
+
+                self.assertEqual(days.index(1), (first.weekday() + 1) % 7)
+                self.assertEqual(len([d for d in days if d]),
+                                 ((first + datetime.timedelta(days=32)).replace(day=1) - first).days)
+                self.assertEqual([d for week in month_grid(month, year) for d in week if d], list(range(1, days[-1] + 1)))
+
+    def test_leap_years(self):
+        self.assertEqual(Month(2, 2016).days[-1], 29)
+        self.assertEqual(Month(2, 2000).days[-1], 29)
+        self.assertEqual(Month(2, 1900).days[-1], 28)
+        self.assertTrue(Month(1, 2000).is_leap_year())
+
+    def test_year_grid(self):
+        grids = year_grid(2018)
+        self.assertEqual(len(grids), 12)
+        self.assertEqual(grids[8], Month(9, 2018).weeks)
+        self.assertTrue(all(len(week) == 7 for grid in grids for week in grid))
+
+    def test_grids_are_shared(self):
+        self.assertIs(Month(3, 2017).weeks, Month(3, 2017).weeks)
+
+    def test_grid_worked_out_once(self):
+        """
+            The grid of a month is worked out once; every later Month is
+            served from the cache
+        """
+        month_grid.cache_clear()
+        month_days.cache_clear()
+        Month(9, 2018)
+        grid_misses, days_misses = month_grid.cache_info().misses, month_days.cache_info().misses
+
+        for _ in range(5):
+            Month(9, 2018)
+        self.assertEqual((month_grid.cache_info().misses, month_days.cache_info().misses), (grid_misses, days_misses))
+        self.assertGreaterEqual(month_grid.cache_info().hits, 5)
+
+
+class DaySummaryTests(TestCase):
+    """
+        Class dedicated to testing the per-day appointment summaries that
+        drive the month calendar
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.nurse = make_nurse(self.hospital)
+
+        for day, hour, state in ((3, 9, Appointment.PENDING), (3, 10, Appointment.ACCEPTED),
+                                 (3, 11, Appointment.ACCEPTED), (10, 9, Appointment.REJECTED),
+                                 (10, 23, Appointment.PENDING), (17, 9, Appointment.PENDING),
+                                 (17, 10, Appointment.REJECTED), (31, 23, Appointment.ACCEPTED)):
+            Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                       accept_state=state, appointment_time=datetime.datetime(2018, 3, day, hour, 30))
+        # outside the month
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                   appointment_time=datetime.datetime(2018, 4, 1, 0, 0))
+
+    def month(self):
+        return Appointment.objects.filter(appointment_time__year=2018, appointment_time__month=3)
+
+    def test_summary(self):
+        with self.assertNumQueries(1):
+            summary = summarize_days(self.month())
+
+        self.assertEqual({day: counts[:3] for day, counts in summary.items()},
+                         {3: (1, 2, 0), 10: (1, 0, 1), 17: (1, 0, 1), 31: (0, 1, 0)})
+        self.assertEqual(summary[3][3:], (datetime.datetime(2018, 3, 3, 9, 30), datetime.datetime(2018, 3, 3, 10, 30),
+                                          None))
+
+    def test_css_classes(self):
+        html = ApptCalendar(3, 2018, self.month()).format_month(3, 2018)
+        self.assertIn('<td class=" pending filled"><a href="/appointment/3/3/2018">3</a></td>', html)
+        # only the states of the appointments before a day's first rejected
+        # one are shown, as when the day's appointments were gone through in
+        # time order
+        self.assertIn('<td class=" rejected"><a href="/appointment/10/3/2018">10</a></td>', html)
+        self.assertIn('<td class=" pending rejected"><a href="/appointment/17/3/2018">17</a></td>', html)
+        self.assertIn('<td class=" filled"><a href="/appointment/31/3/2018">31</a></td>', html)
+        self.assertIn('<td class=" unfilled"><a href="/appointment/4/3/2018">4</a></td>', html)
+
+    def test_doctor_hides_rejected(self):
+        html = DoctorCalendar(3, 2018, self.month()).format_month(3, 2018)
+        self.assertIn('<td class=" pending filled"><a href="/appointment/10/3/2018">10</a></td>', html)
+
+    def test_calendar_does_not_load_appointments(self):
+        self.client.login(username="nurse", password="password")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('calendar', args=[3, 2018]))
+
+        self.assertEqual(response.status_code, 200)
+        appointment_queries = [q['sql'] for q in queries if 'healthnet_appointment' in q['sql'].lower()]
+        self.assertEqual(len(appointment_queries), 1)
+        self.assertIn('GROUP BY', appointment_queries[0])
+
+
+class CalendarCacheTests(TestCase):
+    """
+        Class dedicated to testing the cached month calendar and its ETags
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.nurse = make_nurse(self.hospital)
+        self.other_hospital = make_hospital("Rochester General")
+        self.other_doctor = make_doctor(self.other_hospital, "otherdoctor")
+
+    def get(self, username, month=3, year=2018, etag=None):
+        self.client.login(username=username, password="password")
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('calendar', args=[month, year]), **headers)
+        return response, [q['sql'] for q in queries if 'healthnet_appointment' in q['sql'].lower()]
+
+    def book(self, doctor, day=5):
+        return Appointment.objects.create(doctor=doctor, patient=self.patient, reason="Checkup",
+                                          appointment_time=datetime.datetime(2018, 3, day, 9, 0))
+
+    def test_repeat_load_is_cached(self):
+        first, queries = self.get("nurse")
+        self.assertEqual(len(queries), 1)
+
+        second, queries = self.get("nurse")
+        self.assertEqual(queries, [])
+        self.assertEqual(first.content, second.content)
+
+    def test_not_modified(self):
+        first, _ = self.get("doctor")
+        self.assertTrue(first['ETag'].startswith('"'))
+
+        self.client.login(username="doctor", password="password")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('calendar', args=[3, 2018]), HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        # only the session, the user and the role are read
+        self.assertEqual(len(queries), 3)
+
+    def test_months_have_their_own_etags(self):
+        march, _ = self.get("patient")
+        april, _ = self.get("patient", month=4)
+        self.assertNotEqual(march['ETag'], april['ETag'])
+
+        response, _ = self.get("patient", month=4, etag=march['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_appointment_changes_invalidate(self):
+        first, _ = self.get("nurse")
+        appointment = self.book(self.doctor)
+
+        response, queries = self.get("nurse", etag=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+        self.assertContains(response, '<td class=" pending"><a href="/appointment/5/3/2018">5</a></td>', html=False)
+
+        second = response
+        appointment.delete()
+        response, _ = self.get("nurse", etag=second['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_other_hospitals_stay_cached(self):
+        first, _ = self.get("nurse")
+        self.book(self.other_doctor)
+
+        response, _ = self.get("nurse", etag=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class CalendarRendererTests(TestCase):
+    """
+        Class dedicated to testing that the compiled month renderer gives the
+        same HTML as formatting each day on its own, reversing the day url
+        once a month rather than once a day
+    """
+
+    def setUp(self):
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+
+        today = datetime.date.today()
+        self.month, self.year = today.month, today.year
+        for hour, (day, state) in enumerate(((1, Appointment.PENDING), (1, Appointment.ACCEPTED),
+                                             (2, Appointment.REJECTED), (today.day, Appointment.ACCEPTED),
+                                             (28, Appointment.PENDING)), 9):
+            Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup", accept_state=state,
+                                       appointment_time=datetime.datetime(self.year, self.month, day, hour, 0))
+
+    def calendars(self):
+        appointments = Appointment.objects.filter(appointment_time__year=self.year,
+                                                  appointment_time__month=self.month)
+        return (ApptCalendar(self.month, self.year, appointments),
+                DoctorCalendar(self.month, self.year, appointments))
+
+    def format_by_day(self, cal):
+        """ The month put together one format_day call at a time """
+        html = ['<table class="month">', '\n', cal.format_week_header()]
+        for week in Month(cal.month, cal.year).weeks:
+            html.append(cal.format_week(week))
+            html.append('\n')
+        html.append('</table>')
+        html.append('\n')
+        return ''.join(html)
+
+    def test_same_html(self):
+        for cal in self.calendars():
+            html = cal.format_month(self.month, self.year)
+            self.assertEqual(html, self.format_by_day(cal))
+            self.assertIn('class="today', html)
+
+    def count_urls(self, cal, render):
+        """ How many times render reverses a day view url """
+        urls = []
+        get_absolute_url = cal.get_absolute_url
+        cal.get_absolute_url = lambda day: urls.append(day) or get_absolute_url(day)
+        try:
+            render()
+        finally:
+            del cal.get_absolute_url
+        return len(urls)
+
+    def test_url_reversed_once(self):
+        days = len([day for day in Month(self.month, self.year).days if day])
+        for cal in self.calendars():
+            self.assertEqual(self.count_urls(cal, lambda: self.format_by_day(cal)), days)
+            self.assertEqual(self.count_urls(cal, lambda: cal.format_month(self.month, self.year)), 1)
+
+
+class CalendarApiTests(TestCase):
+    """
+        Class dedicated to testing the JSON calendar that the calendar page
+        renders in the browser
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        for day, hour, state in ((5, 9, Appointment.PENDING), (5, 10, Appointment.ACCEPTED),
+                                 (6, 9, Appointment.REJECTED), (31, 23, Appointment.ACCEPTED)):
+            Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup", accept_state=state,
+                                       appointment_time=datetime.datetime(2018, 3, day, hour, 0))
+        # just outside the month
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                   appointment_time=datetime.datetime(2018, 4, 1, 0, 0))
+
+    def get(self, username, name, args, etag=None):
+        self.client.login(username=username, password="password")
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(name, args=args), **headers)
+        return response, [q['sql'] for q in queries if 'healthnet_appointment' in q['sql'].lower()]
+
+    def test_month(self):
+        response, queries = self.get("patient", 'calendar_month_json', [3, 2018])
+        data = response.json()
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual((data['month'], data['year'], data['name']), (3, 2018, "March"))
+        self.assertEqual(data['weeks'][0], [0, 0, 0, 0, 1, 2, 3])
+        self.assertEqual(data['status'], {'5': PENDING_DAY | FILLED_DAY, '6': REJECTED_DAY, '31': FILLED_DAY})
+        self.assertEqual(data['day_url'], '/appointment/%d/3/2018')
+        self.assertEqual(data['prev'], {'month': 2, 'year': 2018, 'name': "February"})
+        self.assertEqual(data['next'], {'month': 4, 'year': 2018, 'name': "April"})
+
+    def test_doctor_month_hides_rejected(self):
+        response, _ = self.get("doctor", 'calendar_month_json', [3, 2018])
+        self.assertEqual(response.json()['status'], {'5': PENDING_DAY | FILLED_DAY, '31': FILLED_DAY})
+
+    def test_year_boundaries(self):
+        data = self.get("patient", 'calendar_month_json', [1, 2018])[0].json()
+        self.assertEqual((data['prev']['month'], data['prev']['year']), (12, 2017))
+        data = self.get("patient", 'calendar_month_json', [12, 2018])[0].json()
+        self.assertEqual((data['next']['month'], data['next']['year']), (1, 2019))
+
+    def test_month_is_cached(self):
+        first, _ = self.get("patient", 'calendar_month_json', [3, 2018])
+        second, queries = self.get("patient", 'calendar_month_json', [3, 2018])
+        self.assertEqual(queries, [])
+        self.assertEqual(first.content, second.content)
+
+        response, queries = self.get("patient", 'calendar_month_json', [3, 2018], etag=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(queries, [])
+
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                   appointment_time=datetime.datetime(2018, 3, 20, 9, 0))
+        response, _ = self.get("patient", 'calendar_month_json', [3, 2018], etag=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('20', response.json()['status'])
+
+    def test_same_classes_as_the_page(self):
+        cal = ApptCalendar(3, 2018, Appointment.objects.filter(appointment_time__month=3))
+        data = cal.month_data()
+        for day in range(1, 32):
+            self.assertEqual(day_status_class(data['status'].get(day, 0), False), cal.day_class(day, False))
+
+    def test_day(self):
+        response, queries = self.get("patient", 'calendar_day_json', [5, 3, 2018])
+        appointments = response.json()['appointments']
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([(a['time'], a['state']) for a in appointments],
+                         [('09:00', Appointment.PENDING), ('10:00', Appointment.ACCEPTED)])
+        self.assertEqual(appointments[0]['doctor'], "%s %s" % (self.doctor.first_name, self.doctor.last_name))
+
+        response, _ = self.get("doctor", 'calendar_day_json', [6, 3, 2018])
+        self.assertEqual(response.json()['appointments'], [])
+
+    def test_invalid(self):
+        self.assertEqual(self.get("patient", 'calendar_month_json', [13, 2018])[0].status_code, 404)
+        self.assertEqual(self.get("patient", 'calendar_day_json', [30, 2, 2018])[0].status_code, 404)
+
+
+class AvailabilityTests(TestCase):
+    """
+        Class dedicated to testing the free slot finder
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.other_doctor = make_doctor(self.hospital, "otherdoctor")
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.day = datetime.date(2018, 3, 5)
+
+    def book(self, hour, minute, doctor=None, day=None):
+        return Appointment.objects.create(doctor=doctor or self.doctor, patient=self.patient, reason="Checkup",
+                                          appointment_time=datetime.datetime.combine(day or self.day,
+                                                                                      datetime.time(hour, minute)))
+
+    def free(self, doctor=None, day=None):
+        day = day or self.day
+        return free_slots([(doctor or self.doctor).pk], day, day + datetime.timedelta(days=1))[(doctor or self.doctor).pk][day]
+
+    def test_sweep(self):
+        slots = day_slots(self.day)
+        self.assertEqual((slots[0].time(), slots[-1].time(), len(slots)),
+                         (datetime.time(9, 0), datetime.time(16, 30), 16))
+
+        at = lambda hour, minute: datetime.datetime.combine(self.day, datetime.time(hour, minute))
+        free = sweep(slots, [at(9, 45), at(12, 0)])
+        self.assertNotIn(at(9, 30), free)
+        self.assertNotIn(at(10, 0), free)
+        self.assertNotIn(at(12, 0), free)
+        self.assertIn(at(9, 0), free)
+        self.assertIn(at(10, 30), free)
+        self.assertIn(at(11, 30), free)
+        self.assertIn(at(12, 30), free)
+
+    def test_matches_the_booking_check(self):
+        for hour, minute in ((8, 45), (9, 50), (10, 30), (13, 10), (16, 59)):
+            self.book(hour, minute)
+
+        free = self.free()
+        for slot in day_slots(self.day):
+            taken = find_conflict(slot, self.doctor.pk, self.patient.pk + 1000) is not None
+            self.assertEqual(slot.time() not in free, taken, slot)
+
+    def test_other_doctors_are_free(self):
+        self.book(9, 0, doctor=self.other_doctor)
+        self.assertEqual(len(self.free()), 16)
+
+    def test_cached_per_doctor_day(self):
+        self.book(9, 0)
+        with self.assertNumQueries(2):
+            first = self.free()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.free(), first)
+
+        # booking invalidates the doctor's days
+        self.book(11, 0)
+        self.assertNotIn(datetime.time(11, 0), self.free())
+
+    def test_one_query_for_a_hospital(self):
+        self.book(9, 0)
+        self.book(10, 0, doctor=self.other_doctor, day=self.day + datetime.timedelta(days=3))
+        doctors = [self.doctor.pk, self.other_doctor.pk]
+        with self.assertNumQueries(2):
+            slots = free_slots(doctors, self.day, self.day + datetime.timedelta(days=7))
+
+        self.assertEqual(len(slots[self.doctor.pk]), 7)
+        self.assertNotIn(datetime.time(9, 0), slots[self.doctor.pk][self.day])
+        self.assertNotIn(datetime.time(10, 0), slots[self.other_doctor.pk][self.day + datetime.timedelta(days=3)])
+
+    def test_parse_days(self):
+        self.assertEqual(parse_days('2018-03-05', '2018-03-08'), (self.day, datetime.date(2018, 3, 8)))
+        start, end = parse_days('2018-03-05', '2019-03-05')
+        self.assertEqual((end - start).days, 7)
+        start, end = parse_days('junk')
+        self.assertEqual(start, datetime.date.today())
+        # the range can't run past the last date there is
+        self.assertEqual(parse_days('9999-12-31'), parse_days())
+        self.assertEqual(parse_days('0001-01-01', '0001-01-05'), parse_days())
+
+    def test_view(self):
+        day = datetime.date.today() + datetime.timedelta(days=2)
+        self.book(9, 0, day=day)
+
+        self.client.login(username="patient", password="password")
+        response = self.client.get(reverse('doctor_availability'), {
+            'doctor': self.doctor.pk, 'start': day.isoformat(),
+            'end': (day + datetime.timedelta(days=1)).isoformat()})
+        data = response.json()
+
+        self.assertEqual([doctor['id'] for doctor in data['doctors']], [self.doctor.pk])
+        self.assertEqual(data['doctors'][0]['days'][day.isoformat()][:2], ['09:30', '10:00'])
+
+        response = self.client.get(reverse('doctor_availability'))
+        self.assertEqual(len(response.json()['doctors']), 2)
+
+        other = make_doctor(make_hospital("Rochester General"), "faraway")
+        response = self.client.get(reverse('doctor_availability'), {'doctor': other.pk})
+        self.assertEqual(response.status_code, 404)
+
+        for start, end in (('9999-12-31', ''), ('9999-12-29', '9999-12-30'), ('0001-01-01', '0001-01-02'),
+                           ('0001-01-02', '0001-01-03')):
+            response = self.client.get(reverse('doctor_availability'), {'start': start, 'end': end})
+            self.assertEqual(response.status_code, 200)
+
+
+class CalendarFeedTests(TestCase):
+    """
+        Class dedicated to testing the iCalendar feed of appointments
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+        self.nurse = make_nurse(self.hospital)
+        self.admin = make_admin(self.hospital)
+
+        self.soon = datetime.datetime.combine(datetime.date.today(), datetime.time(9, 0)) + datetime.timedelta(days=2)
+        self.booked = Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup, yearly",
+                                                 appointment_time=self.soon)
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Old",
+                                   appointment_time=self.soon - datetime.timedelta(days=400))
+
+    def feed(self, user, etag=None, **window):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        url = reverse('calendar_feed', args=[feed_token(user.pk)])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, window, **headers)
+        content = b''.join(response.streaming_content).decode() if response.status_code == 200 else ''
+        return response, content, len(queries)
+
+    def test_feed_streams_events(self):
+        response, content, _ = self.feed(self.patient)
+
+        self.assertEqual(response['Content-Type'], 'text/calendar; charset=utf-8')
+        self.assertTrue(content.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertTrue(content.endswith('END:VCALENDAR\r\n'))
+        self.assertEqual(content.count('BEGIN:VEVENT'), 1)
+        self.assertIn('DTSTART:%s' % self.soon.strftime('%Y%m%dT%H%M%S'), content)
+        self.assertIn('SUMMARY:Checkup\\, yearly', content)
+        self.assertIn('STATUS:TENTATIVE', content)
+
+    def test_nurse_sees_hospital(self):
+        _, content, _ = self.feed(self.nurse)
+        self.assertEqual(content.count('BEGIN:VEVENT'), 1)
+
+    def test_window(self):
+        start = (self.soon - datetime.timedelta(days=401)).strftime('%Y%m%d')
+        end = (self.soon - datetime.timedelta(days=399)).strftime('%Y%m%d')
+        _, content, _ = self.feed(self.doctor, start=start, end=end)
+
+        self.assertEqual(content.count('BEGIN:VEVENT'), 1)
+        self.assertIn('Old', content)
+
+    def test_window_is_capped(self):
+        start, end = feed_window('20000101', '20300101')
+        self.assertEqual(start, datetime.datetime(2000, 1, 1))
+        self.assertLessEqual((end - start).days, 366)
+        self.assertEqual(feed_window('garbage'), feed_window())
+        self.assertEqual(feed_window('99991231'), feed_window())
+
+        response, _, _ = self.feed(self.doctor, start='99991231')
+        self.assertEqual(response.status_code, 200)
+
+    def test_not_modified(self):
+        response, _, _ = self.feed(self.doctor)
+        etag = response['ETag']
+
+        response, _, queries = self.feed(self.doctor, etag)
+        self.assertEqual(response.status_code, 304)
+        # the token's user and their role; no appointments
+        self.assertEqual(queries, 2)
+
+        self.booked.acceptAppointment(commit=True)
+        response, content, _ = self.feed(self.doctor, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('STATUS:CONFIRMED', content)
+
+    def test_bad_tokens(self):
+        response = self.client.get(reverse('calendar_feed', args=[feed_token(self.patient.pk) + 'x']))
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.get(reverse('calendar_feed', args=[feed_token(self.admin.pk)]))
+        self.assertEqual(response.status_code, 404)
+
+        self.patient.is_active = False
+        self.patient.save()
+        response, _, _ = self.feed(self.patient)
+        self.assertEqual(response.status_code, 404)
+
+    def test_new_token(self):
+        self.client.login(username="patient", password="password")
+        # the feed is made the first time its link is shown
+        response = self.client.get(reverse('calendar_feed_settings'))
+        old_token = CalendarFeed.objects.get(user_id=self.patient.pk).token
+        self.assertContains(response, reverse('calendar_feed', args=[old_token]))
+
+        self.client.post(reverse('calendar_feed_settings'))
+        self.assertNotEqual(feed_token(self.patient.pk), old_token)
+        response = self.client.get(reverse('calendar_feed', args=[old_token]))
+        self.assertEqual(response.status_code, 404)
+        response, _, _ = self.feed(self.patient)
+        self.assertEqual(response.status_code, 200)
+
+    def test_long_lines_are_folded(self):
+        line = content_line('SUMMARY', 'x' * 200)
+        self.assertTrue(all(len(part.encode()) <= 75 for part in line[:-2].split('\r\n')))
+        self.assertEqual(line.replace('\r\n ', ''), 'SUMMARY:' + 'x' * 200 + '\r\n')
+
+    def test_calendar_links_feed(self):
+        self.client.login(username="nurse", password="password")
+        response = self.client.get(reverse('calendar', args=[1, 2017]))
+        self.assertContains(response, reverse('calendar_feed_settings'))
+        # opening the calendar doesn't make a feed
+        self.assertFalse(CalendarFeed.objects.exists())
+
+
+class HospitalScheduleTests(TestCase):
+    """
+        Class dedicated to testing the per-doctor lanes of the hospital schedule
+    """
+
+    def setUp(self):
+        self.hospital = make_hospital()
+        self.doctors = [make_doctor(self.hospital, "doctor%d" % i) for i in range(3)]
+        self.patient = make_patient(self.hospital, self.doctors[0])
+        self.nurse = make_nurse(self.hospital)
+        self.week = datetime.date(2018, 3, 4)    # a sunday
+
+    def book(self, doctor, day, hour, minute=0, state=Appointment.PENDING):
+        Appointment.objects.create(doctor=doctor, patient=self.patient, reason="Checkup", accept_state=state,
+                                   appointment_time=datetime.datetime(2018, 3, day, hour, minute))
+
+    def test_week_start(self):
+        self.assertEqual(week_start(datetime.date(2018, 3, 4)), self.week)
+        self.assertEqual(week_start(datetime.date(2018, 3, 10)), self.week)
+        self.assertEqual(parse_week('2018-03-07'), self.week)
+        self.assertEqual(parse_week('nonsense'), week_start(datetime.date.today()))
+        for edge in ('0001-01-01', '0001-01-08', '9999-12-26', '9999-12-31'):
+            self.assertEqual(parse_week(edge), week_start(datetime.date.today()))
+
+    def test_lanes(self):
+        self.book(self.doctors[0], 5, 9, 0, Appointment.REJECTED)
+        self.book(self.doctors[0], 5, 9, 15, Appointment.ACCEPTED)
+        self.book(self.doctors[0], 10, 23, 45, Appointment.REJECTED)
+        self.book(self.doctors[1], 4, 0)
+        self.book(self.doctors[1], 11, 9)   # next week
+
+        with self.assertNumQueries(4):
+            _, lanes = schedule_lanes(self.hospital.pk, self.week)
+
+        lanes = {lane.doctor.pk: lane.days for lane in lanes}
+        self.assertEqual(lanes[self.doctors[0].pk][1], [(datetime.time(9, 0), Appointment.ACCEPTED)])
+        self.assertEqual(lanes[self.doctors[0].pk][6], [(datetime.time(23, 30), Appointment.REJECTED)])
+        self.assertEqual(lanes[self.doctors[1].pk][0], [(datetime.time(0, 0), Appointment.PENDING)])
+        self.assertEqual(sum(len(day) for day in lanes[self.doctors[2].pk]), 0)
+
+    def test_paged_by_doctor(self):
+        doctors, lanes = schedule_lanes(self.hospital.pk, self.week, page=2, per_page=2)
+        self.assertEqual(len(lanes), 1)
+        self.assertEqual(doctors.paginator.count, 3)
+
+        doctors, lanes = schedule_lanes(self.hospital.pk, self.week, page='99', per_page=2)
+        self.assertEqual(doctors.number, 2)
+
+    def test_view(self):
+        self.book(self.doctors[2], 6, 14, 30, Appointment.ACCEPTED)
+        self.client.login(username="nurse", password="password")
+        response = self.client.get(reverse('hospital_schedule'), {'week': '2018-03-06'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<span class="slot filled">14:30</span>', html=False)
+        self.assertContains(response, '?week=2018-03-11')
+
+        response = self.client.get(reverse('hospital_schedule'), {'week': '0001-01-01'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_only_nurses(self):
+        self.client.login(username="doctor0", password="password")
+        response = self.client.get(reverse('hospital_schedule'))
+        self.assertTemplateUsed(response, 'error.html')
+
+
+class DateWindowTests(TestCase):
+    """
+        Class dedicated to testing the half open date windows the calendar
+        views filter by, and that they are served from the indexes
+    """
+
+    def setUp(self):
+        self.hospital = make_hospital()
+        self.doctor = make_doctor(self.hospital)
+        self.patient = make_patient(self.hospital, self.doctor)
+
+    def book(self, time):
+        return Appointment.objects.create(doctor=self.doctor, patient=self.patient, reason="Checkup",
+                                          appointment_time=time)
+
+    def test_windows(self):
+        self.assertEqual(DateWindow.month(2, 2016), (datetime.datetime(2016, 2, 1), datetime.datetime(2016, 3, 1)))
+        self.assertEqual(DateWindow.month(12, 2017), (datetime.datetime(2017, 12, 1), datetime.datetime(2018, 1, 1)))
+        self.assertEqual(DateWindow.day(datetime.date(2016, 2, 29)),
+                         (datetime.datetime(2016, 2, 29), datetime.datetime(2016, 3, 1)))
+        self.assertEqual(DateWindow.week(datetime.date(2018, 3, 7)),
+                         (datetime.datetime(2018, 3, 4), datetime.datetime(2018, 3, 11)))
+
+    def test_windows_are_half_open(self):
+        inside = self.book(datetime.datetime(2018, 3, 31, 23, 59, 59))
+        self.book(datetime.datetime(2018, 4, 1, 0, 0))
+        first = self.book(datetime.datetime(2018, 3, 1, 0, 0))
+
+        march = Appointment.objects.filter(**DateWindow.month(3, 2018).lookup())
+        self.assertEqual(set(march), {inside, first})
+
+    def test_valid_days(self):
+        self.assertTrue(is_valid_day(29, 2, 2016))
+        self.assertFalse(is_valid_day(29, 2, 2017))
+        self.assertFalse(is_valid_day(31, 4, 2017))
+        self.assertFalse(is_valid_day(1, 13, 2017))
+        self.assertFalse(is_valid_day(1, 1, 1899))
+        # the window of the last date there is would end after it
+        self.assertTrue(is_valid_day(30, 12, 9999))
+        self.assertFalse(is_valid_day(31, 12, 9999))
+        self.assertTrue(is_valid_month(11, 9999))
+        self.assertFalse(is_valid_month(12, 9999))
+        self.assertFalse(is_valid_month(13, 2017))
+
+    def test_last_month_not_found(self):
+        self.client.login(username="patient", password="password")
+        self.assertEqual(self.client.get(reverse('calendar', args=[12, 9999])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('calendar_month_json', args=[12, 9999])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('day_view', args=[31, 12, 9999])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('calendar', args=[11, 9999])).status_code, 200)
+
+    def test_day_view_knows_leap_years(self):
+        self.book(datetime.datetime(2016, 2, 29, 10, 0))
+        self.client.login(username="patient", password="password")
+
+        response = self.client.get(reverse('day_view', args=[29, 2, 2016]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['appointments']), 1)
+
+        response = self.client.get(reverse('day_view', args=[29, 2, 2017]))
+        self.assertEqual(response.status_code, 404)
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+    def composite_index(self, column):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Appointment._meta.db_table)
+        return [name for name, info in constraints.items()
+                if info['index'] and info['columns'] == [column, 'appointment_time']][0]
+
+    def test_windows_use_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("EXPLAIN QUERY PLAN is SQLite's")
+
+        plan = self.query_plan(Appointment.objects.filter(
+            patient_id=self.patient.pk, **DateWindow.day(datetime.date(2018, 3, 5)).lookup()))
+        self.assertIn('USING INDEX %s (patient_id=? AND appointment_time>? AND appointment_time<?)'
+                      % self.composite_index('patient_id'), plan)
+
+        plan = self.query_plan(Appointment.objects.filter(
+            doctor_id=self.doctor.pk, **DateWindow.month(3, 2018).lookup()))
+        self.assertIn('USING INDEX %s (doctor_id=? AND appointment_time>? AND appointment_time<?)'
+                      % self.composite_index('doctor_id'), plan)
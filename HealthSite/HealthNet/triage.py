@@ -0,0 +1,73 @@
+"""
+    File containing the bulk triage of a doctor's pending appointments, so a
+    doctor with a backlog of requests can accept or reject many of them at
+    once. However many are picked, a batch is one locking read, one UPDATE of
+    just the state (and slot), one INSERT of the log entries and one round
+    trip to invalidate the caches.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Appointment, LogEntry
+from .cache_versions import bump, appointment_scopes, LOG_SCOPE
+
+# what a batch can do to the appointments picked
+ACCEPT = 'accept'
+REJECT = 'reject'
+ACTIONS = ((ACCEPT, 'Accept'), (REJECT, 'Reject'))
+
+# the state each action gives, and what it is logged as; rejected
+# appointments give up their slot, as Appointment.save() would do
+CHANGES = {
+    ACCEPT: ({'accept_state': Appointment.ACCEPTED}, "Appointment Accepted"),
+    REJECT: ({'accept_state': Appointment.REJECTED, 'slot': None}, "Appointment Rejected"),
+}
+
+
+def pending_appointments(doctor_id):
+    """
+        Returns the appointments waiting on a doctor, soonest first
+    :param doctor_id: (int) id of the doctor
+    :return: (QuerySet) the pending appointments, with their patients
+    """
+    return Appointment.objects.filter(doctor_id=doctor_id, accept_state=Appointment.PENDING).select_related(
+        'patient').order_by('appointment_time', 'pk')
+
+
+def triage(doctor_id, hospital_id, appointment_ids, action, requester, now=None):
+    """
+        Accepts or rejects a set of a doctor's pending appointments. Only
+        the doctor's own appointments that are still pending are changed,
+        so ids of other appointments, or a batch sent twice, change nothing.
+        The update goes straight to the database, so the caches of the
+        patients, the doctor and the hospital are invalidated here, once.
+    :param doctor_id: (int) id of the doctor
+    :param hospital_id: (int) id of the doctor's hospital
+    :param appointment_ids: (list) ids of the appointments picked, at most
+                            HEALTHNET_TRIAGE_MAX_APPOINTMENTS of them
+    :param action: (str) ACCEPT or REJECT
+    :param requester: (User) who the log entries are made for
+    :param now: (datetime) the time logged, defaults to now
+    :return: (int) the number of appointments changed
+    """
+    changes, log_action = CHANGES[action]
+    now = now or datetime.datetime.now()
+    appointment_ids = list(appointment_ids)[:settings.HEALTHNET_TRIAGE_MAX_APPOINTMENTS]
+
+    with transaction.atomic():
+        picked = pending_appointments(doctor_id).filter(pk__in=appointment_ids)
+        rows = list(picked.select_for_update().order_by().values_list('pk', 'patient_id'))
+        if not rows:
+            return 0
+
+        Appointment.objects.filter(pk__in=[pk for pk, _ in rows]).update(**changes)
+        LogEntry.objects.bulk_create([LogEntry(requester=requester, action=log_action, date=now) for _ in rows])
+
+    scopes = {LOG_SCOPE}
+    for patient_id in {patient_id for _, patient_id in rows}:
+        scopes.update(appointment_scopes(patient_id, doctor_id, hospital_id))
+    bump(*scopes)
+    return len(rows)
@@ -17,6 +17,7 @@ urlpatterns = [
     url(r'^delete_request/(?P<req_id>[0-9]+)/$', views.deleteRequest, name='delete_request'),
     url(r'^reject_request_reason/(?P<req_id>[0-9]+)/$', views.rejectRequestForm, name='reject_request_reason'),
     url(r'^$', views.base, name='base'),
+    url(r'^dashboard/(?P<name>\w+)/$', views.dashboard_panel, name='dashboard_panel'),
     url(r'^register_admin/$', views.admin_new, name='admin_new'),
     url(r'^register/$', views.patient_new, name='patient_new'),
     url(r'^register_patient/$', views.admin_patient_new, name='admin_patient_new'),
@@ -27,7 +28,7 @@ urlpatterns = [
     url(r'^delete_admin/(?P<admin_id>[0-9]+)/$', views.delete_admin, name='delete_admin'),
     url(r'^register_nurse/$', views.nurse_new, name='nurse_new'),
     url(r'^message_new/', views.message_new, name='message_new'),
-    url(r'^view_conversation/(?P<name>[-\w]+)/$', views.view_conversation, name='view_conversation'),
+    url(r'^view_conversation/(?P<conv_id>[0-9]+)/$', views.view_conversation, name='view_conversation'),
     url(r'^reply/(?P<otheruser_name>[-\w]+)/$', views.reply, name='reply'),
     url(r'^delete_nurse/(?P<nurse_id>[0-9]+)/$', views.delete_nurse, name='delete_nurse'),
     url(r'^employees/$', views.employees, name='employees'),
@@ -43,7 +44,17 @@ urlpatterns = [
     url(r'^logout/$', views.logout_user, name='logout_user'),
     url(r'^calendar/$', views.baseCalendar, name='base_calendar'),
     url(r'^calendar/(?P<themonth>[0-9]+)/(?P<theyear>[0-9]{4})$', views.calendar, name='calendar'),
+    url(r'^calendar/hospital/$', views.hospital_schedule, name='hospital_schedule'),
+    url(r'^calendar/availability/$', views.doctor_availability, name='doctor_availability'),
+    url(r'^calendar/feed/$', views.calendar_feed_settings, name='calendar_feed_settings'),
+    url(r'^calendar/feed/(?P<token>\w+)\.ics$', views.calendar_feed, name='calendar_feed'),
+    url(r'^calendar/api/(?P<themonth>[0-9]+)/(?P<theyear>[0-9]{4})/$', views.calendar_month_json,
+        name='calendar_month_json'),
+    url(r'^calendar/api/(?P<day>[0-9]+)/(?P<month>[0-9]+)/(?P<year>[0-9]{4})/$', views.calendar_day_json,
+        name='calendar_day_json'),
     url(r'^appointment/(?P<day>[0-9]+)/(?P<month>[0-9]+)/(?P<year>[0-9]{4})$', views.day_view, name='day_view'),
+    url(r'^appointments/import/$', views.import_appointments_upload, name='import_appointments'),
+    url(r'^appointments/triage/$', views.triage_appointments, name='triage_appointments'),
     url(r'^calendar/create_appointment/$', views.createAppointment,
         name='create_appointment'),
     url(r'^calendar/update_appointment/(?P<appt_id>[0-9]+)/$', views.updateAppointment,
@@ -51,6 +62,10 @@ urlpatterns = [
     url(r'^delete_appointment/(?P<appt_id>[0-9]+)/$', views.deleteAppointment, name='delete_appointment'),
     url(r'^accept_appointment/(?P<appt_id>[0-9]+)/$', views.acceptAppointment, name='accept_appointment'),
     url(r'^reject_appointment/(?P<appt_id>[0-9]+)/$', views.rejectAppointment, name='reject_appointment'),
+    url(r'^series/(?P<series_id>[0-9]+)/skip/(?P<occurrence>[0-9]{12})/$', views.skip_occurrence,
+        name='skip_occurrence'),
+    url(r'^series/(?P<series_id>[0-9]+)/accept/$', views.accept_series, name='accept_series'),
+    url(r'^series/(?P<series_id>[0-9]+)/reject/$', views.reject_series, name='reject_series'),
     url(r'^patient_info/$', views.patient_info, name='patient_info'),
     url(r'^patient_edit/$', views.patient_edit, name='patient_edit'),
     url(r'^prescriptions/(?P<patient_id>[0-9]+)/$', views.viewPatientPrescriptions, name='prescriptions'),
@@ -7,60 +7,56 @@
 from django.contrib import messages
 from django.contrib.auth import logout, login, authenticate
 from django.contrib.auth.models import User
-from django.http import HttpResponseRedirect, HttpResponseNotFound, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponseNotFound, HttpResponse, HttpResponseForbidden, JsonResponse, \
+    HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags
 from django.shortcuts import render_to_response, redirect, render, get_object_or_404
+from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.conf import settings
+from django.views.decorators.http import condition, require_POST
 from . import models
 from . import forms
-from .models import Appointment, Doctor, Patient, HospitalAdmin, Nurse, Test, Prescription, Message, Hospital, \
-    TransferRequest, TransferRequestReply, LogEntry
+from .models import Appointment, Doctor, Patient, HospitalAdmin, Nurse, Test, Prescription, Hospital, \
+    TransferRequest, TransferRequestReply, LogEntry, UserRoleIndex, RecurringAppointment, SkippedOccurrence
 import datetime
+import hashlib
 from django.utils.safestring import mark_safe
 from django.views import generic
 from .forms import EditAppointmentForm, CreateAppointmentForm, CreateTestForm, NewMessageForm
 from django.core.urlresolvers import reverse
-from .calendar import Month, ApptCalendar, DoctorCalendar
+from .calendar import ApptCalendar, DoctorCalendar, month_cache_key, owner_appointments, owner_occurrences
+from .recurrence import OCCURRENCE_FORMAT, with_occurrences
+from .triage import pending_appointments, triage, ACCEPT
+from .messaging import conversations_of, thread, mark_read
+from .schedule import parse_week, schedule_lanes
+from .windows import DateWindow, is_valid_day, is_valid_month
+from .availability import availability, hospital_doctors, parse_days
+from .appointment_import import ImportFileError, guess_format, read_rows, import_appointments
+from .ical import feed_token, reset_feed_token, feed_user, feed_window, feed_appointments, feed_etag, ics_feed
+from .roles import Role, get_role, get_request_role
+from .decorators import require_role
+from .dashboard import PANELS, panels_for, panel_cache_key
+from .scheduling import book, book_series, SlotTaken
 from django.utils import timezone
 from itertools import chain
 import csv
 
 
 def get_user_type(user):
-    admin = False
-    patient = False
-    doctor = False
-    nurse = False
+    """
+        Returns the role flags of the given user. The role itself is resolved
+        once per request (see roles.get_role)
+    :param user: the user in question
+    :return: (list) [patient, doctor, nurse, admin, hosp]
+    """
+    role = get_role(user)
     hosp = None
-    app = []
-    if Patient.objects.filter(pk=user.pk):
-        patient = True
-        p = Patient.objects.get(pk=user.pk)
-        for a in Appointment.objects.all():
-            if a.patient_id == p.id and a.accept_state != Appointment.REJECTED:
-                app.append(a)
-                app.sort(key=lambda b: b.appointment_time)
-    elif Doctor.objects.filter(pk=user.pk):
-        doctor = True
-        d = Doctor.objects.get(pk=user.pk)
-        for a in Appointment.objects.all():
-            if a.doctor_id == d.id and a.accept_state != Appointment.REJECTED:
-                app.append(a)
-                app.sort(key=lambda b: b.appointment_time)
-    elif Nurse.objects.filter(pk=user.pk):
-        nurse = True
-        n = Nurse.objects.get(pk=user.pk)
-        for a in Appointment.objects.all():
-            if a.doctor.hospital_id == n.hospital_id and a.accept_state != Appointment.REJECTED:
-                app.append(a)
-                app.sort(key=lambda b: b.appointment_time)
-    elif HospitalAdmin.objects.filter(pk=user.pk):
-        admin = True
-        admin_temp = models.HospitalAdmin.objects.get(pk=user.id)
-        hosp = admin_temp.hptal
-    some = app.__len__() != 0
-
-
-            #  0       1     2     3     4    5
-    users = [patient,doctor,nurse,admin,hosp,app,some]
+    if role.is_admin:
+        hosp = role.hospital
+
+            #  0       1     2     3     4
+    users = [role.is_patient, role.is_doctor, role.is_nurse, role.is_admin, hosp]
     return users
 
 def base(request):
@@ -72,36 +68,46 @@ def base(request):
 
     user = request.user
     users = get_user_type(user)
-    some_m = False
+    role = get_role(user)
     base = True
 
-    new_messages = []
+    # the panels are only placeholders here, filled in by dashboard_panel
+    return render(request, 'base.html', {'user': user, "admin": users[3], "patient": users[0], 'hosp':users[4],
+                                         'doctor':users[1], 'nurse':users[2], 'base':base,
+                                         'panels': panels_for(role), 'log_before': request.GET.get('log_before')})
 
-    if users[0] or users[1] or users[2] or users[3]:
-        for m in Message.objects.filter(receiver=user):
-            if not m.status:
-                new_messages.append(m)
-                some_m = True
 
-    transfers = TransferRequest.objects.order_by('patient_to_transfer__last_name').filter(
-        receiving_admin__id = user.id
-    )
+def dashboard_panel(request, name):
+    """
+        View for a single panel of the dashboard, fetched by the dashboard
+        page after it has loaded. Each panel is cached on its own until
+        something shown on it changes.
+    :param request: request for the panel
+    :param name: the name of the panel (see dashboard.PANELS)
+    :return: JSON with the rendered panel and the number of items in it
+    """
+    if name not in PANELS:
+        return HttpResponseNotFound()
 
-    transferReqs = []
+    role = get_role(request.user)
+    roles, build = PANELS[name]
+    if role.name not in roles:
+        return HttpResponseForbidden()
 
-    for transfer in transfers:
-        possible_replies = TransferRequestReply.objects.get(transfer_request__id = transfer.id)
-        if( possible_replies.acceptance_reply == TransferRequestReply.PENDING):
-            transferReqs.append(transfer)
+    # only the first page of the log is cached
+    cache_key = None
+    panel = None
+    if 'log_before' not in request.GET:
+        cache_key = panel_cache_key(name, role)
+        panel = cache.get(cache_key)
 
-    transferReplies = TransferRequestReply.objects.order_by('transfer_request__patient_to_transfer__last_name').filter(
-        receiver__id = user.id
-    )
+    if panel is None:
+        context, count = build(role, request)
+        panel = {'html': render_to_string('panels/%s.html' % name, context, request=request), 'count': count}
+        if cache_key is not None:
+            cache.set(cache_key, panel, settings.HEALTHNET_DASHBOARD_CACHE_TIMEOUT)
 
-    return render(request, 'base.html', {'user': user, "admin": users[3], "patient": users[0], 'hosp':users[4],
-                                         'doctor':users[1], 'nurse':users[2], 'apps': users[5], 'some':users[6], 'new_messages':new_messages, 'some_m':some_m, 'transferReqs': transferReqs,
-                                         'transferReplies': transferReplies, 'base':base, 'entries': LogEntry.objects.all(),
-                                         'now': timezone.now(), '24HoursAgo': datetime.datetime.now()-datetime.timedelta(days=1)})
+    return JsonResponse(panel)
 
 def baseCalendar(request):
     """
@@ -292,136 +298,316 @@ def logout_user(request):
     logout(request)
     return redirect('base')
 
-def calendar(request, themonth, theyear):
+def calendar_etag(request, themonth, theyear):
+    """
+        Returns the ETag of a month calendar. It is worked out from cached
+        versions only, so browsers paging back and forth between months are
+        answered with 304 Not Modified without touching the database.
+    :param request: request to view the calendar
+    :param themonth: (str) the month
+    :param theyear: (str) the year
+    :return: (str) the ETag, or None if the calendar can't be shown
+    """
+    role = get_request_role(request)
+    month = int(themonth)
+    year = int(theyear)
+    if role.name not in (Role.PATIENT, Role.DOCTOR, Role.NURSE) or not 1 <= month <= 12 or year < 1900:
+        return None
+
+    return hashlib.md5(month_cache_key(role, month, year).encode()).hexdigest()
+
+
+def calendar_month_json_etag(request, themonth, theyear):
+    """
+        Returns the ETag of a month of the calendar API, worked out from
+        cached versions only like the calendar page's
+    :param request: request for the month
+    :param themonth: (str) the month
+    :param theyear: (str) the year
+    :return: (str) the ETag, or None if the month can't be shown
+    """
+    role = get_request_role(request)
+    month = int(themonth)
+    year = int(theyear)
+    if role.name not in (Role.PATIENT, Role.DOCTOR, Role.NURSE) or not 1 <= month <= 12 or year < 1900:
+        return None
+
+    return hashlib.md5(('%s:json' % month_cache_key(role, month, year)).encode()).hexdigest()
+
+
+@condition(etag_func=calendar_month_json_etag)
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE, profile=False)
+def calendar_month_json(request, role, themonth, theyear):
+    """
+        Returns a month of the user's calendar as JSON for the calendar page
+        to render in the browser: the grid of days and the status of each
+        day with appointments. Months are cached like the rendered ones.
+    :param request: GET for the month
+    :param role: the Role of the patient, doctor or nurse requesting the month
+    :param themonth: (str) the month
+    :param theyear: (str) the year
+    :return: JSON of the month
+    """
+    month = int(themonth)
+    year = int(theyear)
+    if not is_valid_month(month, year):
+        return HttpResponseNotFound()
+
+    cache_key = month_cache_key(role, month, year) + ':json'
+    data = cache.get(cache_key)
+    if data is None:
+        calendar_class = DoctorCalendar if role.is_doctor else ApptCalendar
+        window = DateWindow.month(month, year)
+        cal = calendar_class(month, year, owner_appointments(role).filter(**window.lookup()),
+                             owner_occurrences(role, window))
+        data = cal.month_data()
+        cache.set(cache_key, data, settings.HEALTHNET_CALENDAR_CACHE_TIMEOUT)
+
+    return JsonResponse(data)
+
+
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE, profile=False)
+def calendar_day_json(request, role, day, month, year):
+    """
+        Returns the user's appointments on a day as JSON, for the calendar
+        page to show when a day is picked
+    :param request: GET for the day
+    :param role: the Role of the patient, doctor or nurse requesting the day
+    :param day: the day
+    :param month: the month
+    :param year: the year
+    :return: JSON of the day's appointments
+    """
+    day = int(day)
+    month = int(month)
+    year = int(year)
+    if not is_valid_day(day, month, year):
+        return HttpResponseNotFound()
+
+    window = DateWindow.day(datetime.date(year, month, day))
+    rows = owner_appointments(role).filter(**window.lookup()).order_by('appointment_time').values_list(
+        'id', 'appointment_time', 'reason', 'accept_state',
+        'doctor__first_name', 'doctor__last_name', 'patient__first_name', 'patient__last_name',
+    )
+
+    appointments = [{
+        'id': appt_id,
+        'series': None,
+        'time': time.strftime('%H:%M'),
+        'reason': reason,
+        'state': state,
+        'doctor': '%s %s' % (doctor_first, doctor_last),
+        'patient': '%s %s' % (patient_first, patient_last),
+    } for appt_id, time, reason, state, doctor_first, doctor_last, patient_first, patient_last in rows]
+    appointments.extend({
+        'id': None,
+        'series': occurrence.series.pk,
+        'time': occurrence.appointment_time.strftime('%H:%M'),
+        'reason': occurrence.reason,
+        'state': occurrence.accept_state,
+        'doctor': '%s %s' % (occurrence.doctor.first_name, occurrence.doctor.last_name),
+        'patient': '%s %s' % (occurrence.patient.first_name, occurrence.patient.last_name),
+    } for occurrence in owner_occurrences(role, window))
+
+    return JsonResponse({'appointments': sorted(appointments, key=lambda appointment: appointment['time'])})
+
+
+@condition(etag_func=calendar_etag)
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE, profile=False)
+def calendar(request, role, themonth, theyear):
     """
         Renders the calendar specific to the user requesting it. If the
         user is a patient or a doctor, he/she can only see their own
         appointments. If the user is a nurse, then he/she can see all of
-        the appointments
+        the appointments. The rendered month is cached until one of the
+        appointments on it changes.
     :param request: request to view the calendar
+    :param role: the Role of the patient, doctor or nurse requesting the calendar
     :param themonth: (str) the current month
     :param theyear: (str) the current year
     :return: a rendering of the user-unique calendar
     """
-    if Patient.objects.filter(pk=request.user.id) or Doctor.objects.filter(pk=request.user.id) or Nurse.objects.filter(pk=request.user.id):
-        month = int(themonth)
-        year = int(theyear)
-        doctor = False
-        nurse = False
-        patient = False
+    month = int(themonth)
+    year = int(theyear)
+    doctor = role.is_doctor
+    nurse = role.is_nurse
+    patient = role.is_patient
 
-        if((month < 1) or (month > 12) or (year < 1900)):
-            return HttpResponseNotFound('<h1>Not a valid month/year</h1>')
+    if not is_valid_month(month, year):
+        return HttpResponseNotFound('<h1>Not a valid month/year</h1>')
 
-        user = request.user
+    calendar_class = DoctorCalendar if doctor else ApptCalendar
+
+    cache_key = month_cache_key(role, month, year)
+    calMonth = cache.get(cache_key)
+    if calMonth is None:
+        window = DateWindow.month(month, year)
+        cal = calendar_class(month, year, owner_appointments(role).filter(**window.lookup()),
+                             owner_occurrences(role, window))
+        calMonth = cal.format_month(month, year)
+        cache.set(cache_key, calMonth, settings.HEALTHNET_CALENDAR_CACHE_TIMEOUT)
+
+    # get the previous month and year to get the correct link in template
+    prevYear = year
+    prevMonth = month - 1
+    if (prevMonth < 1):
+        prevMonth = 12
+        prevYear -= 1
+    prevMonthName = calendar_class.months[prevMonth]
+
+    # get the next month and year to get the correct link in template
+    nextYear = year
+    nextMonth = month + 1
+    if (nextMonth > 12):
+        nextMonth = 1
+        nextYear += 1
+    nextMonthName = calendar_class.months[nextMonth]
+    is_calendar = True
+
+    return render_to_response('calendar.html', {
+        'month_format': mark_safe(calMonth),
+        'month': calendar_class.months[month],
+        'themonth': month,
+        'year': str(year),
+        'prevMonth': str(prevMonth),
+        'prevYear': str(prevYear),
+        'prevMonthName': prevMonthName,
+        'nextMonth': str(nextMonth),
+        'nextYear': str(nextYear),
+        'nextMonthName': nextMonthName,
+        'patient': patient, 'doctor': doctor, 'nurse': nurse, 'is_calendar':is_calendar
+    })
 
-        if (Patient.objects.filter(pk=user.pk)):
-            my_appointments = Appointment.objects.order_by('appointment_time').filter(
-                appointment_time__year=year, appointment_time__month=month, patient__username=user.username,
-            )
-            cal = ApptCalendar(month, year, my_appointments)
-            patient = True
 
-        elif (Doctor.objects.filter(pk=user.pk)):
-            my_appointments = Appointment.objects.order_by('appointment_time').filter(
-                appointment_time__year=year, appointment_time__month=month, doctor__username=user.username,
-            )
-            cal = DoctorCalendar(month, year, my_appointments)
-            doctor = True
+@require_role(Role.NURSE, profile=False)
+def hospital_schedule(request, role):
+    """
+        Renders a week of the nurse's hospital in lanes, one per doctor,
+        showing which of each doctor's slots are taken. Doctors are paged
+        through with the page parameter, and weeks with the week parameter
+    :param request: request to view the schedule
+    :param role: the Role of the nurse
+    :return: rendering of the hospital schedule
+    """
+    week = parse_week(request.GET.get('week'))
+    doctors, lanes = schedule_lanes(role.hospital_id, week, request.GET.get('page', 1))
 
-        else:
-            nurse = Nurse.objects.get(pk=user.id)
-            hospital = nurse.hospital_id
-            my_appointments = Appointment.objects.order_by('appointment_time').filter(
-                appointment_time__year=year, appointment_time__month=month, doctor__hospital_id=hospital
-            )
-            cal = ApptCalendar(month, year, my_appointments)
-            nurse = True
+    return render_to_response('hospital_schedule.html', {
+        'doctors': doctors,
+        'lanes': lanes,
+        'week': week,
+        'days': [week + datetime.timedelta(days=i) for i in range(7)],
+        'prev_week': week - datetime.timedelta(days=7),
+        'next_week': week + datetime.timedelta(days=7),
+        'nurse': True, 'is_calendar': True,
+    })
 
-        calMonth = cal.format_month(month, year)
 
-        # get the previous month and year to get the correct link in template
-        prevYear = year
-        prevMonth = month - 1
-        if (prevMonth < 1):
-            prevMonth = 12
-            prevYear -= 1
-        prevMonthName = cal.months[prevMonth]
-
-        # get the next month and year to get the correct link in template
-        nextYear = year
-        nextMonth = month + 1
-        if (nextMonth > 12):
-            nextMonth = 1
-            nextYear += 1
-        nextMonthName = cal.months[nextMonth]
-        is_calendar = True
-
-        return render_to_response('calendar.html', {
-            'calendar': cal,
-            'month_format': mark_safe(calMonth),
-            'month': cal.months[month],
-            'year': str(year),
-            'prevMonth': str(prevMonth),
-            'prevYear': str(prevYear),
-            'prevMonthName': prevMonthName,
-            'nextMonth': str(nextMonth),
-            'nextYear': str(nextYear),
-            'nextMonthName': nextMonthName,
-            'patient': patient, 'doctor': doctor, 'nurse': nurse, 'is_calendar':is_calendar
-        })
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE, profile=False)
+def doctor_availability(request, role):
+    """
+        Returns the open appointment slots of the doctors of the user's
+        hospital as JSON, so a time can be picked before booking. A single
+        doctor can be asked for with the doctor parameter, and the days
+        with start and end (YYYY-MM-DD, end not included).
+    :param request: GET for the slots
+    :param role: the Role of the patient, doctor or nurse asking
+    :return: JSON of each doctor's open slots by day
+    """
+    doctor_id = request.GET.get('doctor')
+    if doctor_id is not None and not doctor_id.isdigit():
+        return HttpResponseNotFound()
+
+    doctors = list(hospital_doctors(role.hospital_id, int(doctor_id) if doctor_id else None))
+    if doctor_id and not doctors:
+        return HttpResponseNotFound()
+
+    start, end = parse_days(request.GET.get('start'), request.GET.get('end'))
+    return JsonResponse({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'doctors': availability(doctors, start, end),
+    })
+
+
+def calendar_feed(request, token):
+    """
+        Streams the iCalendar feed of the user the token was made for, so
+        calendar apps can sync appointments without a login. Clients may
+        pass start and end (YYYYMMDD) to sync a window at a time, and get
+        304 Not Modified while nothing in their window has changed.
+    :param request: GET for the feed
+    :param token: the user's feed token
+    :return: the .ics feed
+    """
+    role = get_role(feed_user(token))
+    if role.name not in (Role.PATIENT, Role.DOCTOR, Role.NURSE):
+        return HttpResponseNotFound()
+
+    start, end = feed_window(request.GET.get('start'), request.GET.get('end'))
+    etag = feed_etag(role, start, end)
+
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
     else:
-        return render_to_response('error.html')
+        response = StreamingHttpResponse(ics_feed(feed_appointments(role, start, end), request.get_host()),
+                                         content_type='text/calendar; charset=utf-8')
+        response['Content-Disposition'] = 'inline; filename="healthnet.ics"'
+
+    response['ETag'] = 'W/"%s"' % etag
+    return response
 
 
-def day_view(request, day, month, year):
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE, profile=False)
+def calendar_feed_settings(request, role):
+    """
+        Shows the url of the user's calendar feed, making the feed the first
+        time it is opened, and gives the feed a new url, so that a url that
+        was shared or leaked stops working
+    :param request: GET for the url, POST for a new one
+    :param role: the Role of the patient, doctor or nurse
+    :return: rendering of the feed's url, or a redirect back to it once a
+                new one is made
+    """
+    if request.method == 'POST':
+        reset_feed_token(role.user.pk)
+        messages.success(request, 'Your calendar feed has a new link. Calendar apps using the old one will stop '
+                                  'getting your appointments.')
+        return redirect('calendar_feed_settings')
+
+    return render(request, 'calendar_feed.html', {
+        'feed_url': request.build_absolute_uri(reverse('calendar_feed', args=[feed_token(role.user.pk)])),
+    })
+
+
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE, profile=False)
+def day_view(request, role, day, month, year):
     """
         Detail view for viewing the appointments for a specific day
     :param request: GET
+    :param role: the Role of the patient, doctor or nurse viewing the day
     :param day: Day in current month and year to look at
     :return: Rendering of the appointments
     """
     day = int(day)
     month = int(month)
     year = int(year)
-    doctor = False
-    nurse = False
-    patient = False
+    doctor = role.is_doctor
+    nurse = role.is_nurse
+    patient = role.is_patient
 
     # making sure the inputs for month, day and year are valid
-    if ((month < 1) or (month > 12) or (year < 1900) or (day > Month.days_in_month[month-1]) or (day < 1)):
+    if not is_valid_day(day, month, year):
         return HttpResponseNotFound('<h1>Not a valid month/year/day</h1>')
 
-    user = request.user
-    template = 'listAppointments.html'
+    template = 'listAppointmentsDoctor.html' if doctor else 'listAppointments.html'
+    window = DateWindow.day(datetime.date(year, month, day))
+    my_appointments = owner_appointments(role).order_by('appointment_time').filter(**window.lookup())
 
-    if (Patient.objects.filter(pk=user.pk)):
-        my_appointments = Appointment.objects.order_by('appointment_time').filter(
-            appointment_time__year=year, appointment_time__month=month, patient__username=user.username,
-            appointment_time__day=day
-        )
-        patient = True
-
-    elif (Doctor.objects.filter(pk=user.pk)):
-        my_appointments = Appointment.objects.order_by('appointment_time').filter(
-            appointment_time__year=year, appointment_time__month=month, doctor__username=user.username,
-            appointment_time__day=day,
-        )
-
-        my_appointments = my_appointments.exclude(accept_state=Appointment.REJECTED)
-
-        template = 'listAppointmentsDoctor.html'
-        doctor = True
-
-    else:
-        my_appointments = Appointment.objects.order_by('appointment_time').filter(
-            appointment_time__year=year, appointment_time__month=month,
-            appointment_time__day=day
-        )
-        nurse = True
-
-    return render_to_response(template, {
-        'appointments': my_appointments,
+    return render(request, template, {
+        # the day's occurrences of recurring series are listed in among them
+        'appointments': list(with_occurrences(my_appointments.select_related('doctor', 'patient'),
+                                              owner_occurrences(role, window))),
         'themonth': month,
         'theyear': year,
         'theday': day,
@@ -456,27 +642,19 @@ def employees(request):
     admins = []
     patients = []
 
+    role = get_role(this_user)
+    hosp = role.hospital_id if role.is_admin else None
+
+    # one indexed lookup finds everyone in the admin's hospital
+    staff = {
+        UserRoleIndex.DOCTOR: doctors,
+        UserRoleIndex.NURSE: nurses,
+        UserRoleIndex.ADMIN: admins,
+        UserRoleIndex.PATIENT: patients,
+    }
+    for entry in UserRoleIndex.objects.filter(hospital_id=hosp).select_related('user').order_by('user_id'):
+        staff[entry.role].append(entry.user)
 
-    if HospitalAdmin.objects.filter(pk=this_user.pk):
-        admin_temp = models.HospitalAdmin.objects.get(pk=this_user.id)
-        hosp = admin_temp.hptal
-    for user in models.User.objects.all():
-        if models.Doctor.objects.filter(pk=user.pk):
-            doc_temp = models.Doctor.objects.get(pk=user.id)
-            if doc_temp.hospital == hosp:
-                doctors.append(user)
-        elif models.Nurse.objects.filter(pk=user.pk):
-            nur_temp = models.Nurse.objects.get(pk=user.id)
-            if nur_temp.hospital == hosp:
-                nurses.append(user)
-        elif models.HospitalAdmin.objects.filter(pk=user.pk):
-            admin_temp = models.HospitalAdmin.objects.get(pk=user.id)
-            if admin_temp.hptal == hosp:
-                admins.append(user)
-        elif models.Patient.objects.filter(pk=user.pk):
-            pat_temp = models.Patient.objects.get(pk=user.id)
-            if pat_temp.hospital == hosp:
-                patients.append(user)
     if not this_user.is_anonymous():
         user = request.user
         users = get_user_type(user)
@@ -491,18 +669,13 @@ def patients(request):
         allow hospital admin to either register patients or delete them
     """
     this_user = request.user
-    patients = []
-    hosp = None
 
-    if HospitalAdmin.objects.filter(pk=this_user.pk):
-        admin_temp = models.HospitalAdmin.objects.get(pk=this_user.id)
-        hosp = admin_temp.hptal
-    for user in models.User.objects.all():
-        if models.Patient.objects.filter(pk=user.pk):
-            pat_temp = models.Patient.objects.get(pk=user.id)
-            if pat_temp.hospital == hosp:
-                patients.append(user)
-    if HospitalAdmin.objects.filter(pk=request.user.id):
+    role = get_role(this_user)
+    if role.is_admin:
+        patients = User.objects.filter(
+            role_index__hospital_id=role.hospital_id, role_index__role=UserRoleIndex.PATIENT,
+        ).order_by('id')
+
         user = request.user
         users = get_user_type(user)
         return render(request, 'patients.html', {'user': this_user, "admin": users[3], "patient": users[0], 'hosp': users[4],
@@ -603,10 +776,12 @@ def med_info_edit(request, patient_id):
 
 
 
-def createAppointment(request):
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE)
+def createAppointment(request, profile):
     """
             view for creating a new appointment
             :param request: the request for loading the messages page
+            :param profile: the Patient, Doctor or Nurse creating the appointment
             :return: Redirect to the 1)base calender after creating 2)form
     """
 
@@ -614,74 +789,105 @@ def createAppointment(request):
     users = get_user_type(user)
     is_patient = True
 
-    if Doctor.objects.filter(pk=request.user.id) or Patient.objects.filter(pk=request.user.id) or Nurse.objects.filter(pk=request.user.id):
-        if request.method == 'POST':
-            user = request.user
-            form = forms.CreateAppointmentForm(request.POST)
-            if form.is_valid():
-                form.save()
-                log = LogEntry(requester=request.user, action="Appointment Creation", date=datetime.datetime.now())
-                log.save()
-                return redirect('base_calendar')
+    if request.method == 'POST':
+        form = forms.CreateAppointmentForm(request.POST)
+        if form.is_valid() and form.book():
+            log = LogEntry(requester=request.user, action="Appointment Creation", date=datetime.datetime.now())
+            log.save()
+            return redirect('base_calendar')
+    else:
+        hospital = profile.hospital_id
+        if(users[0]):   # if the user is a patient, send in the patient as the inital value
+            form = CreateAppointmentForm(initial={'patient': profile.pk, 'doctor': profile.patient_doctor_id})
+            form.fields['doctor'].queryset = Doctor.objects.filter(hospital_id=hospital)
+        elif(users[1]):           # else, send in the id of the user as the doctor
+            form = CreateAppointmentForm(initial={'doctor': profile.pk})
+            form.fields['patient'].queryset = Patient.objects.filter(hospital_id=hospital)
+            is_patient = False
         else:
-            if(users[0]):   # if the user is a patient, send in the patient as the inital value
-                patient = Patient.objects.get(pk=user.id)
-                doctor = Doctor.objects.get(pk=patient.patient_doctor.id)
-                hospital = patient.hospital_id
-                form = CreateAppointmentForm(initial={'patient': patient, 'doctor': doctor})
-                form.fields['doctor'].queryset = Doctor.objects.filter(hospital_id=hospital)
-            elif(users[1]):           # else, send in the id of the user as the doctor
-                doctor = Doctor.objects.get(pk=user.id)
-                hospital = doctor.hospital_id
-                form = CreateAppointmentForm(initial={'doctor': doctor})
-                form.fields['patient'].queryset = Patient.objects.filter(hospital_id=hospital)
-                is_patient = False
-            else:
-                form = CreateAppointmentForm()
-                nurse = Nurse.objects.get(pk=user.id)
-                hospital = nurse.hospital_id
-                form.fields['patient'].queryset = Patient.objects.filter(hospital_id=hospital)
-                form.fields['doctor'].queryset = Doctor.objects.filter(hospital_id=hospital)
+            form = CreateAppointmentForm()
+            form.fields['patient'].queryset = Patient.objects.filter(hospital_id=hospital)
+            form.fields['doctor'].queryset = Doctor.objects.filter(hospital_id=hospital)
 
-        return render(request, 'create_appointment.html', {'form': form, 'user': user, "admin": users[3],
-                                                               "patient": users[0], 'hosp': users[4], 'doctor': users[1],
-                                                               'nurse': users[2], 'is_patient': is_patient })
-    else:
-        return render_to_response('error.html')
+    return render(request, 'create_appointment.html', {'form': form, 'user': user, "admin": users[3],
+                                                           "patient": users[0], 'hosp': users[4], 'doctor': users[1],
+                                                           'nurse': users[2], 'is_patient': is_patient })
 
-def updateAppointment(request, appt_id):
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE)
+def updateAppointment(request, profile, appt_id):
     """
         view for updating and appointment
         :param request: the request for updating an appointment
+        :param profile: the Patient, Doctor or Nurse updating the appointment
         :return: Redirect to the create appointment form
     """
-    if Nurse.objects.filter(pk=request.user.id) or Doctor.objects.filter(pk=request.user.id) or Patient.objects.filter(
-            pk=request.user.id):
-        instance = get_object_or_404(Appointment, pk=appt_id)
-        user = request.user
+    instance = get_object_or_404(Appointment, pk=appt_id)
+    user = request.user
 
-        if request.method == 'POST':
-            form = forms.EditAppointmentForm(request.POST, instance=instance)
-            form.doctor = instance.doctor_id
-            form.patient = instance.patient_id
-            if form.is_valid():
-                form.save()
-                form.instance.toggle_pending()
+    if request.method == 'POST':
+        form = forms.EditAppointmentForm(request.POST, instance=instance)
+        form.doctor = instance.doctor_id
+        form.patient = instance.patient_id
+        # an edited appointment goes back to pending, and is booked as such,
+        # so a rejected one is checked for the time it takes back
+        instance.accept_state = Appointment.PENDING
+        if form.is_valid() and form.book():
+            log = LogEntry(requester=request.user, action="Appointment Update", date=datetime.datetime.now())
+            log.save()
+            return redirect('base_calendar')
 
-                log = LogEntry(requester=request.user, action="Appointment Update", date=datetime.datetime.now())
-                log.save()
-                return redirect('base_calendar')
+    else:
+        form = forms.EditAppointmentForm(instance=instance)
 
-        else:
-            form = forms.EditAppointmentForm(instance=instance)
+    users = get_user_type(user)
+    return render(request, 'edit_appointment.html',
+                  {'form': form, 'user': user, "admin": users[3], "patient": users[0], 'hosp': users[4],
+                   'doctor': users[1],
+                   'nurse': users[2]})
 
-        users = get_user_type(user)
-        return render(request, 'edit_appointment.html',
-                      {'form': form, 'user': user, "admin": users[3], "patient": users[0], 'hosp': users[4],
-                       'doctor': users[1],
-                       'nurse': users[2]})
+
+@require_role(Role.ADMIN, profile=False)
+def import_appointments_upload(request, role):
+    """
+        Lets a hospital admin upload a batch of appointments for the
+        hospital's doctors and patients, and shows which rows were turned
+        down and why
+    :param request: GET for the form, POST with the batch
+    :param role: the Role of the admin
+    :return: rendering of the form and the import report
+    """
+    report = None
+    rows = []
+    dry_run = False
+
+    if request.method == 'POST':
+        form = forms.AppointmentImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            batch = form.cleaned_data['batch']
+            dry_run = form.cleaned_data['dry_run']
+            try:
+                file_format = guess_format(batch.name)
+                if file_format is None:
+                    raise ImportFileError('Upload a .csv or .json file')
+                rows = read_rows(batch.read().decode('utf-8-sig'), file_format)
+            except UnicodeDecodeError:
+                form.add_error('batch', 'The file must be UTF-8 text')
+            except ImportFileError as error:
+                form.add_error('batch', str(error))
+            else:
+                report = import_appointments(rows, hospital_id=role.hospital_id, dry_run=dry_run)
+                if report.created and not dry_run:
+                    log = LogEntry(requester=request.user, action="Appointment Import", date=datetime.datetime.now())
+                    log.save()
     else:
-        return render_to_response('error.html')
+        form = forms.AppointmentImportForm()
+
+    return render(request, 'import_appointments.html', {
+        'form': form,
+        'report': report,
+        'rows': len(rows),
+        'dry_run': dry_run,
+    })
 
 
 def deleteAppointment(request, appt_id):
@@ -710,7 +916,15 @@ def acceptAppointment(request, appt_id):
     """
     if Doctor.objects.filter(pk=request.user.id):
         acceptAppt = get_object_or_404(Appointment, pk=appt_id)
-        acceptAppt.acceptAppointment(commit=True)
+        acceptAppt.acceptAppointment(commit=False)
+        try:
+            # a rejected appointment gave up its time, which may have been taken since
+            book(acceptAppt)
+        except SlotTaken as taken:
+            messages.error(request, "The appointment can't be accepted, as the %s has another appointment "
+                                    "within half an hour of it." % taken.conflict.party)
+            time = acceptAppt.appointment_time
+            return HttpResponseRedirect(reverse('day_view', args=[time.day, time.month, time.year]))
         log = LogEntry(requester=request.user, action="Appointment Accepted", date=datetime.datetime.now())
         log.save()
 
@@ -739,6 +953,115 @@ def rejectAppointment(request, appt_id):
     else:
         return render_to_response('error.html')
 
+@require_role(Role.DOCTOR, profile=False)
+def triage_appointments(request, role):
+    """
+        Lists the doctor's pending appointments with a box to tick for each,
+        and accepts or rejects the ticked ones all at once
+    :param request: GET for the list, POST with the action and the ticked
+                    appointments
+    :param role: the Role of the doctor
+    :return: rendering of the list, or a redirect back to it once a batch
+                is done
+    """
+    if request.method == 'POST':
+        form = forms.TriageForm(request.POST)
+        if form.is_valid():
+            action = form.cleaned_data['action']
+            changed = triage(role.user.pk, role.hospital_id, form.cleaned_data['appointments'], action, request.user)
+            messages.success(request, '%d appointment%s %s' % (changed, '' if changed == 1 else 's',
+                                                               'accepted' if action == ACCEPT else 'rejected'))
+            return redirect('triage_appointments')
+    else:
+        form = forms.TriageForm()
+
+    return render(request, 'triage_appointments.html', {
+        'form': form,
+        'appointments': pending_appointments(role.user.pk),
+    })
+
+
+@require_POST
+@require_role(Role.PATIENT, Role.DOCTOR, profile=False)
+def skip_occurrence(request, role, series_id, occurrence):
+    """
+        Skips one occurrence of a recurring series, leaving the rest of the
+        series as it is
+    :param request: the request to skip the occurrence
+    :param role: the Role of the series' patient or doctor
+    :param series_id: the id of the series
+    :param occurrence: the time of the occurrence, as YYYYMMDDHHMM
+    :return: Redirect to the occurrence's day
+    """
+    series = get_object_or_404(RecurringAppointment, pk=series_id)
+    if role.user.pk not in (series.doctor_id, series.patient_id):
+        return render_to_response('error.html')
+
+    try:
+        time = datetime.datetime.strptime(occurrence, OCCURRENCE_FORMAT)
+    except ValueError:
+        return HttpResponseNotFound()
+    # the occurrence in the minute given, if the series has one
+    time = next(series.occurrences(time, time + datetime.timedelta(minutes=1)), None)
+    if time is None:
+        return HttpResponseNotFound()
+
+    SkippedOccurrence.objects.get_or_create(series=series, occurrence=time)
+    log = LogEntry(requester=request.user, action="Appointment Skipped", date=datetime.datetime.now())
+    log.save()
+
+    return HttpResponseRedirect(reverse('day_view', args=[time.day, time.month, time.year]))
+
+
+def _series_state(request, role, series_id, state, action):
+    series = get_object_or_404(RecurringAppointment, pk=series_id, doctor_id=role.user.pk)
+    # a rejected series gave up its times, which may have been taken since
+    rebook = series.accept_state == Appointment.REJECTED and state != Appointment.REJECTED
+    series.accept_state = state
+    if rebook:
+        try:
+            book_series(series)
+        except SlotTaken as taken:
+            messages.error(request, "The series can't be accepted, as on %s the %s has another appointment "
+                                    "within half an hour of it." % (taken.occurrence.strftime('%Y-%m-%d %H:%M'),
+                                                                    taken.conflict.party))
+            time = taken.occurrence
+            return HttpResponseRedirect(reverse('day_view', args=[time.day, time.month, time.year]))
+    else:
+        series.save(update_fields=['accept_state'])
+    log = LogEntry(requester=request.user, action=action, date=datetime.datetime.now())
+    log.save()
+
+    today = datetime.date.today()
+    return HttpResponseRedirect(reverse('calendar', args=[today.month, today.year]))
+
+
+@require_POST
+@require_role(Role.DOCTOR, profile=False)
+def accept_series(request, role, series_id):
+    """
+        Accepts every occurrence of a recurring series at once
+    :param request: the request to accept the series
+    :param role: the Role of the series' doctor
+    :param series_id: the id of the series
+    :return: Redirect to the calendar
+    """
+    return _series_state(request, role, series_id, Appointment.ACCEPTED, "Appointment Series Accepted")
+
+
+@require_POST
+@require_role(Role.DOCTOR, profile=False)
+def reject_series(request, role, series_id):
+    """
+        Rejects every occurrence of a recurring series at once
+    :param request: the request to reject the series
+    :param role: the Role of the series' doctor
+    :param series_id: the id of the series
+    :return: Redirect to the calendar
+    """
+    return _series_state(request, role, series_id, Appointment.REJECTED, "Appointment Series Rejected")
+
+
 def patient_edit(request):
     """
         View for editing the patient information using a specific patient edit form
@@ -769,54 +1092,42 @@ def patient_edit(request):
     else:
         return render_to_response('error.html')
 
-def viewPatientPrescriptions(request, patient_id):
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE)
+def viewPatientPrescriptions(request, profile, patient_id):
     """
         View for Patient, Doctor, or Nurse to see the selected Patient's list of Prescriptions
     :param request: request to view list of Patient's Prescriptions
+    :param profile: the Patient, Doctor or Nurse viewing the Prescriptions
     :param patient_id: id of the Patient who's Prescriptions you'd like to view
     :return: list of the Patient's Prescriptions
     """
-    if Nurse.objects.filter(pk=request.user.id) or Doctor.objects.filter(pk=request.user.id) or Patient.objects.filter(
-            pk=request.user.id):
-        user = request.user
-        if(models.Patient.objects.filter(pk=user.id)):
-            # requesting user is the Patient
-            patient = models.Patient.objects.get(pk=user.id)
-            patient_prescriptions = Prescription.objects.order_by('-datePrescribed').filter(patientAssigned=patient)
-            patient.prescriptions = patient_prescriptions
-            user = request.user
-            users = get_user_type(user)
-            return render_to_response('prescriptions_list.html',
-                                      {'prescriptions': patient_prescriptions, 'patient1': patient, "admin": users[3], "patient": users[0], 'hosp': users[4],
-                       'doctor': users[1],
-                       'nurse': users[2]})
+    user = request.user
+    users = get_user_type(user)
 
-        elif(models.Doctor.objects.filter(pk=user.id)):
-            # requesting user is a Doctor
-            patient = models.Patient.objects.get(pk=patient_id)
-            patient_prescriptions = Prescription.objects.order_by('-datePrescribed').filter(patientAssigned=patient)
-            patient.prescriptions = patient_prescriptions
-            user = request.user
-            users = get_user_type(user)
-            return render_to_response('prescriptions_list_doctor.html',
-                                      {'prescriptions': patient_prescriptions, 'patient1': patient, "admin": users[3], "patient": users[0], 'hosp': users[4],
-                       'doctor': users[1],
-                       'nurse': users[2]})
+    if users[0]:
+        # requesting user is the Patient
+        patient = profile
+        template = 'prescriptions_list.html'
+
+    elif users[1]:
+        # requesting user is a Doctor
+        patient = get_object_or_404(Patient, pk=patient_id)
+        template = 'prescriptions_list_doctor.html'
 
-        elif(models.Nurse.objects.filter(pk=user.id)):
-            # requesting user is a Nurse
-            patient = models.Patient.objects.get(pk=patient_id)
-            nurse = models.Nurse.objects.get(pk=user.id)
-            if nurse.hospital == patient.hospital:
-                patient_prescriptions = Prescription.objects.order_by('-datePrescribed').filter(patientAssigned=patient)
-                patient.prescriptions = patient_prescriptions
-                user = request.user
-                users = get_user_type(user)
-                return render_to_response('prescriptions_list_nurse.html',
-                                          {'prescriptions': patient_prescriptions, 'patient1': patient, "admin": users[3], "patient": users[0], 'hosp': users[4],
-                                            'doctor': users[1], 'nurse': users[2]})
     else:
-        return render_to_response('error.html')
+        # requesting user is a Nurse, who can only see patients of their hospital
+        patient = get_object_or_404(Patient, pk=patient_id)
+        if profile.hospital_id != patient.hospital_id:
+            return render_to_response('error.html')
+        template = 'prescriptions_list_nurse.html'
+
+    patient_prescriptions = Prescription.objects.order_by('-datePrescribed').filter(
+        patientAssigned=patient
+    ).select_related('patientAssigned', 'doctorAssigned')
+    patient.prescriptions = patient_prescriptions
+    return render_to_response(template,
+                              {'prescriptions': patient_prescriptions, 'patient1': patient, "admin": users[3], "patient": users[0], 'hosp': users[4],
+                               'doctor': users[1], 'nurse': users[2]})
 
 
 
@@ -905,25 +1216,22 @@ def reviewPrescription(request, prescrip_id):
     else:
         return render_to_response('error.html')
 
-def deletePrescription(request, prescrip_id):
+@require_role(Role.PATIENT, Role.DOCTOR, Role.NURSE)
+def deletePrescription(request, profile, prescrip_id):
     """
     Deletes a given Prescription from the list of Prescriptions
     :param request: the request to delete the Prescription
+    :param profile: the Patient, Doctor or Nurse deleting the Prescription
     :param prescrip_id: the id of the Prescription to be deleted
     :return: Redirect to the list of Prescriptions
     """
-
-    if Nurse.objects.filter(pk=request.user.id) or Doctor.objects.filter(pk=request.user.id) or Patient.objects.filter(
-            pk=request.user.id):
-        delPrescrip = get_object_or_404(Prescription, pk=prescrip_id)
-        patient = delPrescrip.patientAssigned
-        delPrescrip.delete()
-        log = LogEntry(requester=request.user, action="Prescription Deletion: " + patient.username,
-                       date=datetime.datetime.now())
-        log.save()
-        return HttpResponseRedirect(reverse('prescriptions', kwargs={'patient_id': patient.id}))
-    else:
-        return render_to_response('error.html')
+    delPrescrip = get_object_or_404(Prescription.objects.select_related('patientAssigned'), pk=prescrip_id)
+    patient = delPrescrip.patientAssigned
+    delPrescrip.delete()
+    log = LogEntry(requester=request.user, action="Prescription Deletion: " + patient.username,
+                   date=datetime.datetime.now())
+    log.save()
+    return HttpResponseRedirect(reverse('prescriptions', kwargs={'patient_id': patient.id}))
 
 
 def createTest(request):
@@ -1208,7 +1516,7 @@ def test_results(request):
 
 
         return render(request, 'test_results.html', {'user': user, "admin": users[3], "patient": users[0], 'hosp': users[4],
-                                             'doctor': users[1], 'nurse': users[2], 'apps': users[5], 'some': users[6], 'tests':tests, 'is_none':is_none})
+                                             'doctor': users[1], 'nurse': users[2], 'tests':tests, 'is_none':is_none})
     else:
         return render_to_response('error.html')
 
@@ -1227,13 +1535,8 @@ def message_new(request):
         if request.method == 'POST':
             form = forms.NewMessageForm(request.POST)
             if form.is_valid():
-                form.save()
-                m = form.instance
-                names = [(m.sender.first_name + m.sender.last_name).replace(" ", ""),
-                         (m.receiver.first_name + m.receiver.last_name).replace(" ", "")]
-                names.sort()
-                c_id = names[0] + '-' + names[1]
-                return HttpResponseRedirect(reverse('view_conversation', kwargs={'name': c_id}))
+                message = form.save()
+                return HttpResponseRedirect(reverse('view_conversation', args=[message.conversation_id]))
         user = request.user
         users = get_user_type(user)
         ex = 'Sender'
@@ -1298,81 +1601,49 @@ def message(request):
         pat = None
         user = request.user
         users = get_user_type(user)
-        convos = get_conv(request)
-        names = convos.keys()
+        convos = conversations_of(user.id)
         is_empty = len(convos) == 0
 
 
 
         return render(request, 'messages.html', {'user': user, "admin": users[3], "patient": users[0], 'hosp': users[4],
-                                             'doctor': users[1], 'nurse': users[2], 'apps': users[5], 'some': users[6], 'convos':convos, 'pat':pat,
-                                                 'names':names, 'is_empty':is_empty})
+                                             'doctor': users[1], 'nurse': users[2], 'convos':convos, 'pat':pat,
+                                                 'is_empty':is_empty})
     else:
         return render_to_response('error.html')
 
 
-def get_conv(request):
-    """
-          returns a dictionary of conversations (conversation id -> list of messages)
-          :param request: the request for loading the messages page
-          :return: Redirect to the employee page
-    """
-
-    user = request.user
-    users = get_user_type(user)
-    convos = {}
-
-    for m in Message.objects.all():
-        if m.receiver.id == user.id or m.sender.id == user.id:
-            names = [(m.sender.first_name + m.sender.last_name).replace(" ", ""), (m.receiver.first_name + m.receiver.last_name).replace(" ", "")]
-            names.sort()
-            c_id = names[0] + '-' + names[1]
-            if c_id in convos.keys():
-                convos[c_id].append(m)
-            else:
-                convos[c_id] = []
-                convos[c_id].append(m)
-    return convos
-
-def view_conversation(request, name):
+def view_conversation(request, conv_id):
     """
            view for a given conversation
            :param request: the request to view a specific conversation
-           :param name: the id for the conversation (name-name)
+           :param conv_id: the id of the conversation
             :return: Redirect to the template for the conversation
     """
     if User.objects.filter(pk=request.user.id):
-        user = request.user
-        you = []
-        other_user = None
-        them = []
         user = request.user
         users = get_user_type(user)
-        convos = get_conv(request)
-        messages = convos[name]
-        for message in messages:
-            if message.sender.id == user.id:
-                you.append(message)
-
-            else:
-                them.append(message)
-                Message.objects.filter(pk=message.id).update(status=True)
-
+        cursor = request.GET.get('before')
+        messages, older = thread(user.id, int(conv_id), cursor)
+        if not messages:
+            return HttpResponseNotFound('<h1>No such conversation</h1>')
+        if not cursor:
+            # marks the whole conversation, so older pages needn't do it again
+            mark_read(user.id, int(conv_id))
 
         m = messages[0]
-        if m.sender.id != user.id:
+        if m.sender_id != user.id:
             other_user = m.sender
-            other_name = m.sender.first_name + " " + m.sender.last_name
-
         else:
             other_user = m.receiver
-            other_name = m.receiver.first_name + " " + m.receiver.last_name
+        other_name = other_user.first_name + " " + other_user.last_name
 
 
         return render(request, 'view_conversation.html',
                       {'user': user, "admin": users[3], "patient": users[0], 'hosp': users[4],
                        'doctor': users[1],
-                       'nurse': users[2], 'messages':messages, 'title':m, 'you':you, 'them':them, 'other_user':other_user.username, 'other_name':other_name})
+                       'nurse': users[2], 'messages':messages, 'title':m, 'other_user':other_user.username, 'other_name':other_name,
+                       'older': older})
     else:
         return render_to_response('error.html')
 
@@ -1387,13 +1658,8 @@ def reply(request, otheruser_name):
         if request.method == 'POST':
             form = forms.NewMessageForm(request.POST)
             if form.is_valid():
-                form.save()
-                m = form.instance
-                names = [(m.sender.first_name + m.sender.last_name).replace(" ", ""),
-                         (m.receiver.first_name + m.receiver.last_name).replace(" ", "")]
-                names.sort()
-                c_id = names[0] + '-' + names[1]
-                return HttpResponseRedirect(reverse('view_conversation', kwargs={'name': c_id}))
+                message = form.save()
+                return HttpResponseRedirect(reverse('view_conversation', args=[message.conversation_id]))
         user = request.user
         users = get_user_type(user)
         otheruser = models.User.objects.get(username=otheruser_name)
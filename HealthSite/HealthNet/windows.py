@@ -0,0 +1,93 @@
+"""
+    File containing the date windows that the calendar views filter
+    appointments by. A window is half open, from its start up to but not
+    including its end, and is turned into a plain >= / < comparison on the
+    appointment time. Unlike the __year, __month and __day lookups, which the
+    database has to work out for every row, a comparison can use the
+    (patient, appointment_time) and (doctor, appointment_time) indexes.
+"""
+
+import calendar as stdlib_calendar
+import datetime
+from collections import namedtuple
+
+
+def week_start(day):
+    """
+        Returns the sunday that starts the week of the given day
+    :param day: (date) the day
+    :return: (date) the sunday on or before the day
+    """
+    return day - datetime.timedelta(days=(day.weekday() + 1) % 7)
+
+
+def is_valid_day(day, month, year):
+    """
+        Determines if a day, month and year make up a real date that the
+        calendar can show, counting leap years. The very last date can't be
+        shown, as its window would end after it.
+    :return: True if the date is valid, False otherwise
+    """
+    return (1 <= month <= 12 and 1900 <= year <= datetime.MAXYEAR
+            and 1 <= day <= stdlib_calendar.monthrange(year, month)[1]
+            and datetime.date(year, month, day) < datetime.date.max)
+
+
+def is_valid_month(month, year):
+    """
+        Determines if a month and year make up a month that the calendar can
+        show. As with days, the very last month can't be shown.
+    :return: True if the month is valid, False otherwise
+    """
+    return 1 <= month <= 12 and 1900 <= year <= datetime.MAXYEAR and (year, month) < (datetime.MAXYEAR, 12)
+
+
+class DateWindow(namedtuple('DateWindow', ['start', 'end'])):
+    """
+        A half open window of time, [start, end)
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def day(cls, day):
+        """
+            Returns the window of a single day
+        :param day: (date) the day
+        :return: (DateWindow) the window
+        """
+        start = datetime.datetime.combine(day, datetime.time.min)
+        return cls(start, start + datetime.timedelta(days=1))
+
+    @classmethod
+    def week(cls, day):
+        """
+            Returns the window of the week, sunday to saturday, of a day
+        :param day: (date) any day of the week
+        :return: (DateWindow) the window
+        """
+        start = datetime.datetime.combine(week_start(day), datetime.time.min)
+        return cls(start, start + datetime.timedelta(days=7))
+
+    @classmethod
+    def month(cls, month, year):
+        """
+            Returns the window of a month
+        :param month: (int) the month, 1 - 12
+        :param year: (int) the year
+        :return: (DateWindow) the window
+        """
+        start = datetime.datetime(year, month, 1)
+        days = stdlib_calendar.monthrange(year, month)[1]
+        return cls(start, start + datetime.timedelta(days=days))
+
+    def lookup(self, field='appointment_time'):
+        """
+            Returns the filter arguments that select the window
+
+            Usage:
+                Appointment.objects.filter(**window.lookup())
+        :param field: (str) the datetime field to filter on
+        :return: (dict) the filter arguments
+        """
+        return {field + '__gte': self.start, field + '__lt': self.end}
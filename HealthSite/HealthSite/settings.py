@@ -50,6 +50,7 @@ MIDDLEWARE_CLASSES = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'HealthNet.middleware.RoleMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -67,6 +68,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'HealthNet.context_processors.healthnet_role',
             ],
         },
     },
@@ -86,6 +88,27 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+#
+# Dashboard panels, calendars and free slots are cached under versions that
+# saves bump (see HealthNet/cache_versions.py), so every process serving the
+# site must share one cache or a bump made in one of them never reaches the
+# others. The file based cache is shared by all the processes on one machine;
+# a site served from several machines should use a memcached server instead.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache/'),
+        'OPTIONS': {
+            # per doctor-day free slots and per user panels add up to many
+            # more entries than the default of 300
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -132,4 +155,57 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media_cdn/')
 LOGIN_REDIRECT_URL = 'base'
 LOGIN_URL = 'Login'
 
+# How far ahead (in days) and how many upcoming appointments the dashboard shows
+HEALTHNET_UPCOMING_APPOINTMENTS_DAYS = 30
+HEALTHNET_UPCOMING_APPOINTMENTS_LIMIT = 10
+
+# How many unread message previews the dashboard shows
+HEALTHNET_DASHBOARD_PREVIEW_LIMIT = 5
+
+# How many system log entries the admin dashboard shows per page
+HEALTHNET_LOG_PANEL_LIMIT = 25
+
+# How many seconds a user's rendered dashboard panels are cached for. Saves
+# invalidate the cache right away; the timeout only lets the time windows of
+# the panels move on.
+HEALTHNET_DASHBOARD_CACHE_TIMEOUT = 60
+
+# How many seconds a rendered month calendar is cached for. Appointment saves
+# invalidate it right away, and the key changes at midnight.
+HEALTHNET_CALENDAR_CACHE_TIMEOUT = 60 * 60 * 24
+
+# The window of appointments in a calendar feed when the client doesn't ask
+# for one, in days before and after today, and the longest window a client
+# may ask for
+HEALTHNET_ICS_PAST_DAYS = 30
+HEALTHNET_ICS_FUTURE_DAYS = 180
+HEALTHNET_ICS_MAX_DAYS = 366
+
+# How many doctors the hospital schedule shows per page
+HEALTHNET_SCHEDULE_DOCTORS_PER_PAGE = 10
+
+# The hours, start and end, that appointments are offered in by the free slot
+# finder
+HEALTHNET_WORKING_HOURS = (9, 17)
+
+# How many days the free slot finder covers when the client doesn't ask for
+# a range, and the longest range a client may ask for
+HEALTHNET_AVAILABILITY_DEFAULT_DAYS = 7
+HEALTHNET_AVAILABILITY_MAX_DAYS = 31
+
+# How many seconds the free slots of a doctor-day are cached for. Appointment
+# saves invalidate them right away.
+HEALTHNET_AVAILABILITY_CACHE_TIMEOUT = 60 * 60 * 24
+
+# How many appointments a bulk import writes per INSERT
+HEALTHNET_IMPORT_BATCH_SIZE = 500
+
+# How many days ahead a recurring series that doesn't end is checked for
+# conflicts when it is booked
+HEALTHNET_SERIES_HORIZON_DAYS = 365
+
+# The most appointments a doctor can accept or reject in one batch
+HEALTHNET_TRIAGE_MAX_APPOINTMENTS = 500
 
+# How many messages a conversation shows per page, the newest first
+HEALTHNET_CONVERSATION_PAGE_SIZE = 50